@@ -0,0 +1,187 @@
+"""
+ASGI version of app.routes for production serving, see serve.py. Requests are handled on the
+server's event loop and await the upstream I/O directly, so one worker process serves many
+/profile calls at once instead of tying up a thread per request like the flask app does
+"""
+import json
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Tuple
+from urllib.parse import parse_qs
+
+from app import cache, client, executor, metrics, snapshots
+from app.routes import Body, handle_profile, handle_profiles
+
+logger = logging.getLogger("user_profiles_api")
+
+class Request:
+    """
+    The parts of an ASGI http request the endpoints need
+    """
+    def __init__(self, scope: dict, receive: Callable[[], Awaitable[dict]]):
+        self.scope = scope
+        self._receive = receive
+        self.args = {key: values[0] for key, values in parse_qs(scope.get("query_string", b"").decode("latin-1"),
+            keep_blank_values = True).items()}
+
+    async def body(self) -> bytes:
+        chunks = []
+        while True:
+            message = await self._receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+def text(body: str, status: int = 200) -> Tuple[int, bytes, str]:
+    return status, body.encode("utf-8"), "text/html; charset=utf-8"
+
+def prometheus(body: str) -> Tuple[int, bytes, str]:
+    return 200, body.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+
+def json_response(body, status: int = 200) -> Tuple[int, bytes, str]:
+    return status, json.dumps(body, sort_keys = True).encode("utf-8"), "application/json"
+
+def ndjson(lines: AsyncIterator) -> Tuple[int, AsyncIterator[bytes], str]:
+    """
+    :param lines: async iterator of the json values to send, one per line as they come
+    :returns: a streamed response
+    """
+    async def body():
+        try:
+            async for line in lines:
+                yield json.dumps(line, sort_keys = True).encode("utf-8") + b"\n"
+        finally:
+            await lines.aclose()
+    return 200, body(), "application/x-ndjson"
+
+def respond(status: int, body: Body) -> Tuple[int, bytes, str]:
+    """
+    :param status: status of the response
+    :param body: body returned by one of the shared handlers, see app.routes.to_response
+    :returns: the response to send
+    """
+    if isinstance(body, str):
+        return text(body, status = status)
+    if isinstance(body, dict):
+        return json_response(body, status = status)
+    return ndjson(body)
+
+async def profile(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to get unified profile from github and bitbucket, see app.routes.profile for its arguments
+    """
+    return respond(*await handle_profile(request.args))
+
+async def profiles(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to get the profiles of many bitbucket teams and github orgs at once, along with their total
+    """
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        body = None
+    return respond(*await handle_profiles(body, request.args))
+
+async def health_check(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to health check API
+    """
+    return text("All Good!")
+
+async def metrics_endpoint(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to expose this worker's request counters, cache hits, retries and latency histograms to prometheus
+    """
+    return prometheus(metrics.render())
+
+async def pool_stats(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to report the usage of this worker's upstream connection pool
+    """
+    return json_response(client.pool_stats(asyncio.get_running_loop()))
+
+async def cache_stats(request: Request) -> Tuple[int, bytes, str]:
+    """
+    Endpoint to report the hits, misses and revalidations of this worker's caches
+    """
+    return json_response({"responses": cache.responses.stats, "profiles": cache.profiles.stats})
+
+ROUTES = {
+    "/profile": ("GET", profile),
+    "/profiles": ("POST", profiles),
+    "/health-check": ("GET", health_check),
+    "/metrics": ("GET", metrics_endpoint),
+    "/pool-stats": ("GET", pool_stats),
+    "/cache-stats": ("GET", cache_stats),
+}
+
+async def startup():
+    """
+    Opens the pooled client on the server's event loop, and starts the snapshots of the watchlist if
+    there is one. A single worker process refreshes them, the others read what it saves
+    """
+    client.get_client()
+    if snapshots.watchlist_from_env():
+        snapshots.start()
+
+async def shutdown():
+    """
+    Stops the refresh worker and the crawl processes, closes the pooled client and empties the caches
+    """
+    snapshots.stop()
+    executor.stop()
+    await client.aclose()
+    cache.responses.clear()
+    cache.profiles.clear()
+
+async def lifespan(receive: Callable[[], Awaitable[dict]], send: Callable[[dict], Awaitable[None]]):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await startup()
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def application(scope: dict, receive: Callable[[], Awaitable[dict]], send: Callable[[dict], Awaitable[None]]):
+    """
+    The ASGI application, serve it with e.g. `uvicorn app.asgi:application`
+    """
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    method, endpoint = ROUTES.get(scope["path"], (None, None))
+    if endpoint is None:
+        status, body, content_type = text("Not Found", status = 404)
+    elif scope["method"] not in (method, "HEAD" if method == "GET" else method):
+        status, body, content_type = text("Method Not Allowed", status = 405)
+    else:
+        try:
+            status, body, content_type = await endpoint(Request(scope, receive))
+        except Exception:
+            logger.exception(f"Failed to handle {scope['method']} {scope['path']}")
+            status, body, content_type = text("Internal Server Error", status = 500)
+
+    if isinstance(body, bytes):
+        await send({"type": "http.response.start", "status": status,
+            "headers": [(b"content-type", content_type.encode("latin-1")), (b"content-length", str(len(body)).encode("latin-1"))]})
+        await send({"type": "http.response.body", "body": body if scope["method"] != "HEAD" else b""})
+        return
+
+    # a streamed body goes out chunk by chunk as the endpoint produces it
+    await send({"type": "http.response.start", "status": status, "headers": [(b"content-type", content_type.encode("latin-1"))]})
+    try:
+        if scope["method"] != "HEAD":
+            async for chunk in body:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+    finally:
+        await body.aclose()
+    await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,318 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Awaitable, Callable, List, Optional, Tuple
+from collections import OrderedDict
+
+from app import metrics
+
+logger = logging.getLogger("user_profiles_api")
+
+# request headers that change what the upstream apis send back
+VARY_HEADERS = ["accept", "authorization"]
+# response headers that describe the encoded body, we store the decoded one
+ENCODING_HEADERS = ["content-encoding", "content-length", "transfer-encoding"]
+
+class CachedResponse:
+    """
+    A successful upstream response along with what we need to revalidate it
+    """
+    __slots__ = ["content", "headers", "expires"]
+
+    def __init__(self, content: bytes, headers: List[Tuple[str, str]], expires: float):
+        """
+        :param content: raw body of the response
+        :param headers: headers of the response
+        :param expires: time.monotonic() value after which the response has to be revalidated
+        """
+        self.content = content
+        self.headers = headers
+        self.expires = expires
+
+    def header(self, name: str) -> Optional[str]:
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+class CacheBackend:
+    """
+    Interface for where cached responses are stored, implement it to point the cache at a shared store
+    """
+    def get(self, key: str) -> Optional[CachedResponse]:
+        raise NotImplementedError
+
+    def set(self, key: str, entry: CachedResponse):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+class MemoryBackend(CacheBackend):
+    """
+    In-process backend that evicts the least recently used entries once it holds more than `max_entries`,
+    or once their bodies add up to more than `max_bytes`
+    """
+    def __init__(self, max_entries: int = 1024, max_bytes: Optional[int] = None):
+        """
+        :optional param max_entries: most responses kept
+        :optional param max_bytes: most bytes of response bodies kept, None for no limit.
+            A body bigger than that on its own isn't kept at all
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, entry: CachedResponse):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.content)
+            if self.max_bytes is not None and len(entry.content) > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self.size += len(entry.content)
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                _, evicted = self._entries.popitem(last = False)
+                self.size -= len(evicted.content)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+class ResponseCache:
+    """
+    Caches upstream GET responses for `ttl` seconds. Stale entries are revalidated with
+    If-None-Match/If-Modified-Since, github doesn't count the resulting 304s against the rate limit
+    """
+    def __init__(self, backend: CacheBackend = None, ttl: float = 60.0, enabled: bool = True, listings: bool = False):
+        """
+        :optional param backend: where entries are stored, defaults to an in-process MemoryBackend
+        :optional param ttl: seconds an entry is served without asking the upstream api
+        :optional param enabled: set to False to send every request upstream
+        :optional param listings: set to True to cache the pages of streamed listings too, which means
+            holding each whole page in memory instead of only parsing it as it arrives
+        """
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.listings = listings
+        self.stats = {"hits": 0, "misses": 0, "revalidations": 0, "revalidated": 0}
+
+    def key(self, endpoint: str, headers: dict) -> str:
+        """
+        Builds the cache key from the endpoint and the headers that affect the response,
+        secrets are hashed so they're never stored in a backend
+
+        :param endpoint: endpoint of the request
+        :param headers: headers of the request
+        :returns: the key for the request
+        """
+        vary = {name.lower(): value for name, value in headers.items() if name.lower() in VARY_HEADERS}
+        if "authorization" in vary:
+            vary["authorization"] = hashlib.sha256(vary["authorization"].encode()).hexdigest()
+        return endpoint + "|" + "|".join(f"{name}={vary[name]}" for name in sorted(vary))
+
+    def lookup(self, key: str) -> Optional[CachedResponse]:
+        """
+        :param key: key of the request
+        :returns: the cached entry for the request (fresh or stale), or None
+        """
+        if not self.enabled:
+            return None
+        entry = self.backend.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+        elif entry.fresh():
+            self.stats["hits"] += 1
+        else:
+            self.stats["revalidations"] += 1
+        return entry
+
+    def conditional_headers(self, entry: CachedResponse) -> dict:
+        """
+        :param entry: stale entry to revalidate
+        :returns: the headers that ask the upstream api to only send the body if it changed
+        """
+        headers = {}
+        if entry.header("etag"):
+            headers["If-None-Match"] = entry.header("etag")
+        if entry.header("last-modified"):
+            headers["If-Modified-Since"] = entry.header("last-modified")
+        return headers
+
+    def store(self, key: str, content: bytes, headers: List[Tuple[str, str]]):
+        """
+        :param key: key of the request
+        :param content: raw body of the response
+        :param headers: headers of the response
+        """
+        if self.enabled:
+            headers = [(name, value) for name, value in headers if name.lower() not in ENCODING_HEADERS]
+            self.backend.set(key, CachedResponse(content, headers, time.monotonic() + self.ttl))
+
+    def refresh(self, key: str, entry: CachedResponse):
+        """
+        Marks a stale entry as fresh again after the upstream api answered 304
+
+        :param key: key of the request
+        :param entry: entry that was revalidated
+        """
+        self.stats["revalidated"] += 1
+        entry.expires = time.monotonic() + self.ttl
+        self.backend.set(key, entry)
+
+    def clear(self):
+        self.backend.clear()
+        for stat in self.stats:
+            self.stats[stat] = 0
+
+class ProfileCache:
+    """
+    Caches finished profiles per provider and org. Identical lookups that arrive while one is
+    being computed wait on that one computation instead of crawling again, and profiles that are
+    a bit old are served straight away while a refresh runs in the background
+    """
+    def __init__(self, ttl: float = 60.0, stale_ttl: float = 600.0, max_entries: int = 1024):
+        """
+        :optional param ttl: seconds a profile is served as is
+        :optional param stale_ttl: seconds after the ttl that a profile is still served while it's refreshed
+        :optional param max_entries: number of profiles kept before the least recently used is evicted
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0}
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    async def get(self, provider: str, organization: str, fetch: Callable[[], Awaitable]):
+        """
+        Returns the cached profile for an org, computing it with `fetch` if needed
+
+        :param provider: provider the org belongs to, e.g. "github"
+        :param organization: name of the org
+        :param fetch: function that returns a coroutine computing the profile
+        :returns: the profile of the org
+        :raises ConnectionError: raises an exception if the profile had to be computed and that failed
+        """
+        key = (provider, organization)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            age = time.monotonic() - entry[1]
+            if age < self.ttl:
+                self.stats["hits"] += 1
+                return entry[0]
+            if age < self.ttl + self.stale_ttl:
+                self.stats["stale"] += 1
+                self._in_flight_task(key, fetch)
+                return entry[0]
+
+        task = self._in_flight.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+        # shield so a caller giving up doesn't cancel the computation the others wait on
+        return await asyncio.shield(self._in_flight_task(key, fetch))
+
+    def peek(self, provider: str, organization: str):
+        """
+        Returns the cached profile of an org if it's fresh, without computing it otherwise
+
+        :param provider: provider the org belongs to
+        :param organization: name of the org
+        :returns: the profile of the org, or None
+        """
+        with self._lock:
+            entry = self._entries.get((provider, organization))
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self.stats["hits"] += 1
+            return entry[0]
+        return None
+
+    def _in_flight_task(self, key: tuple, fetch: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self._in_flight.get(key)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            return task
+
+        task = asyncio.ensure_future(fetch())
+        self._in_flight[key] = task
+
+        def done(task: asyncio.Task):
+            # a crawl that was running when the cache was cleared isn't stored
+            if self._in_flight.get(key) is not task:
+                return
+            del self._in_flight[key]
+            if task.cancelled():
+                return
+            if task.exception() is not None:
+                logger.warning(f"Failed to refresh the profile of {key[0]} org {key[1]}: {task.exception()}")
+                return
+            self.store(key[0], key[1], task.result())
+
+        task.add_done_callback(done)
+        return task
+
+    def store(self, provider: str, organization: str, profile):
+        """
+        :param provider: provider the org belongs to
+        :param organization: name of the org
+        :param profile: profile to cache
+        """
+        with self._lock:
+            self._entries[(provider, organization)] = (profile, time.monotonic())
+            self._entries.move_to_end((provider, organization))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        """
+        Forgets every profile, along with the ones being computed so later lookups crawl again
+        """
+        with self._lock:
+            self._entries.clear()
+            self._in_flight.clear()
+        for stat in self.stats:
+            self.stats[stat] = 0
+
+responses = ResponseCache(MemoryBackend(int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)),
+        int(os.environ.get("RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))),
+    ttl = float(os.environ.get("RESPONSE_CACHE_TTL", 60)), listings = os.environ.get("RESPONSE_CACHE_LISTINGS") == "1")
+profiles = ProfileCache(ttl = float(os.environ.get("PROFILE_CACHE_TTL", 60)),
+    stale_ttl = float(os.environ.get("PROFILE_CACHE_STALE_TTL", 600)))
+
+def collect() -> list:
+    """
+    :returns: the cache stats as metrics, see metrics.collector
+    """
+    return [("response_cache_lookups_total", "counter", "Upstream response cache lookups by result",
+            [({"result": result}, count) for result, count in responses.stats.items()]),
+        ("profile_cache_lookups_total", "counter", "Profile cache lookups by result",
+            [({"result": result}, count) for result, count in profiles.stats.items()])]
+
+metrics.collector(collect)
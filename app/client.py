@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import concurrent.futures
+import weakref
+from typing import AsyncIterator, Coroutine, Iterator, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from app import metrics, scheduler
+
+# http/2 needs the optional `h2` package (pip install httpx[http2]), fall back to http/1.1 without it
+try:
+    import h2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+# pool settings, these can be tuned at runtime with configure()
+settings = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "max_connections_per_host": 20,
+    "max_concurrent_crawls": 8,
+    "requests_per_second_per_host": None,
+    "max_retries": 4,
+    "backoff_base": 0.5,
+    "backoff_cap": 30.0,
+    "max_rate_limit_wait": 60.0,
+    "keepalive_expiry": 30.0,
+    "timeout": 10.0,
+    "http2": HTTP2,
+    "transport": None,
+}
+
+class PooledTransport(httpx.AsyncHTTPTransport):
+    """
+    Transport that keeps track of how many connections the pool has opened so we can tell
+    how often a request reused a kept-alive connection instead of paying for a new handshake
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.requests = 0
+        self.opened = 0
+        self._seen = weakref.WeakSet()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await super().handle_async_request(request)
+        self.requests += 1
+        for connection in self._pool.connections:
+            if connection not in self._seen:
+                self._seen.add(connection)
+                self.opened += 1
+        return response
+
+class _LoopState:
+    """
+    Everything that is bound to a single event loop: the pooled client and the per host schedulers
+    """
+    def __init__(self):
+        limits = httpx.Limits(max_connections = settings["max_connections"],
+            max_keepalive_connections = settings["max_keepalive_connections"],
+            keepalive_expiry = settings["keepalive_expiry"])
+        self.transport = settings["transport"] or PooledTransport(http2 = settings["http2"], limits = limits)
+        self.client = httpx.AsyncClient(transport = self.transport, timeout = settings["timeout"])
+        self.schedulers = {}
+        self.crawl_slots = asyncio.Semaphore(settings["max_concurrent_crawls"])
+
+_states = weakref.WeakKeyDictionary()
+# held while a state is built or the states are reset, so a crawl still running on another thread
+# can't build its client from the settings configure is replacing
+_states_lock = threading.RLock()
+_loop = None
+_loop_lock = threading.Lock()
+
+def _state() -> _LoopState:
+    loop = asyncio.get_running_loop()
+    state = _states.get(loop)
+    if state is None:
+        with _states_lock:
+            state = _states.get(loop)
+            if state is None:
+                state = _states[loop] = _LoopState()
+    return state
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Returns the shared pooled client for the running event loop, creating it on first use
+
+    :returns: an httpx.AsyncClient that keeps connections alive between requests
+    """
+    return _state().client
+
+def host_scheduler(endpoint: str) -> scheduler.HostScheduler:
+    """
+    Returns the scheduler that paces, caps and retries the requests to the endpoint's host
+
+    :param endpoint: url that is about to be requested
+    :returns: a scheduler shared by every request to the same host
+    """
+    host = urlsplit(endpoint).netloc
+    schedulers = _state().schedulers
+    if host not in schedulers:
+        schedulers[host] = scheduler.HostScheduler(max_concurrency = settings["max_connections_per_host"],
+            rate = settings["requests_per_second_per_host"], max_retries = settings["max_retries"],
+            backoff_base = settings["backoff_base"], backoff_cap = settings["backoff_cap"],
+            max_wait = settings["max_rate_limit_wait"])
+    return schedulers[host]
+
+def crawl_slot() -> asyncio.Semaphore:
+    """
+    Returns the semaphore that caps how many orgs are crawled at once by batch requests,
+    shared by every batch on the event loop
+
+    :returns: a semaphore shared by every batch crawl
+    """
+    return _state().crawl_slots
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target = _loop.run_forever, name = "upstream-loop", daemon = True).start()
+        return _loop
+
+def run(coroutine: Coroutine):
+    """
+    Runs a coroutine on the process wide background event loop and blocks until it's done.
+    Unlike asyncio.run the loop (and the connection pool bound to it) outlives the call,
+    so kept-alive connections are reused by every synchronous caller
+
+    :param coroutine: coroutine to run
+    :returns: the result of the coroutine
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _background_loop()).result()
+
+def submit(coroutine: Coroutine) -> concurrent.futures.Future:
+    """
+    Starts a coroutine on the process wide background event loop without waiting for it
+
+    :param coroutine: coroutine to run
+    :returns: a future for the result of the coroutine
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _background_loop())
+
+def iterate(iterator: AsyncIterator) -> Iterator:
+    """
+    Drives an async iterator on the process wide background event loop, handing out its items
+    to a synchronous caller as they come. Closing the returned iterator early closes the async one
+
+    :param iterator: async iterator to drive
+    :returns: an iterator of the same items
+    """
+    loop = _background_loop()
+    try:
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(iterator.__anext__(), loop).result()
+            except StopAsyncIteration:
+                return
+    finally:
+        asyncio.run_coroutine_threadsafe(iterator.aclose(), loop).result()
+
+async def aclose():
+    """
+    Closes the pooled client of the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    state = _states.pop(loop, None)
+    if state is not None:
+        await state.client.aclose()
+
+def configure(**options):
+    """
+    Updates the pool settings, clients created afterwards pick up the new values
+
+    :param options: any of the keys in `settings`
+    :raises KeyError: raises an exception if an option isn't a known setting
+    """
+    for key in options:
+        if key not in settings:
+            raise KeyError("Unknown client setting " + key)
+    with _states_lock:
+        settings.update(options)
+        reset()
+
+def reset():
+    """
+    Drops every pooled client so the next request builds a new one with the current settings
+    """
+    with _states_lock:
+        for loop, state in list(_states.items()):
+            if loop.is_running() and not loop.is_closed():
+                asyncio.run_coroutine_threadsafe(state.client.aclose(), loop)
+        _states.clear()
+
+def pool_stats(loop: Optional[asyncio.AbstractEventLoop] = None) -> dict:
+    """
+    Reports the connection pool usage so the limits can be tuned
+
+    :optional param loop: event loop whose pool to report on, defaults to the background loop
+    :returns: a dict with the number of open, idle, opened and reused connections, and the
+        concurrency limit and retries of each host
+    """
+    state = _states.get(loop or _loop) if (loop or _loop) is not None else None
+    stats = {"open": 0, "idle": 0, "opened": 0, "requests": 0, "reused": 0, "http2": settings["http2"], "hosts": {}}
+    if state is None:
+        return stats
+    stats["hosts"] = {host: host_scheduler.report() for host, host_scheduler in state.schedulers.items()}
+    if not isinstance(state.transport, PooledTransport):
+        return stats
+    connections = state.transport._pool.connections
+    stats["open"] = len(connections)
+    stats["idle"] = sum(1 for connection in connections if connection.is_idle())
+    stats["opened"] = state.transport.opened
+    stats["requests"] = state.transport.requests
+    stats["reused"] = max(state.transport.requests - state.transport.opened, 0)
+    return stats
+
+def collect() -> list:
+    """
+    :returns: the scheduler counters and limits of every host (summed over the event loops) as metrics,
+        see metrics.collector
+    """
+    hosts = {}
+    for state in list(_states.values()):
+        for host, host_scheduler in state.schedulers.items():
+            totals = hosts.setdefault(host, {"requests": 0, "retries": 0, "throttled": 0, "concurrency": 0, "in_flight": 0})
+            for name, value in host_scheduler.report().items():
+                totals[name] += value
+    return [(f"upstream_{name}", kind, documentation, [({"host": host}, totals[stat]) for host, totals in sorted(hosts.items())])
+        for name, stat, kind, documentation in [
+            ("attempts_total", "requests", "counter", "Requests sent to each upstream host, retries included"),
+            ("retries_total", "retries", "counter", "Upstream requests that were retried"),
+            ("throttled_total", "throttled", "counter", "Upstream responses that asked us to slow down"),
+            ("concurrency_limit", "concurrency", "gauge", "Current AIMD limit on requests in flight per host"),
+            ("in_flight", "in_flight", "gauge", "Upstream requests in flight per host")]]
+
+metrics.collector(collect)
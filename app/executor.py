@@ -0,0 +1,209 @@
+"""
+Process pool mode for crawling very large sets of teams/orgs, or a single very large one, once
+decoding the listings and tallying the repos keeps a core busy. Each worker process runs its own
+event loop and connection pool (see app.client), gathers its shard of the work with the
+app.parsers coroutines and sends back compact profiles that are merged here with `+`.
+
+Set CRAWL_PROCESSES to the number of workers to gather /profiles batches, and the pages of big
+teams/orgs, this way. The workers' upstream requests and cache hits are counted in their own
+process, not in /metrics
+"""
+import os
+import math
+import asyncio
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+from typing import AsyncIterator, Iterable, List, Optional
+
+from app import cache, client, parsers, snapshots
+from app.profile import OrganizationProfile
+
+import httpx
+
+logger = logging.getLogger("user_profiles_api")
+
+# worker processes, 0 to gather everything in this process
+PROCESSES = int(os.environ.get("CRAWL_PROCESSES", 0))
+# most teams/orgs handed to a worker at once, so a few big ones don't leave the other workers idle
+ORGS_PER_TASK = 4
+
+pool = None
+workers = 0
+_pool_lock = threading.Lock()
+
+def compact(result: OrganizationProfile) -> tuple:
+    """
+    :param result: profile to send across processes
+    :returns: the profile as a tuple of plain values
+    """
+    return (result.repos, result.forks, result.watchers, dict(result.languages), dict(result.topics))
+
+def expand(result: tuple) -> OrganizationProfile:
+    """
+    :param result: output of compact()
+    :returns: the profile
+    """
+    return OrganizationProfile(*result)
+
+def start(processes: int = None) -> concurrent.futures.ProcessPoolExecutor:
+    """
+    Starts the worker processes, they pick up the current client settings and whether the
+    response cache is on
+
+    :optional param processes: number of workers, defaults to CRAWL_PROCESSES or the number of cpus
+    :returns: the pool
+    """
+    global pool, workers
+    stop()
+    with _pool_lock:
+        workers = processes or PROCESSES or os.cpu_count()
+        # spawned rather than forked, forking would copy the background event loop without its thread
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers = workers,
+            mp_context = multiprocessing.get_context("spawn"), initializer = _start_worker,
+            initargs = (dict(client.settings), cache.responses.enabled, cache.responses.listings))
+        return pool
+
+def stop():
+    """
+    Stops the worker processes, if they were started
+    """
+    global pool, workers
+    with _pool_lock:
+        if pool is not None:
+            pool.shutdown()
+        pool = None
+        workers = 0
+
+def _pool() -> concurrent.futures.ProcessPoolExecutor:
+    current = pool
+    return current if current is not None else start()
+
+def _start_worker(settings: dict, cached: bool, listings: bool):
+    global PROCESSES
+    # the workers gather their share themselves, CRAWL_PROCESSES is passed down to them too
+    PROCESSES = 0
+    client.configure(**settings)
+    cache.responses.enabled = cached
+    cache.responses.listings = listings
+    logger.setLevel(logging.WARNING)
+
+def shards(items: list, count: int) -> List[list]:
+    """
+    :param items: work to split
+    :param count: most shards to split it in
+    :returns: the items split in at most `count` contiguous shards of about the same size
+    """
+    size = max(math.ceil(len(items) / max(count, 1)), 1)
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def _crawl_orgs(teams: List[str], organizations: List[str]) -> dict:
+    results = client.run(parsers.fetch_profiles(teams, organizations))
+    # exceptions go back as ConnectionErrors, not every httpx error survives pickling
+    return {provider: {name: compact(result) if isinstance(result, OrganizationProfile) else ConnectionError(str(result))
+        for name, result in provider_results.items()} for provider, provider_results in results.items()}
+
+def _known(provider: str, name: str) -> Optional[OrganizationProfile]:
+    snapshot = snapshots.lookup(provider, name)
+    return snapshot if snapshot is not None else cache.profiles.peek(provider, name)
+
+async def fetch_profiles(teams: List[str], organizations: List[str]) -> dict:
+    """
+    parsers.fetch_profiles with the teams and orgs sharded across the worker processes. Watched
+    and freshly cached ones are answered here, what the workers gather goes into this process's
+    profile cache
+
+    :param teams: bitbucket teams to gather the stats of
+    :param organizations: github organizations to gather the stats of
+    :returns: the "bitbucket" and "github" results, see parsers.fetch_profiles
+    """
+    teams = list(dict.fromkeys(teams))
+    organizations = list(dict.fromkeys(organizations))
+    names = [("bitbucket", team) for team in teams] + [("github", organization) for organization in organizations]
+    known = {name: _known(*name) for name in names}
+    missing = [name for name in names if known[name] is None]
+
+    futures = {}
+    if missing:
+        current = _pool()
+        size = min(ORGS_PER_TASK, max(math.ceil(len(missing) / workers), 1))
+        for shard in shards(missing, math.ceil(len(missing) / size)):
+            future = asyncio.wrap_future(current.submit(_crawl_orgs, [name for provider, name in shard if provider == "bitbucket"],
+                [name for provider, name in shard if provider == "github"]))
+            futures.update((name, future) for name in shard)
+
+    async def gather(provider: str, name: str):
+        if known[(provider, name)] is not None:
+            return known[(provider, name)]
+
+        async def fetch() -> OrganizationProfile:
+            result = (await futures[(provider, name)])[provider][name]
+            if isinstance(result, Exception):
+                raise result
+            return expand(result)
+
+        try:
+            return await cache.profiles.get(provider, name, fetch)
+        except ConnectionError as e:
+            return e
+
+    # the shards aren't cancelled with the request, the refreshes of stale profiles still wait on them
+    results = await asyncio.gather(*[gather(provider, name) for provider, name in names])
+    return {"bitbucket": dict(zip(teams, results[:len(teams)])), "github": dict(zip(organizations, results[len(teams):]))}
+
+def crawl(teams: List[str], organizations: List[str]) -> dict:
+    """
+    Synchronous wrapper around fetch_profiles
+
+    :param teams: bitbucket teams to gather the stats of
+    :param organizations: github organizations to gather the stats of
+    :returns: the "bitbucket" and "github" results, see parsers.fetch_profiles
+    """
+    return client.run(fetch_profiles(teams, organizations))
+
+def _crawl_pages(provider: str, name: str, endpoints: List[str], fields: Iterable[str]) -> tuple:
+    fetch = parsers.fetch_bitbucket_pages if provider == "bitbucket" else parsers.fetch_github_pages
+    try:
+        result, _ = client.run(fetch(name, endpoints, fields))
+    except httpx.HTTPError as e:
+        raise ConnectionError(str(e))
+    return compact(result)
+
+async def shard_pages(provider: str, name: str, endpoints: List[str], fields: Iterable[str] = None) -> AsyncIterator[OrganizationProfile]:
+    """
+    Splits pages of a team/org's listing in contiguous ranges across the worker processes, see
+    parsers.fold_remaining
+
+    :param provider: "bitbucket" or "github"
+    :param name: name of the team/org
+    :param endpoints: listing pages to gather
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: an async iterator of the profile of each range, as they're done
+    :raises ConnectionError: raises an exception if any page could not be gathered
+    """
+    current = _pool()
+    futures = [asyncio.wrap_future(current.submit(_crawl_pages, provider, name, shard, fields)) for shard in shards(endpoints, workers)]
+    try:
+        for future in asyncio.as_completed(futures):
+            yield expand(await future)
+    finally:
+        for future in futures:
+            future.cancel()
+
+def crawl_pages(provider: str, name: str, fields: Iterable[str] = None) -> OrganizationProfile:
+    """
+    Gathers a single team/org with the pages of its listing split across the worker processes,
+    the way parsers.fetch_bitbucket/fetch_github do with CRAWL_PROCESSES set. The first page is
+    gathered here since it tells how many pages there are
+
+    :param provider: "bitbucket" or "github"
+    :param name: name of the team/org
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    :raises ConnectionError: raises an exception if any page could not be gathered
+    """
+    fetch = parsers.fetch_bitbucket_pages if provider == "bitbucket" else parsers.fetch_github_pages
+    shard = lambda endpoints: shard_pages(provider, name, endpoints, fields)
+    result, _ = client.run(fetch(name, fields = fields, shard = shard))
+    return result
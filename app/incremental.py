@@ -0,0 +1,189 @@
+import logging
+from typing import Callable, Dict, List, Optional
+from collections import Counter, namedtuple
+
+from app import parsers
+from app.profile import OrganizationProfile
+
+logger = logging.getLogger("user_profiles_api")
+
+# what a single repo adds to its org's profile, stored per repo so a refresh only has to look at what changed
+RepoEntry = namedtuple("RepoEntry", ["updated", "fork", "watchers", "language", "topics"])
+# the refreshed profile of an org along with the repo index entries to store or delete with it
+Refresh = namedtuple("Refresh", ["profile", "changed", "removed", "incremental"])
+# incremental refreshes in a row before every repo is listed again, they miss changes that don't bump a
+# repo's updated time (e.g. new bitbucket watchers)
+FULL_REFRESH_EVERY = 12
+
+def contribution(entry: RepoEntry) -> OrganizationProfile:
+    """
+    :param entry: index entry of a repo
+    :returns: the profile of just that repo
+    """
+    return OrganizationProfile(repos = 0 if entry.fork else 1, forks = 1 if entry.fork else 0, watchers = entry.watchers,
+        languages = Counter([entry.language]), topics = Counter(entry.topics))
+
+def unchanged(index: Dict[str, RepoEntry], repo) -> bool:
+    old = index.get(repo.id)
+    return old is not None and repo.updated is not None and old.updated == repo.updated
+
+def apply(totals: Optional[OrganizationProfile], index: Dict[str, RepoEntry], entries: Dict[str, RepoEntry],
+        removed: List[str], incremental: bool) -> Refresh:
+    """
+    Works out the new profile of an org. An incremental refresh takes the old contribution of every
+    changed or removed repo off the stored totals and adds the new one, a full refresh adds up the whole index
+
+    :param totals: the stored profile of the org
+    :param index: the stored entry of each repo
+    :param entries: the new entry of each new or changed repo
+    :param removed: ids of the repos that are gone
+    :param incremental: whether the totals can be reused
+    :returns: the refreshed profile and the index changes
+    """
+    if incremental:
+        profile = totals + OrganizationProfile()
+        for key, entry in entries.items():
+            if key in index:
+                profile -= contribution(index[key])
+            profile += contribution(entry)
+        for key in removed:
+            profile -= contribution(index[key])
+    else:
+        current = {key: entry for key, entry in index.items() if key not in removed}
+        current.update(entries)
+        profile = OrganizationProfile.merge_many(contribution(entry) for entry in current.values())
+    return Refresh(profile, {key: list(entry) for key, entry in entries.items()}, removed, incremental)
+
+async def list_changed(endpoint: str, index: Dict[str, RepoEntry], fold: Callable, slim: Callable,
+        headers: dict = {}, key: str = None) -> dict:
+    """
+    Pages through a listing sorted by most recently updated, one page at a time, until it reaches
+    a repo we've already seen unchanged, everything after it is older and so unchanged as well
+
+    :param endpoint: endpoint of the sorted listing, the page number is appended to it
+    :param index: the stored entry of each repo
+    :param fold: function that takes each repo that is new or changed
+    :param slim: function that turns an item of the listing into a repo record
+    :returns: the other top level values of the first page
+    """
+    reached = False
+    first = None
+
+    def check(repo):
+        nonlocal reached
+        if unchanged(index, repo):
+            reached = True
+        else:
+            fold(repo)
+
+    page = 1
+    while True:
+        response, fields = await parsers.get_request_items(f"{endpoint}&page={page}", check, slim, headers = headers, key = key)
+        first = first if first is not None else fields
+        more = "next" in fields if key is not None else "next" in response.links
+        if reached or not more:
+            return first
+        page += 1
+
+async def refresh_github(organization: str, index: Dict[str, RepoEntry], totals: Optional[OrganizationProfile],
+        full: bool = False) -> Refresh:
+    """
+    Refreshes the profile of a github org from its stored repo index. Only the repos updated since the
+    last refresh are listed (and have their "null" language looked up). Deleted repos can't be seen that
+    way, so when the org's public_repos count doesn't add up every repo is listed again
+
+    :param organization: github organization to refresh
+    :param index: the stored entry of each repo of the org
+    :param totals: the stored profile of the org, None if there isn't one
+    :optional param full: list and look up every repo again, changed or not
+    :returns: the refreshed profile and the index changes
+    """
+    changed = {}
+    seen = set()
+
+    def fold(repo: parsers.GithubRepo):
+        seen.add(repo.id)
+        if full or not unchanged(index, repo):
+            changed[repo.id] = repo
+
+    headers = {**parsers.GITHUB_HEADERS, **parsers.github_auth_headers()}
+    incremental = bool(index) and totals is not None and not full
+    if incremental:
+        await list_changed(f"https://api.github.com/orgs/{organization}/repos?type=public&sort=updated&direction=desc&per_page={parsers.GITHUB_PER_PAGE}",
+            index, fold, parsers.slim_github, headers = headers)
+        details = await parsers.get_request_json(f"https://api.github.com/orgs/{organization}", headers = headers)
+        incremental = len(index) + sum(1 for key in changed if key not in index) == details.get("public_repos")
+    if not incremental:
+        changed.clear()
+        await parsers.list_github(organization, fold)
+
+    unresolved = [repo for repo in changed.values() if parsers.parse_language(repo.language) == "none"]
+    resolved = dict(zip([repo.id for repo in unresolved], await parsers.resolve_languages([repo.languages_url for repo in unresolved])))
+    entries = {key: RepoEntry(repo.updated, repo.fork, repo.watchers, resolved.get(key, parsers.parse_language(repo.language)),
+        list(repo.topics)) for key, repo in changed.items()}
+
+    removed = [] if incremental else [key for key in index if key not in seen]
+    logger.debug(f"Refreshed github org {organization}: {len(entries)} changed, {len(removed)} removed, incremental {incremental}")
+    return apply(totals, index, entries, removed, incremental)
+
+async def refresh_bitbucket(team: str, index: Dict[str, RepoEntry], totals: Optional[OrganizationProfile],
+        full: bool = False) -> Refresh:
+    """
+    Refreshes the profile of a bitbucket team from its stored repo index. Only the repos updated since the
+    last refresh are listed (and have their watchers looked up). When the size of the listing doesn't add
+    up, e.g. after a repo was deleted, every repo is listed again
+
+    Bitbucket doesn't bump updated_on when a repo gets a new watcher, so the watcher counts of
+    unchanged repos only catch up on a full refresh, see FULL_REFRESH_EVERY
+
+    :param team: bitbucket team to refresh
+    :param index: the stored entry of each repo of the team
+    :param totals: the stored profile of the team, None if there isn't one
+    :optional param full: list and look up every repo again, changed or not
+    :returns: the refreshed profile and the index changes
+    """
+    changed = {}
+    seen = set()
+
+    def fold(repo: parsers.BitbucketRepo):
+        seen.add(repo.id)
+        if full or not unchanged(index, repo):
+            changed[repo.id] = repo
+
+    incremental = bool(index) and totals is not None and not full
+    if incremental:
+        page = await list_changed(f"https://api.bitbucket.org/2.0/repositories/{team}?sort=-updated_on&pagelen={parsers.BITBUCKET_PAGELEN}",
+            index, fold, parsers.slim_bitbucket, key = "values")
+        incremental = len(index) + sum(1 for key in changed if key not in index) == page.get("size")
+    if not incremental:
+        changed.clear()
+        await parsers.list_bitbucket(team, fold)
+
+    watchers = await parsers.count_watchers([repo.watchers_url for repo in changed.values()])
+    entries = {key: RepoEntry(repo.updated, False, count, parsers.parse_language(repo.language), [])
+        for (key, repo), count in zip(changed.items(), watchers)}
+
+    removed = [] if incremental else [key for key in index if key not in seen]
+    logger.debug(f"Refreshed bitbucket team {team}: {len(entries)} changed, {len(removed)} removed, incremental {incremental}")
+    return apply(totals, index, entries, removed, incremental)
+
+REFRESHERS = {"bitbucket": refresh_bitbucket, "github": refresh_github}
+
+def refresher(provider: str, store, full_every: int = FULL_REFRESH_EVERY) -> Callable:
+    """
+    :param provider: provider to refresh the orgs of
+    :param store: snapshots.SnapshotStore with the stored profiles and repo indexes
+    :optional param full_every: incremental refreshes of an org in a row before it's listed in full again
+    :returns: a coroutine function that refreshes an org of the provider from what the store has
+    """
+    # incremental refreshes since the last full one, by org
+    streaks = {}
+
+    async def refresh(organization: str) -> Refresh:
+        index = {key: RepoEntry(*entry) for key, entry in store.index(provider, organization).items()}
+        snapshot = store.get(provider, organization)
+        result = await REFRESHERS[provider](organization, index, snapshot.profile if snapshot is not None else None,
+            full = streaks.get(organization, 0) >= full_every)
+        streaks[organization] = streaks.get(organization, 0) + 1 if result.incremental else 0
+        return result
+    return refresh
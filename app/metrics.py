@@ -0,0 +1,277 @@
+"""
+Counters, latency histograms and timing spans for the hot paths, rendered in the prometheus text
+format by the /metrics route. Set METRICS=0 to turn recording off, spans then cost a single
+context variable lookup unless the request asked for its timing breakdown (?debug-timing=1)
+"""
+import os
+import time
+import bisect
+import threading
+import contextvars
+from typing import Callable, Iterator, List, Optional, Tuple
+
+enabled = os.environ.get("METRICS", "1") != "0"
+
+# seconds, roughly the range between a cached page and a big org
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_lock = threading.Lock()
+_metrics = []
+_collectors = []
+
+def _labels(names: Tuple[str, ...], values: tuple) -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Counter:
+    """
+    A count that only goes up, one per combination of label values
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: List[str] = ()):
+        """
+        :param name: metric name, e.g. upstream_requests_total
+        :param documentation: what it counts, sent as the HELP line
+        :optional param labels: names of the labels its values are split by
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        """
+        :param labels: value of each label, in the order they were declared
+        :optional param amount: how much to add
+        """
+        if not enabled:
+            return
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def lines(self) -> Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+class Histogram:
+    """
+    Counts observations into buckets, along with their sum, one per combination of label values
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: List[str] = (), buckets: Tuple[float, ...] = BUCKETS):
+        """
+        :param name: metric name, e.g. upstream_request_seconds
+        :param documentation: what it measures, sent as the HELP line
+        :optional param labels: names of the labels its values are split by
+        :optional param buckets: upper bounds of the buckets, in increasing order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        """
+        :param value: the observation, e.g. seconds a request took
+        :param labels: value of each label, in the order they were declared
+        """
+        if not enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def lines(self) -> Iterator[str]:
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), labels + (le,))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+def collector(collect: Callable[[], List[tuple]]):
+    """
+    Registers a function that reports stats kept elsewhere (e.g. the cache hit counts) when the
+    metrics are rendered, so the hot path doesn't have to count them twice
+
+    :param collect: function returning (name, kind, documentation, [(labels dict, value)]) tuples
+    """
+    _collectors.append(collect)
+
+def render() -> str:
+    """
+    :returns: every metric in the prometheus text exposition format
+    """
+    lines = []
+    with _lock:
+        for metric in _metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.lines())
+    for collect in _collectors:
+        for name, kind, documentation, samples in collect():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+def reset():
+    """
+    Zeroes every metric
+    """
+    with _lock:
+        for metric in _metrics:
+            metric.values.clear()
+
+phase_seconds = Histogram("profile_phase_seconds", "Seconds spent in each phase of gathering a profile", ["phase"])
+
+class Trace:
+    """
+    The timing spans of a single request, see tracing
+    """
+    # spans listed one by one in the report, every span still counts towards its phase
+    MAX_SPANS = 200
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = []
+        # phase -> [count, total seconds, max seconds]
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float, started: Optional[float] = None):
+        """
+        :param name: phase the span belongs to
+        :param seconds: how long it took
+        :optional param started: time.perf_counter() it started at, defaults to `seconds` ago
+        """
+        started = started if started is not None else time.perf_counter() - seconds
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = [0, 0.0, 0.0]
+            phase[0] += 1
+            phase[1] += seconds
+            phase[2] = max(phase[2], seconds)
+            if len(self.spans) < self.MAX_SPANS:
+                self.spans.append((name, started - self.start, seconds))
+
+    def report(self) -> dict:
+        """
+        :returns: the total time, and the count, total and max time of each phase in ms, along with
+            the first MAX_SPANS spans. Spans run concurrently so their times add up to more than the total
+        """
+        with self._lock:
+            return {"total_ms": (time.perf_counter() - self.start) * 1000,
+                "phases": {name: {"count": count, "total_ms": total * 1000, "max_ms": longest * 1000}
+                    for name, (count, total, longest) in sorted(self.phases.items(), key = lambda item: -item[1][1])},
+                "spans": [{"phase": name, "start_ms": start * 1000, "duration_ms": seconds * 1000}
+                    for name, start, seconds in self.spans]}
+
+_trace = contextvars.ContextVar("trace", default = None)
+
+class tracing:
+    """
+    Collects the spans of everything run inside it (including tasks and client.run calls started from
+    it) into a Trace
+
+        with metrics.tracing(metrics.Trace()) as trace:
+            ...
+        trace.report()
+    """
+    def __init__(self, trace: Optional[Trace]):
+        """
+        :param trace: where the spans go, None to not trace
+        """
+        self.trace = trace
+        self._token = None
+
+    def __enter__(self) -> Optional[Trace]:
+        if self.trace is not None:
+            self._token = _trace.set(self.trace)
+        return self.trace
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            _trace.reset(self._token)
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+def active() -> bool:
+    """
+    :returns: whether anything would be recorded, to skip timing the hot path otherwise
+    """
+    return enabled or _trace.get() is not None
+
+def add(name: str, seconds: float, started: Optional[float] = None):
+    """
+    Records a span whose time was measured by the caller, e.g. summed up over a loop
+
+    :param name: phase the span belongs to
+    :param seconds: how long it took
+    :optional param started: time.perf_counter() it started at
+    """
+    phase_seconds.observe(seconds, name)
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, seconds, started)
+
+class _Span:
+    __slots__ = ("name", "trace", "started")
+
+    def __init__(self, name: str, trace: Optional[Trace]):
+        self.name = name
+        self.trace = trace
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.started
+        phase_seconds.observe(seconds, self.name)
+        if self.trace is not None:
+            self.trace.add(self.name, seconds, self.started)
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NO_SPAN = _NoSpan()
+
+def span(name: str):
+    """
+    Times the block it wraps into the profile_phase_seconds histogram and the request's trace
+
+        with metrics.span("github.listing"):
+            ...
+
+    :param name: phase the block belongs to
+    :returns: a context manager
+    """
+    trace = _trace.get()
+    if not enabled and trace is None:
+        return NO_SPAN
+    return _Span(name, trace)
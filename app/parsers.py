@@ -1,10 +1,15 @@
+import os
+import time
 import logging
 import asyncio
+import contextlib
+import math
 import operator
-from typing import List
-from collections import defaultdict
+import itertools
+from typing import Any, AsyncIterator, Callable, Iterable, Iterator, List, Optional, Tuple
+from collections import namedtuple
 
-from app import profile
+from app import cache, client, metrics, profile, snapshots, stream
 
 import httpx
 import flask
@@ -12,21 +17,195 @@ import flask
 app = flask.Flask("user_profiles_api")
 logger = flask.logging.create_logger(app)
 
-async def get_request_json(endpoint: str, headers: dict = {}) -> dict:
+# bitbucket allows up to 100 repos per page
+BITBUCKET_PAGELEN = 100
+# github allows up to 100 repos per page
+GITHUB_PER_PAGE = 100
+# header to enable topics since it's in the preview period
+GITHUB_HEADERS = {"Accept": "application/vnd.github.mercy-preview+json"}
+# set GITHUB_GRAPHQL to gather github orgs through the graphql api (needs GITHUB_TOKEN)
+GITHUB_GRAPHQL = bool(os.environ.get("GITHUB_GRAPHQL"))
+GITHUB_GRAPHQL_ENDPOINT = "https://api.github.com/graphql"
+GITHUB_GRAPHQL_QUERY = """
+query($organization: String!, $cursor: String) {
+  organization(login: $organization) {
+    repositories(first: 100, after: $cursor, privacy: PUBLIC) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        isFork
+        stargazerCount
+        primaryLanguage { name }
+        languages(first: 1, orderBy: {field: SIZE, direction: DESC}) { nodes { name } }
+        repositoryTopics(first: 100) { nodes { topic { name } } }
+      }
+    }
+  }
+}
+"""
+# max pages of a single listing in flight at once
+PAGE_CONCURRENCY = 10
+# max watcher lookups in flight for a single team
+WATCHER_CONCURRENCY = 20
+# max languages_url lookups in flight for a single org
+LANGUAGE_CONCURRENCY = 20
+# least seconds between two running totals of a streamed profile
+STREAM_INTERVAL = 0.1
+
+upstream_requests = metrics.Counter("upstream_requests_total", "Requests sent to the github and bitbucket apis, retries aside",
+    ["host", "status"])
+upstream_bytes = metrics.Counter("upstream_response_bytes_total", "Bytes received from the github and bitbucket apis", ["host"])
+upstream_seconds = metrics.Histogram("upstream_request_seconds",
+    "Seconds from sending an upstream request to having its whole body, waiting for rate limits and retries included", ["host"])
+
+def observe_upstream(response: httpx.Response, started: float):
     """
-    Sends a get request to a given endpoint and returns the response as json
+    Records an upstream request in the metrics and the request's trace
+
+    :param response: its final response, with the body read
+    :param started: time.perf_counter() it was sent at
+    """
+    if not metrics.active():
+        return
+    seconds = time.perf_counter() - started
+    host = response.request.url.host
+    upstream_requests.inc(host, response.status_code)
+    upstream_bytes.inc(host, amount = response.num_bytes_downloaded)
+    upstream_seconds.observe(seconds, host)
+    trace = metrics.current_trace()
+    if trace is not None:
+        trace.add("upstream " + host, seconds, started)
+
+def github_auth_headers() -> dict:
+    """
+    :returns: the authorization header for github if a GITHUB_TOKEN is set
+    """
+    token = os.environ.get("GITHUB_TOKEN")
+    return {"Authorization": f"bearer {token}"} if token else {}
+
+async def get_request(endpoint: str, headers: dict = {}) -> httpx.Response:
+    """
+    Sends a get request to a given endpoint and returns the whole response, for when we
+    need more than the body (e.g. the pagination links)
     
     :param endpoint: endpoint to make a get request to
     :param headers: headers to pass to the endpoint for the request
-    :returns: json output from the request
+    :returns: the response of the request
     :raises ConnectionError: raises an exception if a valid request could not be sent
     """
+    key = cache.responses.key(endpoint, headers)
+    entry = cache.responses.lookup(key)
+    if entry is not None and entry.fresh():
+        return httpx.Response(200, headers = entry.headers, content = entry.content)
+
     app.logger.debug(f"Sending get request to '{endpoint}' with the following headers: {headers}")
-    async with httpx.AsyncClient() as client:
-        response = await client.get(endpoint, headers = headers)
+    conditional = cache.responses.conditional_headers(entry) if entry is not None else {}
+    started = time.perf_counter()
+    response = await client.host_scheduler(endpoint).send(lambda: client.get_client().get(endpoint, headers = {**headers, **conditional}))
+    observe_upstream(response, started)
+    if response.status_code == 304 and entry is not None:
+        cache.responses.refresh(key, entry)
+        return httpx.Response(200, headers = entry.headers, content = entry.content)
+    if response.status_code != 200:
+        raise ConnectionError("Failed to recieve data from " + endpoint)
+    cache.responses.store(key, response.content, response.headers.multi_items())
+    return response
+
+async def get_request_items(endpoint: str, fold: Callable[[Any], None], slim: Callable[[dict], Any],
+        headers: dict = {}, key: str = None) -> Tuple[httpx.Response, dict]:
+    """
+    Sends a get request for a json listing and parses the body as it arrives, handing each item
+    to `fold` (after `slim` has cut it down to the fields we use) instead of holding the whole listing
+    
+    :param endpoint: endpoint to make a get request to
+    :param fold: function that adds a slimmed item to the running totals
+    :param slim: function that turns an item into the record passed to fold
+    :param headers: headers to pass to the endpoint for the request
+    :param key: top level key that holds the listing, None if the body is the listing
+    :returns: the response (with the body already consumed) and the other top level values of the body
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    parser = stream.ItemParser(key)
+
+    def replay(entry: cache.CachedResponse) -> Tuple[httpx.Response, dict]:
+        with metrics.span("parse"):
+            for item in itertools.chain(parser.feed(entry.content), parser.close()):
+                fold(slim(item))
+        return httpx.Response(200, headers = entry.headers), parser.fields
+
+    # listing pages are only buffered, and cached, if the response cache is asked to keep them
+    cached = cache.responses.enabled and cache.responses.listings
+    cache_key = cache.responses.key(endpoint, headers)
+    entry = cache.responses.lookup(cache_key) if cached else None
+    if entry is not None and entry.fresh():
+        return replay(entry)
+
+    app.logger.debug(f"Sending streamed get request to '{endpoint}' with the following headers: {headers}")
+    conditional = cache.responses.conditional_headers(entry) if entry is not None else {}
+    http = client.get_client()
+    started = time.perf_counter()
+    # the host's slot stays taken until the whole body is in, not just its headers
+    async with client.host_scheduler(endpoint).stream(lambda: http.send(
+            http.build_request("GET", endpoint, headers = {**headers, **conditional}), stream = True)) as response:
+        if response.status_code == 304 and entry is not None:
+            observe_upstream(response, started)
+            cache.responses.refresh(cache_key, entry)
+            return replay(entry)
         if response.status_code != 200:
             raise ConnectionError("Failed to recieve data from " + endpoint)
-        return response.json()
+
+        chunks = [] if cached else None
+        # time spent parsing and folding, apart from waiting on the body
+        timed = metrics.active()
+        parsing = 0.0
+        try:
+            async for chunk in response.aiter_bytes():
+                if chunks is not None:
+                    chunks.append(chunk)
+                if timed:
+                    parsed = time.perf_counter()
+                for item in parser.feed(chunk):
+                    fold(slim(item))
+                if timed:
+                    parsing += time.perf_counter() - parsed
+            for item in parser.close():
+                fold(slim(item))
+        except ValueError as e:
+            raise ConnectionError(f"Failed to parse data from {endpoint}: {e}")
+        if timed:
+            metrics.add("parse", parsing)
+        if chunks is not None:
+            cache.responses.store(cache_key, b"".join(chunks), response.headers.multi_items())
+        observe_upstream(response, started)
+        return response, parser.fields
+
+async def get_request_json(endpoint: str, headers: dict = {}) -> dict:
+    """
+    Sends a get request to a given endpoint and returns the response as json
+    
+    :param endpoint: endpoint to make a get request to
+    :param headers: headers to pass to the endpoint for the request
+    :returns: json output from the request
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    return (await get_request(endpoint, headers = headers)).json()
+
+async def post_request_json(endpoint: str, body: dict, headers: dict = {}) -> dict:
+    """
+    Sends a post request with a json body to a given endpoint and returns the response as json
+    
+    :param endpoint: endpoint to make a post request to
+    :param body: json body to send
+    :param headers: headers to pass to the endpoint for the request
+    :returns: json output from the request
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    app.logger.debug(f"Sending post request to '{endpoint}'")
+    started = time.perf_counter()
+    response = await client.host_scheduler(endpoint).send(lambda: client.get_client().post(endpoint, json = body, headers = headers))
+    observe_upstream(response, started)
+    if response.status_code != 200:
+        raise ConnectionError("Failed to recieve data from " + endpoint)
+    return response.json()
 
 async def get_multiple_json(endpoints: List[str], headers: dict = {}) -> List[dict]:
     """
@@ -43,6 +222,42 @@ async def get_multiple_json(endpoints: List[str], headers: dict = {}) -> List[di
     results = await asyncio.gather(*responses)
     return results
 
+async def fold_pages(endpoints: List[str], fold: Callable[[Any], None], slim: Callable[[dict], Any],
+        headers: dict = {}, key: str = None):
+    """
+    Requests pages of a listing at the same time (at most PAGE_CONCURRENCY at once) and streams
+    each page's items into `fold` as they arrive, see get_request_items
+
+    :param endpoints: endpoints of the pages to request
+    :param fold: function that adds a slimmed item to the running totals
+    :param slim: function that turns an item into the record passed to fold
+    :param headers: headers to pass to the endpoint for the request
+    :param key: top level key that holds the listing, None if the body is the listing
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    slots = asyncio.Semaphore(PAGE_CONCURRENCY)
+
+    async def fetch(endpoint: str):
+        async with slots:
+            await get_request_items(endpoint, fold, slim, headers = headers, key = key)
+
+    tasks = [asyncio.ensure_future(fetch(endpoint)) for endpoint in endpoints]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        cancel(tasks)
+
+def cancel(tasks: List[asyncio.Future]):
+    """
+    Cancels any of the given tasks that haven't finished yet, so a failed crawl doesn't leave
+    requests running in the background
+
+    :param tasks: tasks to cancel
+    """
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+
 def parse_language(entry: str) -> str:
     """
     Converts a string to our unified language format for storage:
@@ -56,48 +271,254 @@ def parse_language(entry: str) -> str:
         return "none"
     return entry.lower()
 
-def parse_bitbucket(team: str) -> profile.OrganizationProfile:
+# the only fields of a listed repo that we use
+GithubRepo = namedtuple("GithubRepo", ["id", "updated", "fork", "watchers", "language", "topics", "languages_url"])
+BitbucketRepo = namedtuple("BitbucketRepo", ["id", "updated", "language", "watchers_url"])
+
+def slim_github(repo: dict) -> GithubRepo:
+    return GithubRepo(str(repo.get("id")), repo.get("updated_at"), repo["fork"], repo["watchers_count"], repo["language"],
+        repo["topics"], repo["languages_url"])
+
+def slim_bitbucket(repo: dict) -> BitbucketRepo:
+    return BitbucketRepo(repo.get("uuid") or repo.get("full_name"), repo.get("updated_on"), repo["language"],
+        repo["links"]["watchers"]["href"])
+
+async def list_bitbucket(team: str, fold: Callable[[BitbucketRepo], None]):
+    """
+    Streams every repo of a bitbucket team into `fold`. The first page tells us how many pages
+    there are, the rest are then requested at the same time
+
+    :param team: bitbucket team to list the repos of
+    :param fold: function that adds a repo to the running totals
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    await fold_pages(await first_bitbucket_page(team, fold), fold, slim_bitbucket, key = "values")
+
+async def first_bitbucket_page(team: str, fold: Callable[[BitbucketRepo], None]) -> List[str]:
+    """
+    Streams the repos on the first page of a bitbucket team's listing into `fold`
+
+    :param team: bitbucket team to list the repos of
+    :param fold: function that adds a repo to the running totals
+    :returns: the endpoints of the remaining pages, empty if bitbucket didn't report the size of the
+        listing, the next links are then followed here one at a time
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    endpoint = f"https://api.bitbucket.org/2.0/repositories/{team}"
+    response, page = await get_request_items(f"{endpoint}?pagelen={BITBUCKET_PAGELEN}", fold, slim_bitbucket, key = "values")
+    if "next" in page and page.get("size") and page.get("pagelen"):
+        # we know the page count up front so every remaining page can be requested at once
+        pages = math.ceil(page["size"] / page["pagelen"])
+        return [f"{endpoint}?pagelen={page['pagelen']}&page={number}" for number in range(2, pages + 1)]
+    # no size reported, so follow the next links one at a time
+    while "next" in page:
+        response, page = await get_request_items(page["next"], fold, slim_bitbucket, key = "values")
+    return []
+
+async def list_github(organization: str, fold: Callable[[GithubRepo], None]):
+    """
+    Streams every repo of a github organization into `fold`. The first page links to the last one,
+    which tells us every page we still need, those are then requested at the same time
+
+    :param organization: github organization to list the repos of
+    :param fold: function that adds a repo to the running totals
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    await fold_pages(await first_github_page(organization, fold), fold, slim_github, headers = github_listing_headers())
+
+async def first_github_page(organization: str, fold: Callable[[GithubRepo], None]) -> List[str]:
+    """
+    Streams the repos on the first page of a github organization's listing into `fold`
+
+    :param organization: github organization to list the repos of
+    :param fold: function that adds a repo to the running totals
+    :returns: the endpoints of the remaining pages
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    # a token of an org member would list its private and internal repos as well
+    endpoint = f"https://api.github.com/orgs/{organization}/repos?type=public&per_page={GITHUB_PER_PAGE}"
+    response, _ = await get_request_items(endpoint, fold, slim_github, headers = github_listing_headers())
+    if "last" not in response.links:
+        return []
+    pages = int(httpx.URL(response.links["last"]["url"]).params["page"])
+    return [f"{endpoint}&page={page}" for page in range(2, pages + 1)]
+
+def github_listing_headers() -> dict:
+    return {**GITHUB_HEADERS, **github_auth_headers()}
+
+def fold_bitbucket(totals: profile.OrganizationProfile, repo: BitbucketRepo):
+    """
+    Adds a listed bitbucket repo to the totals, its watchers are looked up separately
+
+    :param totals: profile to add the repo to
+    :param repo: the listed repo
+    """
+    totals.repos += 1
+    totals.languages[parse_language(repo.language)] += 1
+
+def fold_github(totals: profile.OrganizationProfile, repo: GithubRepo, unresolved: Optional[List[str]]):
+    """
+    Adds a listed github repo to the totals
+
+    :param totals: profile to add the repo to
+    :param repo: the listed repo
+    :param unresolved: where the languages_url of a repo github lists without a language goes, to be
+        looked up later, None to count those as "none" instead
+    """
+    # update count of forks vs repos
+    if repo.fork:
+        totals.forks += 1
+    else:
+        totals.repos += 1
+
+    totals.watchers += repo.watchers
+
+    # github reports language as being "null" for forks of closed repos, those are looked up
+    # once every page is in
+    language = parse_language(repo.language)
+    if language == "none" and unresolved is not None:
+        unresolved.append(repo.languages_url)
+    else:
+        totals.languages[language] += 1
+
+    for topic in repo.topics:
+        totals.topics[topic] += 1
+
+def size_only(endpoint: str) -> str:
+    """
+    :param endpoint: bitbucket endpoint of a paginated collection, e.g. a repo's watchers
+    :returns: the endpoint asking for just the size of the collection instead of its first page
+    """
+    return endpoint + ("&" if "?" in endpoint else "?") + "fields=size"
+
+async def count_watchers(watchers_urls: List[str]) -> List[int]:
+    """
+    Looks up the watcher count of bitbucket repos together, at most WATCHER_CONCURRENCY at once
+
+    :param watchers_urls: watchers endpoints of the repos
+    :returns: the watcher count of each repo, in the same order
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    slots = asyncio.Semaphore(WATCHER_CONCURRENCY)
+
+    async def count(watchers_url: str) -> int:
+        async with slots:
+            return (await get_request_json(size_only(watchers_url)))["size"]
+
+    tasks = [asyncio.ensure_future(count(watchers_url)) for watchers_url in watchers_urls]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        cancel(tasks)
+
+class Progress:
+    """
+    Running totals of a crawl that is under way, so a request that can't wait for the whole
+    crawl can still show what has been gathered so far, see fetch_partial_profile
+    """
+    def __init__(self):
+        self.profile = profile.OrganizationProfile()
+        # bumped every time something is folded in
+        self.version = 0
+        self.loop = asyncio.get_running_loop()
+        self._waiters = []
+
+    def snapshot(self) -> profile.OrganizationProfile:
+        """
+        :returns: a copy of the totals so far
+        """
+        return self.profile + profile.OrganizationProfile()
+
+    def changed(self) -> asyncio.Future:
+        """
+        :returns: a future that is done once more has been folded into the totals
+        """
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return waiter
+
+    def notify(self):
+        self.version += 1
+        if self._waiters:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            self._waiters.clear()
+
+# (profile key, team/org) -> Progress of each crawl running right now, see bitbucket_key/github_key
+crawls = {}
+
+def bitbucket_key(fields: Iterable[str] = None) -> str:
+    """
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: what a bitbucket profile gathered for the fields is cached, and its crawl published, under
+    """
+    return "bitbucket" if fields is None or "watchers" in fields else "bitbucket without watchers"
+
+def github_key(fields: Iterable[str] = None) -> str:
+    """
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: what a github profile gathered for the fields is cached, and its crawl published, under
+    """
+    return "github" if fields is None or "languages" in fields else "github without languages"
+
+@contextlib.contextmanager
+def crawling(profile_key: str, organization: str) -> Iterator[Progress]:
+    """
+    Publishes the running totals of a crawl in `crawls` until it's over
+
+    :param profile_key: provider the org belongs to, along with what's left out of the crawl,
+        the same key the profile cache files the result under
+    :param organization: name of the team/org being crawled
+    :returns: the Progress to fold the crawl into
+    """
+    key = (profile_key, organization)
+    progress = crawls[key] = Progress()
+    try:
+        yield progress
+    finally:
+        if crawls.get(key) is progress:
+            del crawls[key]
+        progress.notify()
+
+def progress_of(profile_key: str, organization: str) -> Optional[Progress]:
+    """
+    :param profile_key: key of the crawl, see crawling
+    :param organization: name of the team/org
+    :returns: the Progress of its crawl if one is running on this event loop, None otherwise
+    """
+    progress = crawls.get((profile_key, organization))
+    if progress is not None and progress.loop is asyncio.get_running_loop():
+        return progress
+    return None
+
+async def fetch_bitbucket(team: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
     """
     Requests info from the bitbucket api for a given team to get profile stats:
         - number of public repos
         - count of total followers on all repos
         - count of languages used across all repos
     Bitbucket doesn't have topics, nor does it define if a repo is a fork
+
+    Watchers are looked up as soon as the page listing the repo arrives, each repo exactly once,
+    and only if they're among the `fields` asked for. With CRAWL_PROCESSES set the pages of a
+    big team are split across the worker processes
     
     :param team: bitbucket team to gather the stats of
+    :optional param fields: names of the profile fields needed, defaults to all of them
     :returns: an OrganizationProfile object that holds all of the gathered statistics
     """
-    app.logger.debug(f"parse_bitbucket entered with team name of {team}")
+    app.logger.debug(f"fetch_bitbucket entered with team name of {team}")
     
     if team is None:
         return profile.OrganizationProfile()
 
-    json = asyncio.run(get_request_json(f"https://api.bitbucket.org/2.0/repositories/{team}"))
-
-    # Get number of public repos (I don't think bitbucket displays if a repo is forked)
-    repos = json["size"]
-
-    # Get statistics of repos
-    watchers = 0
-    languages = defaultdict(int)
-    watcher_endpoints = []
-    while(True):
-        for repo in json["values"]:
-            watcher_endpoints.append(repo["links"]["watchers"]["href"])
-            languages[parse_language(repo["language"])] += 1
-        
-        # get number of watchers asynchronously
-        results = asyncio.run(get_multiple_json(watcher_endpoints))
-        for result in results:
-            watchers += result["size"]
-
-        # check if there's another page to request
-        if "next" not in json:
-            break;
-        json = asyncio.run(get_request_json(json["next"]))
-    return profile.OrganizationProfile(repos = repos, watchers = watchers, languages = languages)
-
-def parse_github(organization:str) -> profile.OrganizationProfile:
+    with crawling(bitbucket_key(fields), team) as progress:
+        totals, _ = await fetch_bitbucket_pages(team, fields = fields, shard = page_sharder("bitbucket", team, fields),
+            progress = progress)
+        return totals
+
+async def fetch_github(organization: str, graphql: bool = None, fields: Iterable[str] = None) -> profile.OrganizationProfile:
     """
     Requests info from the github api for a given team to get profile stats:
         - number of public repos
@@ -106,43 +527,493 @@ def parse_github(organization:str) -> profile.OrganizationProfile:
         - count of languages used across all repos
         - count of topics used across all repos
 
+    The "null" languages are only looked up if languages are among the `fields` asked for. With
+    CRAWL_PROCESSES set the pages of a big org are split across the worker processes
+
+    :param organization: github organization to gather the stats of
+    :optional param graphql: use fetch_github_graphql instead of the rest api, defaults to GITHUB_GRAPHQL
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    """
+    app.logger.debug(f"fetch_github entered with organization name of {organization}")
+
+    if organization is None:
+        return profile.OrganizationProfile()
+
+    if graphql is None:
+        graphql = GITHUB_GRAPHQL
+    if graphql:
+        return await fetch_github_graphql(organization, fields)
+
+    with crawling(github_key(fields), organization) as progress:
+        totals, _ = await fetch_github_pages(organization, fields = fields,
+            shard = page_sharder("github", organization, fields), progress = progress)
+        return totals
+
+def page_sharder(provider: str, organization: str, fields: Iterable[str] = None) -> Optional[Callable]:
+    """
+    :param provider: provider the org belongs to
+    :param organization: name of the team/org
+    :optional param fields: names of the profile fields needed
+    :returns: the `shard` of fetch_bitbucket_pages/fetch_github_pages that splits the remaining pages
+        across the worker processes, None if CRAWL_PROCESSES isn't set
+    """
+    # imported here since the workers gather their pages with this module
+    from app import executor
+
+    if not executor.PROCESSES:
+        return None
+    return lambda endpoints: executor.shard_pages(provider, organization, endpoints, fields)
+
+async def fold_remaining(remaining: List[str], fold: Callable[[Any], None], slim: Callable[[dict], Any], totals: profile.OrganizationProfile,
+        progress: Progress, shard: Optional[Callable], headers: dict = {}, key: str = None):
+    """
+    Gathers the pages left of a listing after its first one, here or through `shard` if there are
+    more of them than are requested at once anyway
+
+    :param remaining: endpoints of the pages left
+    :param fold: function that adds a slimmed item to the running totals
+    :param slim: function that turns an item into the record passed to fold
+    :param totals: running totals the profiles handed out by `shard` are added to
+    :param progress: Progress notified of each of them
+    :param shard: function that gathers pages elsewhere and hands out their profiles as an async iterator, or None
+    :param headers: headers to pass to the endpoint for the request
+    :param key: top level key that holds the listing, None if the body is the listing
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    if shard is None or len(remaining) <= PAGE_CONCURRENCY:
+        await fold_pages(remaining, fold, slim, headers = headers, key = key)
+        return
+    async for part in shard(remaining):
+        totals += part
+        progress.notify()
+
+async def fetch_bitbucket_pages(team: str, endpoints: List[str] = None, fields: Iterable[str] = None, split: bool = False,
+        shard: Callable = None, progress: Progress = None) -> Tuple[profile.OrganizationProfile, List[str]]:
+    """
+    Gathers the stats of a bitbucket team's listing, or of some of its pages, along with the watchers
+    of the repos on them. Watchers are looked up as soon as the page listing the repo arrives
+
+    :param team: bitbucket team to gather the stats of
+    :optional param endpoints: listing pages to gather, None to start from the first one
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :optional param split: stop after the first page and return the endpoints of the rest
+    :optional param shard: function that gathers the rest elsewhere, see fold_remaining
+    :optional param progress: Progress to fold the stats into as they come in
+    :returns: the stats of the repos on those pages, and the endpoints of the pages left if split
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    progress = progress if progress is not None else Progress()
+    totals = progress.profile
+    with_watchers = fields is None or "watchers" in fields
+    watcher_endpoints = set()
+    watcher_tasks = []
+    watcher_slots = asyncio.Semaphore(WATCHER_CONCURRENCY)
+
+    async def add_watchers(endpoint: str):
+        async with watcher_slots:
+            watchers = (await get_request_json(size_only(endpoint)))["size"]
+        totals.watchers += watchers
+        progress.notify()
+
+    def fold(repo: BitbucketRepo):
+        fold_bitbucket(totals, repo)
+        if with_watchers and repo.watchers_url not in watcher_endpoints:
+            watcher_endpoints.add(repo.watchers_url)
+            watcher_tasks.append(asyncio.ensure_future(add_watchers(repo.watchers_url)))
+        progress.notify()
+
+    remaining = []
+    try:
+        with metrics.span("bitbucket.listing"):
+            if endpoints is not None:
+                await fold_pages(endpoints, fold, slim_bitbucket, key = "values")
+            elif split:
+                remaining = await first_bitbucket_page(team, fold)
+            else:
+                await fold_remaining(await first_bitbucket_page(team, fold), fold, slim_bitbucket, totals, progress, shard,
+                    key = "values")
+        # the watcher lookups started with the listing, this is whatever is left of them
+        with metrics.span("bitbucket.watchers"):
+            await asyncio.gather(*watcher_tasks)
+    finally:
+        cancel(watcher_tasks)
+    return totals, remaining
+
+async def fetch_github_pages(organization: str, endpoints: List[str] = None, fields: Iterable[str] = None, split: bool = False,
+        shard: Callable = None, progress: Progress = None) -> Tuple[profile.OrganizationProfile, List[str]]:
+    """
+    Gathers the stats of a github organization's listing, or of some of its pages, along with the
+    "null" languages on them, which are looked up together once the pages are in
+
+    :param organization: github organization to gather the stats of
+    :optional param endpoints: listing pages to gather, None to start from the first one
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :optional param split: stop after the first page and return the endpoints of the rest
+    :optional param shard: function that gathers the rest elsewhere, see fold_remaining
+    :optional param progress: Progress to fold the stats into as they come in
+    :returns: the stats of the repos on those pages, and the endpoints of the pages left if split
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    progress = progress if progress is not None else Progress()
+    totals = progress.profile
+    unresolved = [] if fields is None or "languages" in fields else None
+
+    def fold(repo: GithubRepo):
+        fold_github(totals, repo, unresolved)
+        progress.notify()
+
+    remaining = []
+    headers = github_listing_headers()
+    with metrics.span("github.listing"):
+        if endpoints is not None:
+            await fold_pages(endpoints, fold, slim_github, headers = headers)
+        elif split:
+            remaining = await first_github_page(organization, fold)
+        else:
+            await fold_remaining(await first_github_page(organization, fold), fold, slim_github, totals, progress, shard,
+                headers = headers)
+
+    if unresolved:
+        with metrics.span("github.languages"):
+            for language in await resolve_languages(unresolved):
+                totals.languages[language] += 1
+    return totals, remaining
+
+async def resolve_languages(languages_urls: List[str]) -> List[str]:
+    """
+    Finds the main language of repos that github reports as "null" (forks of closed repos) by
+    accessing their languages_url endpoints & sorting for highest. The lookups run together,
+    at most LANGUAGE_CONCURRENCY at once
+
+    :param languages_urls: languages_url endpoints of the repos to look up
+    :returns: the parsed language of each repo, in the same order
+    :raises ConnectionError: raises an exception if a valid request could not be sent
+    """
+    slots = asyncio.Semaphore(LANGUAGE_CONCURRENCY)
+
+    async def resolve(languages_url: str) -> str:
+        async with slots:
+            repo_languages = await get_request_json(languages_url, headers = github_auth_headers())
+        if len(repo_languages) > 0:
+            return parse_language(max(repo_languages.items(), key=operator.itemgetter(1))[0])
+        return "none"
+
+    tasks = [asyncio.ensure_future(resolve(languages_url)) for languages_url in languages_urls]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        cancel(tasks)
+
+async def fetch_github_graphql(organization: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
+    """
+    Same stats as fetch_github, but asks the github graphql api for 100 repos per query with the
+    fork flag, stars, topics and languages of each repo included, so "null" languages don't need
+    any extra requests. Github only serves graphql to authenticated requests, see GITHUB_TOKEN
+
     :param organization: github organization to gather the stats of
+    :optional param fields: names of the profile fields needed, every field is gathered anyway,
+        they only decide which key the crawl is published under
     :returns: an OrganizationProfile object that holds all of the gathered statistics
+    :raises ConnectionError: raises an exception if a valid request could not be sent
     """
-    app.logger.debug(f"parse_github entered with organization name of {organization}")
+    app.logger.debug(f"fetch_github_graphql entered with organization name of {organization}")
 
     if organization is None:
         return profile.OrganizationProfile()
 
-    # send a request w/ header to enable topics since it's in the preview period
-    json = asyncio.run(get_request_json(f"https://api.github.com/orgs/{organization}/repos", headers = {"Accept": "application/vnd.github.mercy-preview+json"}))
-
-    # initialize bookkeeping variables
-    repos = len(json)
-    forks = 0
-    watchers = 0
-    languages = defaultdict(int)
-    topics = defaultdict(int)
-
-    for repo in json:
-        # update count of forks vs repos
-        if repo["fork"]:
-            repos -= 1
-            forks += 1
-        
-        watchers += repo["watchers_count"]
-
-        # github reports language as being "null" for forks of closed repos. we can manually
-        # find the language by accessing the languages_url endpoint & sorting for highest
-        language = parse_language(repo["language"])
-        if language == "none":
-            repo_languages = asyncio.run(get_request_json(repo["languages_url"]))
-            if len(repo_languages) > 0:
-                language = parse_language(max(repo_languages.items(), key=operator.itemgetter(1))[0])
-            
-        languages[language] += 1
-
-        for topic in repo["topics"]:
-            topics[topic] += 1
-
-    return profile.OrganizationProfile(repos, forks, watchers, languages, topics)
+    with crawling(github_key(fields), organization) as progress:
+        totals = progress.profile
+        cursor = None
+        while True:
+            json = await post_request_json(GITHUB_GRAPHQL_ENDPOINT, {"query": GITHUB_GRAPHQL_QUERY,
+                "variables": {"organization": organization, "cursor": cursor}}, headers = github_auth_headers())
+            if json.get("errors") or not (json.get("data") or {}).get("organization"):
+                raise ConnectionError("Failed to recieve data from " + GITHUB_GRAPHQL_ENDPOINT)
+
+            listing = json["data"]["organization"]["repositories"]
+            for repo in listing["nodes"]:
+                if repo["isFork"]:
+                    totals.forks += 1
+                else:
+                    totals.repos += 1
+
+                # the rest api's watchers_count is really the stargazer count
+                totals.watchers += repo["stargazerCount"]
+
+                language = repo["primaryLanguage"]["name"] if repo["primaryLanguage"] else None
+                if language is None and repo["languages"]["nodes"]:
+                    language = repo["languages"]["nodes"][0]["name"]
+                totals.languages[parse_language(language)] += 1
+
+                for topic in repo["repositoryTopics"]["nodes"]:
+                    totals.topics[topic["topic"]["name"]] += 1
+            progress.notify()
+
+            if not listing["pageInfo"]["hasNextPage"]:
+                break
+            cursor = listing["pageInfo"]["endCursor"]
+
+        return totals
+
+async def fetch_profile(team: str, organization: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
+    """
+    Gathers the bitbucket team and the github organization at the same time and merges them
+    into a single profile, so the request takes about as long as the slower of the two
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :optional param fields: names of the profile fields needed, work only the others need is skipped
+    :returns: an OrganizationProfile object that holds the combined statistics
+    :raises ConnectionError: raises an exception if either provider could not be reached
+    """
+    with metrics.span("profile"):
+        bitbucket, github = await asyncio.gather(cached_bitbucket(team, fields), cached_github(organization, fields))
+        return bitbucket + github
+
+# a profile gathered within a deadline, `complete` and `errors` are keyed by provider
+Partial = namedtuple("Partial", ["profile", "complete", "errors"])
+
+def start_profile(team: str, organization: str, fields: Iterable[str] = None) -> dict:
+    """
+    Starts gathering the bitbucket team and the github organization through their caches
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :optional param fields: names of the profile fields needed, work only the others need is skipped
+    :returns: a dict mapping each provider to its (team/org name, task, key of its crawl)
+    """
+    return {"bitbucket": (team, asyncio.ensure_future(cached_bitbucket(team, fields)), bitbucket_key(fields)),
+        "github": (organization, asyncio.ensure_future(cached_github(organization, fields)), github_key(fields))}
+
+def partial_profile(tasks: dict) -> Partial:
+    """
+    Merges whatever the tasks of start_profile have gathered so far, a provider that is still
+    being crawled adds the running totals of its crawl
+
+    :param tasks: the tasks returned by start_profile
+    :returns: a Partial with the merged profile, whether each provider is done, and why any failed
+    """
+    gathered = []
+    complete = {}
+    errors = {}
+    for provider, (name, task, key) in tasks.items():
+        complete[provider] = False
+        if not task.done():
+            progress = progress_of(key, name)
+            if progress is not None:
+                gathered.append(progress.snapshot())
+        elif task.cancelled():
+            errors[provider] = "Cancelled"
+        elif task.exception() is not None:
+            errors[provider] = str(task.exception())
+        else:
+            gathered.append(task.result())
+            complete[provider] = True
+    return Partial(profile.OrganizationProfile.merge_many(gathered), complete, errors)
+
+async def fetch_partial_profile(team: str, organization: str, deadline: float, fields: Iterable[str] = None) -> Partial:
+    """
+    fetch_profile that gives up waiting after `deadline` seconds and returns what it has by then.
+    The crawls that are cut short keep going into the profile cache, so asking again soon after
+    gets the rest. A provider that fails is reported in the errors instead of failing the request
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :param deadline: seconds to wait for the crawls
+    :optional param fields: names of the profile fields needed, work only the others need is skipped
+    :returns: a Partial, see partial_profile
+    """
+    tasks = start_profile(team, organization, fields)
+    try:
+        with metrics.span("profile"):
+            await asyncio.wait([task for _, task, _ in tasks.values()], timeout = deadline)
+        return partial_profile(tasks)
+    finally:
+        # only stops the waiting, the crawls are shielded by the profile cache
+        cancel([task for _, task, _ in tasks.values()])
+
+async def stream_profile(team: str, organization: str, deadline: float = None, fields: Iterable[str] = None,
+        interval: float = STREAM_INTERVAL) -> AsyncIterator[Tuple[Partial, bool]]:
+    """
+    Gathers the bitbucket team and the github organization like fetch_profile, handing out the
+    running totals every time more pages have been folded in
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :optional param deadline: seconds after which the last totals are handed out, even if incomplete
+    :optional param fields: names of the profile fields needed, work only the others need is skipped
+    :optional param interval: least seconds between two totals, pages that arrive in between are combined
+    :returns: an async iterator of (Partial, done) tuples, done is True for the last one
+    """
+    loop = asyncio.get_running_loop()
+    expires = loop.time() + deadline if deadline is not None else math.inf
+    tasks = start_profile(team, organization, fields)
+    running = [task for _, task, _ in tasks.values()]
+    try:
+        while True:
+            pending = [task for task in running if not task.done()]
+            versions = {}
+            for provider, (name, _, key) in tasks.items():
+                progress = progress_of(key, name)
+                if progress is not None:
+                    versions[provider] = progress.version
+            done = not pending or loop.time() >= expires
+            yield partial_profile(tasks), done
+            if done:
+                return
+
+            await asyncio.sleep(min(interval, max(expires - loop.time(), 0)))
+            # wait for the next page unless one came in (or a crawl finished) while sleeping
+            waiters = []
+            changed = any(task.done() for task in pending)
+            for provider, (name, task, key) in tasks.items():
+                progress = progress_of(key, name)
+                if changed or task.done() or progress is None:
+                    continue
+                changed = progress.version != versions.get(provider)
+                waiters.append(progress.changed())
+            if not changed:
+                # a crawl that isn't running on this loop yet (e.g. waiting for a crawl slot) is polled
+                timeout = max(expires - loop.time(), 0)
+                if len(waiters) < len(pending):
+                    timeout = min(timeout, interval)
+                await asyncio.wait(waiters + pending, timeout = timeout, return_when = asyncio.FIRST_COMPLETED)
+            cancel(waiters)
+    finally:
+        cancel(running)
+
+async def fetch_profiles(teams: List[str], organizations: List[str]) -> dict:
+    """
+    Gathers many bitbucket teams and github organizations at the same time, at most
+    max_concurrent_crawls of them at once across every batch. A team or org that fails
+    doesn't fail the others
+
+    :param teams: bitbucket teams to gather the stats of
+    :param organizations: github organizations to gather the stats of
+    :returns: a dict with the "bitbucket" and "github" results, each mapping the team/org name to
+        its OrganizationProfile, or to the exception that stopped it from being gathered
+    """
+    async def crawl(fetch: Callable, name: str):
+        try:
+            async with client.crawl_slot():
+                return await fetch(name)
+        except (ConnectionError, httpx.HTTPError) as e:
+            app.logger.warning(f"Failed to gather {name}: {e}")
+            return e
+
+    teams = list(dict.fromkeys(teams))
+    organizations = list(dict.fromkeys(organizations))
+    results = await asyncio.gather(*[crawl(cached_bitbucket, team) for team in teams],
+        *[crawl(cached_github, organization) for organization in organizations])
+    return {"bitbucket": dict(zip(teams, results[:len(teams)])), "github": dict(zip(organizations, results[len(teams):]))}
+
+async def cached_bitbucket(team: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
+    """
+    fetch_bitbucket through the snapshot of a watched team, or else the profile cache where
+    concurrent lookups of the same team share one crawl. Profiles gathered without watchers are
+    cached apart from the full ones
+
+    :param team: bitbucket team to gather the stats of
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    """
+    if team is None:
+        return profile.OrganizationProfile()
+    snapshot = snapshots.lookup("bitbucket", team)
+    if snapshot is not None:
+        return snapshot
+    if bitbucket_key(fields) == "bitbucket":
+        return await cache.profiles.get("bitbucket", team, lambda: fetch_bitbucket(team))
+    # a full profile has the fields too
+    full = cache.profiles.peek("bitbucket", team)
+    if full is not None:
+        return full
+    return await cache.profiles.get(bitbucket_key(fields), team, lambda: fetch_bitbucket(team, fields))
+
+async def cached_github(organization: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
+    """
+    fetch_github through the snapshot of a watched org, or else the profile cache where
+    concurrent lookups of the same org share one crawl. Profiles gathered without looking up
+    the "null" languages are cached apart from the full ones
+
+    :param organization: github organization to gather the stats of
+    :optional param fields: names of the profile fields needed, defaults to all of them
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    """
+    if organization is None:
+        return profile.OrganizationProfile()
+    snapshot = snapshots.lookup("github", organization)
+    if snapshot is not None:
+        return snapshot
+    if github_key(fields) == "github":
+        return await cache.profiles.get("github", organization, lambda: fetch_github(organization))
+    # a full profile has the fields too
+    full = cache.profiles.peek("github", organization)
+    if full is not None:
+        return full
+    return await cache.profiles.get(github_key(fields), organization, lambda: fetch_github(organization, fields = fields))
+
+def parse_bitbucket(team: str) -> profile.OrganizationProfile:
+    """
+    Synchronous wrapper around fetch_bitbucket
+
+    :param team: bitbucket team to gather the stats of
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    """
+    return client.run(fetch_bitbucket(team))
+
+def parse_github(organization: str, graphql: bool = None) -> profile.OrganizationProfile:
+    """
+    Synchronous wrapper around fetch_github
+
+    :param organization: github organization to gather the stats of
+    :optional param graphql: use fetch_github_graphql instead of the rest api, defaults to GITHUB_GRAPHQL
+    :returns: an OrganizationProfile object that holds all of the gathered statistics
+    """
+    return client.run(fetch_github(organization, graphql = graphql))
+
+def parse_profiles(teams: List[str], organizations: List[str]) -> dict:
+    """
+    Synchronous wrapper around fetch_profiles
+
+    :param teams: bitbucket teams to gather the stats of
+    :param organizations: github organizations to gather the stats of
+    :returns: the "bitbucket" and "github" results, see fetch_profiles
+    """
+    return client.run(fetch_profiles(teams, organizations))
+
+def parse_partial_profile(team: str, organization: str, deadline: float, fields: Iterable[str] = None) -> Partial:
+    """
+    Synchronous wrapper around fetch_partial_profile
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :param deadline: seconds to wait for the crawls
+    :optional param fields: names of the profile fields needed
+    :returns: a Partial, see partial_profile
+    """
+    return client.run(fetch_partial_profile(team, organization, deadline, fields))
+
+def parse_stream_profile(team: str, organization: str, deadline: float = None, fields: Iterable[str] = None) -> Iterator[Tuple[Partial, bool]]:
+    """
+    Synchronous wrapper around stream_profile
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :optional param deadline: seconds after which the last totals are handed out, even if incomplete
+    :optional param fields: names of the profile fields needed
+    :returns: an iterator of (Partial, done) tuples
+    """
+    return client.iterate(stream_profile(team, organization, deadline, fields))
+
+def parse_profile(team: str, organization: str, fields: Iterable[str] = None) -> profile.OrganizationProfile:
+    """
+    Synchronous wrapper around fetch_profile
+
+    :param team: bitbucket team to gather the stats of
+    :param organization: github organization to gather the stats of
+    :optional param fields: names of the profile fields needed
+    :returns: an OrganizationProfile object that holds the combined statistics
+    """
+    return client.run(fetch_profile(team, organization, fields))
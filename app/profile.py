@@ -1,12 +1,18 @@
-from collections import defaultdict
+from typing import Iterable, Mapping
+from collections import Counter
+
+from app.sketch import SpaceSaving
 
 class OrganizationProfile:
     """
     Class to hold all the relevant profile information from a given git SVN host
     """
-    def __init__(self, repos: int = 0, forks: int = 0, watchers: int = 0, languages: defaultdict = defaultdict(int, {}), topics: defaultdict = defaultdict(int, {})):
+    __slots__ = ["repos", "forks", "watchers", "languages", "topics"]
+
+    def __init__(self, repos: int = 0, forks: int = 0, watchers: int = 0, languages: Mapping = None, topics: Mapping = None):
         """
-        Initializes an OrganizationProfile object
+        Initializes an OrganizationProfile object, Counters that are passed in are used as is
+        (not copied) so the parsers can hand over the ones they built
 
         :optional param repos: number of public repos
         :optional param forks: number of forked repos
@@ -18,39 +24,95 @@ class OrganizationProfile:
         self.repos = repos
         self.forks = forks
         self.watchers = watchers
-        self.languages = languages
-        self.topics = topics
+        self.languages = languages if isinstance(languages, Counter) else Counter(languages or {})
+        self.topics = topics if isinstance(topics, Counter) else Counter(topics or {})
 
     def __add__(self, other):
         """
         Adds two OrganizationProfile objects together by aggregating their values
         """
-        repos = self.repos + other.repos
-        forks = self.forks + other.forks
-        watchers = self.watchers + other.watchers
+        # copy() keeps bounded counts bounded
+        result = OrganizationProfile(self.repos, self.forks, self.watchers, self.languages.copy(), self.topics.copy())
+        result += other
+        return result
+
+    def __iadd__(self, other):
+        """
+        Adds another OrganizationProfile's values onto this one in place
+        """
+        self.repos += other.repos
+        self.forks += other.forks
+        self.watchers += other.watchers
+        # Counter.update keeps zero counts, unlike Counter.__add__
+        if other.languages:
+            self.languages.update(other.languages)
+        if other.topics:
+            self.topics.update(other.topics)
+        return self
 
-        # merge count from languages field, only using initialized values
-        languages = defaultdict(int)
-        for profile in [self, other]:
-            if profile.languages != defaultdict(int, {}):
-                for language, count in profile.languages.items():
-                    languages[language] += count
+    def __isub__(self, other):
+        """
+        Takes another OrganizationProfile's values back off this one in place, counts that drop
+        to zero are removed so they don't show up as languages/topics nobody uses
+        """
+        self.repos -= other.repos
+        self.forks -= other.forks
+        self.watchers -= other.watchers
+        for counts, removed in [(self.languages, other.languages), (self.topics, other.topics)]:
+            if removed:
+                counts.subtract(removed)
+                for key in removed:
+                    if counts[key] <= 0:
+                        del counts[key]
+        return self
 
-        # merge count from topics field, only using initialized values
-        topics = defaultdict(int)
-        for profile in [self, other]:
-            if profile.topics != defaultdict(int, {}):
-                for topic, count in profile.topics.items():
-                    topics[topic] += count
-        
-        return OrganizationProfile(repos, forks, watchers, languages, topics)
+    def bounded(self, top: int):
+        """
+        :param top: most languages and topics to keep
+        :returns: a new OrganizationProfile object with the languages and topics in SpaceSaving
+            summaries, profiles added onto it keep it that size
+        """
+        return OrganizationProfile(self.repos, self.forks, self.watchers, SpaceSaving(top, self.languages),
+            SpaceSaving(top, self.topics))
 
-    def dict(self) -> dict:
+    @classmethod
+    def merge_many(cls, profiles: Iterable, top: int = None):
+        """
+        Aggregates any number of OrganizationProfile objects in a single pass, without building
+        the intermediate profiles that chaining `+` would
+
+        :param profiles: profiles to aggregate
+        :optional param top: most languages and topics to keep, see bounded(), defaults to all of them
+        :returns: a new OrganizationProfile object with the combined values
+        """
+        result = cls() if top is None else cls().bounded(top)
+        for profile in profiles:
+            result += profile
+        return result
+
+    @classmethod
+    def from_dict(cls, profile_dict: dict):
+        """
+        Builds a profile back from the output of dict()
+
+        :param profile_dict: dict with the profile data
+        :returns: an OrganizationProfile object with the same values
+        """
+        return cls(profile_dict["repos"], profile_dict["forks"], profile_dict["watchers"],
+            profile_dict["languages"], profile_dict["topics"])
+
+    def dict(self, fields: Iterable[str] = None) -> dict:
         """
         Converts the profile data to a pretty-printable dict
-        
+
+        :optional param fields: names of the fields to include, defaults to all of them
         :returns: a dict object with all of the formatted data
         """
-        profile_dict = {"repos": self.repos, "forks": self.forks, "watchers": self.watchers, 
-            "languages": dict(self.languages or {}), "topics": dict(self.topics or {})}
+        profile_dict = {"repos": self.repos, "forks": self.forks, "watchers": self.watchers,
+            "languages": dict(self.languages), "topics": dict(self.topics)}
+        if fields is not None:
+            return {field: value for field, value in profile_dict.items() if field in fields}
         return profile_dict
+
+# names of the fields a profile can be narrowed down to, see dict()
+FIELDS = tuple(OrganizationProfile.__slots__)
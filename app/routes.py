@@ -1,6 +1,10 @@
+import json
+import math
 import logging
+from typing import AsyncIterator, FrozenSet, Optional, Tuple, Union
 
-from app import parsers
+from app import cache, client, executor, metrics, parsers
+from app.profile import FIELDS, OrganizationProfile
 
 import flask
 from flask import Response, jsonify
@@ -11,21 +15,210 @@ logger.setLevel(logging.INFO)
 
 #{dde490aa-a2db-40cb-81ca-99fd1f52b0ca} <- team name to test multiple pages of repos
 
+# what the shared handlers answer: an error message, a json body, or the json lines of a stream
+Body = Union[str, dict, AsyncIterator[dict]]
+
+def to_response(status: int, body: Body) -> Response:
+    """
+    :param status: status of the response
+    :param body: body returned by one of the shared handlers, e.g. handle_profile
+    :returns: the flask response, a stream is driven on the background event loop line by line
+    """
+    if isinstance(body, str):
+        return Response(body, status=status)
+    if isinstance(body, dict):
+        return jsonify(body), status
+    lines = (json.dumps(line, sort_keys=True) + "\n" for line in client.iterate(body))
+    return Response(lines, status=status, mimetype="application/x-ndjson")
+
+async def handle_profile(args) -> Tuple[int, Body]:
+    """
+    Handles a /profile request, for both the flask app and app.asgi
+
+    :param args: query string arguments of the request
+    :returns: the (status, body) to answer with, see to_response
+    """
+    team = args.get("bitbucket-team")
+    organization = args.get("github-org")
+    app.logger.info(f"Parsed bitbucket team as {team}")
+    app.logger.info(f"Parsed github organization as {organization}")
+
+    try:
+        deadline = deadline_arg(args)
+        fields = fields_arg(args)
+        top = top_arg(args)
+    except ValueError as e:
+        return 400, str(e)
+
+    if args.get("stream") == "1":
+        async def lines():
+            partials = parsers.stream_profile(team, organization, deadline, fields)
+            try:
+                async for partial, done in partials:
+                    yield partial_response(partial, done, fields, top)
+            finally:
+                await partials.aclose()
+        return 200, lines()
+
+    trace = metrics.Trace() if args.get("debug-timing") == "1" else None
+    try:
+        with metrics.tracing(trace):
+            if deadline is None:
+                result = await parsers.fetch_profile(team, organization, fields)
+            else:
+                result = await parsers.fetch_partial_profile(team, organization, deadline, fields)
+    except ConnectionError as e:
+        return 500, str(e)
+
+    body = profile_response(result, fields, top) if deadline is None else partial_response(result, fields=fields, top=top)
+    if trace is not None:
+        body["timing"] = trace.report()
+    return 200, body
+
 @app.route("/profile", methods=["GET"])
 def profile():
     """
-    Endpoint to get unified profile from github and bitbucket
+    Endpoint to get unified profile from github and bitbucket, add debug-timing=1 to get
+    the time spent in each phase under "timing". With deadline=<seconds> it answers with what
+    has been gathered by then, and with stream=1 it sends the running totals as ndjson lines.
+    fields=repos,languages narrows the profile down to those fields and skips the lookups only
+    the others need, and top=<count> keeps only about the most common languages/topics
     """
-    app.logger.info(f"Parsed bitbucket team as {flask.request.args.get('bitbucket-team')}")
-    app.logger.info(f"Parsed github organization as {flask.request.args.get('github-org')}")
+    return to_response(*client.run(handle_profile(flask.request.args)))
 
+def deadline_arg(args) -> Optional[float]:
+    """
+    :param args: query string arguments of a /profile request
+    :returns: the seconds its deadline=<seconds> asks to wait at most, or None if it doesn't have one
+    :raises ValueError: raises an exception if the deadline isn't a positive number
+    """
+    deadline = args.get("deadline")
+    if deadline is None:
+        return None
     try:
-        bitbucket = parsers.parse_bitbucket(flask.request.args.get("bitbucket-team"))
-        github = parsers.parse_github(flask.request.args.get("github-org"))
-    except ConnectionError as e:
-        return Response(str(e), status=500)
-     
-    return jsonify((bitbucket + github).dict())
+        deadline = float(deadline)
+    except ValueError:
+        deadline = math.nan
+    if not 0 < deadline < math.inf:
+        raise ValueError("deadline must be a positive number of seconds")
+    return deadline
+
+def fields_arg(args) -> Optional[FrozenSet[str]]:
+    """
+    :param args: query string arguments of a /profile request
+    :returns: the profile fields its fields=<name>,<name> asks for, or None if it wants all of them
+    :raises ValueError: raises an exception if a field isn't one of the profile's
+    """
+    fields = args.get("fields")
+    if fields is None:
+        return None
+    fields = frozenset(field.strip() for field in fields.split(",") if field.strip())
+    if not fields or not fields <= set(FIELDS):
+        raise ValueError("fields must be a comma separated list of " + ", ".join(FIELDS))
+    return fields
+
+def top_arg(args) -> Optional[int]:
+    """
+    :param args: query string arguments of a /profile or /profiles request
+    :returns: the most languages/topics its top=<count> asks for, or None if it wants all of them
+    :raises ValueError: raises an exception if the count isn't a positive integer
+    """
+    top = args.get("top")
+    if top is None:
+        return None
+    if not top.isdigit() or int(top) < 1:
+        raise ValueError("top must be a positive integer")
+    return int(top)
+
+def profile_response(result: OrganizationProfile, fields: FrozenSet[str] = None, top: int = None) -> dict:
+    """
+    :param result: profile to send back
+    :optional param fields: profile fields to include, defaults to all of them
+    :optional param top: most languages/topics to include, defaults to all of them
+    :returns: the profile, with top set its "bounds" are how far off the languages/topics counts
+        can be, see sketch.SpaceSaving
+    """
+    if top is None:
+        return result.dict(fields)
+    result = result.bounded(top)
+    body = result.dict(fields)
+    body["bounds"] = {field: getattr(result, field).floor for field in ["languages", "topics"] if fields is None or field in fields}
+    return body
+
+def partial_response(partial: parsers.Partial, done: bool = None, fields: FrozenSet[str] = None, top: int = None) -> dict:
+    """
+    :param partial: profile gathered so far, see parsers.partial_profile
+    :optional param done: whether it's the last line of a streamed profile
+    :optional param fields: profile fields to include, defaults to all of them
+    :optional param top: most languages/topics to include, defaults to all of them
+    :returns: the profile along with which providers are "complete" and the "errors" of those that failed
+    """
+    body = {**profile_response(partial.profile, fields, top), "complete": partial.complete, "errors": partial.errors}
+    if done is not None:
+        body["done"] = done
+    return body
+
+def batch_names(body) -> tuple:
+    """
+    :param body: parsed json body of a /profiles request
+    :returns: the (bitbucket teams, github orgs) it asks for
+    :raises ValueError: raises an exception if the body isn't shaped like {"bitbucket-teams": [...], "github-orgs": [...]}
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Expected a json object with bitbucket-teams and github-orgs lists")
+    teams = body.get("bitbucket-teams", [])
+    organizations = body.get("github-orgs", [])
+    if not all(isinstance(names, list) and all(isinstance(name, str) for name in names) for names in [teams, organizations]):
+        raise ValueError("bitbucket-teams and github-orgs must be lists of names")
+    return teams, organizations
+
+def batch_response(results: dict, top: int = None) -> dict:
+    """
+    :param results: the "bitbucket" and "github" results of parsers.fetch_profiles
+    :optional param top: most languages/topics to include in each profile and the total, defaults to all of them
+    :returns: the /profiles response body with the profiles, the errors and their total
+    """
+    response = {"profiles": {}, "errors": {}}
+    gathered = []
+    for provider, provider_results in results.items():
+        response["profiles"][provider] = {}
+        response["errors"][provider] = {}
+        for name, result in provider_results.items():
+            if isinstance(result, OrganizationProfile):
+                response["profiles"][provider][name] = profile_response(result, top=top)
+                gathered.append(result)
+            else:
+                response["errors"][provider][name] = str(result)
+    response["total"] = profile_response(OrganizationProfile.merge_many(gathered, top), top=top)
+    return response
+
+async def handle_profiles(body, args) -> Tuple[int, Body]:
+    """
+    Handles a /profiles request, for both the flask app and app.asgi
+
+    :param body: parsed json body of the request, None if it isn't json
+    :param args: query string arguments of the request
+    :returns: the (status, body) to answer with, see to_response
+    """
+    try:
+        teams, organizations = batch_names(body)
+        top = top_arg(args)
+    except ValueError as e:
+        return 400, str(e)
+
+    app.logger.info(f"Parsed {len(teams)} bitbucket teams and {len(organizations)} github organizations")
+    fetch = executor.fetch_profiles if executor.PROCESSES else parsers.fetch_profiles
+    return 200, batch_response(await fetch(teams, organizations), top)
+
+@app.route("/profiles", methods=["POST"])
+def profiles():
+    """
+    Endpoint to get the profiles of many bitbucket teams and github orgs at once, along with their total.
+    Expects a json body like {"bitbucket-teams": [...], "github-orgs": [...]}. They're sharded across
+    CRAWL_PROCESSES worker processes if it's set. top=<count> keeps the total's languages/topics,
+    and each profile's, down to about the most common ones
+    """
+    return to_response(*client.run(handle_profiles(flask.request.get_json(silent=True), flask.request.args)))
 
 @app.route("/health-check", methods=["GET"])
 def health_check():
@@ -34,3 +227,24 @@ def health_check():
     """
     app.logger.info("Health Check!")
     return Response("All Good!", status=200)
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """
+    Endpoint to expose the request counters, cache hits, retries and latency histograms to prometheus
+    """
+    return Response(metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
+
+@app.route("/pool-stats", methods=["GET"])
+def pool_stats():
+    """
+    Endpoint to report the usage of the shared upstream connection pool
+    """
+    return jsonify(client.pool_stats())
+
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    """
+    Endpoint to report the hits, misses and revalidations of the upstream response and profile caches
+    """
+    return jsonify({"responses": cache.responses.stats, "profiles": cache.profiles.stats})
@@ -0,0 +1,241 @@
+import time
+import random
+import asyncio
+import logging
+import contextlib
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+
+logger = logging.getLogger("user_profiles_api")
+
+# statuses that mean "slow down / try again" rather than "this request is wrong"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+class TokenBucket:
+    """
+    Hands out one token per request. It refills at `rate` tokens per second (never when `rate` is None)
+    and is capped by what the upstream api says is left of its rate limit
+    """
+    def __init__(self, rate: Optional[float] = None, capacity: float = float("inf")):
+        """
+        :optional param rate: tokens added per second, None for no steady rate limit
+        :optional param capacity: max tokens the bucket holds, i.e. the largest burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity if rate is None else min(capacity, max(rate, 1))
+        self.updated = time.monotonic()
+        self.reset_at = None
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.reset_at is not None and now >= self.reset_at:
+            # the upstream window is over, we're back to whatever our own limit allows
+            self.reset_at = None
+            self.tokens = self.capacity if self.rate is None else max(self.tokens, 1)
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """
+        :returns: seconds until a token is available, 0 if one is available now
+        """
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        if self.reset_at is not None:
+            return max(self.reset_at - time.monotonic(), 0.0)
+        if self.rate:
+            return (1 - self.tokens) / self.rate
+        return 0.0
+
+    def take(self):
+        self.tokens -= 1
+
+    def limit(self, remaining: int, reset: Optional[float]):
+        """
+        Syncs the bucket with the rate limit reported by the upstream api
+
+        :param remaining: requests left in the current window
+        :param reset: time.time() value at which the window resets, if known
+        """
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+        if remaining < 1 and reset is not None:
+            self.reset_at = time.monotonic() + max(reset - time.time(), 0.0)
+
+class HostScheduler:
+    """
+    Schedules the requests to a single upstream host:
+        - a token bucket that follows the X-RateLimit-Remaining/Reset headers
+        - a concurrency limit that grows by one request per round trip while things go well
+          and halves when the host pushes back (AIMD)
+        - retries of 429/5xx responses and transport errors with jittered exponential backoff,
+          waiting for Retry-After when the host sends it
+    """
+    def __init__(self, max_concurrency: int = 20, rate: Optional[float] = None, max_retries: int = 4,
+            backoff_base: float = 0.5, backoff_cap: float = 30.0, max_wait: float = 60.0):
+        """
+        :optional param max_concurrency: ceiling of the in-flight requests to the host
+        :optional param rate: steady requests per second allowed to the host, None for no limit
+        :optional param max_retries: times a throttled or failed request is retried
+        :optional param backoff_base: seconds to wait before the first retry, doubled every retry
+        :optional param backoff_cap: most seconds to wait before a retry
+        :optional param max_wait: most seconds a request waits for the host's rate limit to reset,
+            it fails instead of waiting any longer
+        """
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.bucket = TokenBucket(rate = rate)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0}
+        self._ready = asyncio.Condition()
+
+    async def _acquire(self):
+        async with self._ready:
+            while True:
+                wait = max(self.paused_until - time.monotonic(), self.bucket.wait_time())
+                if wait > self.max_wait:
+                    raise ConnectionError("Rate limited by the upstream api until "
+                        + time.strftime("%Y-%m-%d %H:%M:%S UTC", time.gmtime(time.time() + wait)))
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    break
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self._ready.wait(), timeout = wait)
+                    except asyncio.TimeoutError:
+                        pass
+                else:
+                    await self._ready.wait()
+            self.bucket.take()
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._ready:
+            self.in_flight -= 1
+            self._ready.notify_all()
+
+    def _update(self, response: httpx.Response) -> Optional[float]:
+        """
+        Reads the rate limit headers of a response
+
+        :returns: seconds the host asked us to wait with Retry-After, if it did
+        """
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        reset = response.headers.get("X-RateLimit-Reset")
+        if remaining is not None and remaining.isdigit():
+            self.bucket.limit(int(remaining), float(reset) if reset and reset.isdigit() else None)
+
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                return None
+        return None
+
+    def _throttled(self, response: httpx.Response) -> bool:
+        if response.status_code in RETRY_STATUSES:
+            return True
+        # github answers 403 to both primary and secondary rate limits
+        return response.status_code == 403 and (response.headers.get("X-RateLimit-Remaining") == "0"
+            or "Retry-After" in response.headers)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    async def send(self, request: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        """
+        Sends a request once the host has room for it, retrying it while the host pushes back
+
+        :param request: function that returns a coroutine sending the request
+        :returns: the last response of the host, which may still be an error once retries run out.
+            The responses that are retried are closed
+        :raises ConnectionError: raises an exception if the host couldn't be reached after every retry,
+            or its rate limit only resets after more than max_wait seconds
+        """
+        return await self._send(request, hold = False)
+
+    @contextlib.asynccontextmanager
+    async def stream(self, request: Callable[[], Awaitable[httpx.Response]]) -> AsyncIterator[httpx.Response]:
+        """
+        Sends a streamed request like send(), but keeps its slot of the host taken until the body
+        has been read and the response closed, rather than giving it back once the headers are in
+
+        :param request: function that returns a coroutine sending the request with stream = True
+        :returns: a context manager holding the last response of the host, closed on exit
+        :raises ConnectionError: raises an exception under the same conditions as send()
+        """
+        response = await self._send(request, hold = True)
+        try:
+            yield response
+        finally:
+            try:
+                await response.aclose()
+            finally:
+                await self._release()
+
+    async def _send(self, request: Callable[[], Awaitable[httpx.Response]], hold: bool) -> httpx.Response:
+        """
+        :param hold: keep the slot of the response that's handed back, the caller releases it
+        """
+        attempt = 0
+        while True:
+            await self._acquire()
+            try:
+                self.stats["requests"] += 1
+                response = await request()
+            except httpx.TransportError as e:
+                response = None
+                error = e
+            except BaseException:
+                await self._release()
+                raise
+
+            if response is not None:
+                retry_after = self._update(response)
+                if not self._throttled(response):
+                    # additive increase, one more slot per window's worth of good responses
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+                    if not hold:
+                        await self._release()
+                    return response
+                self.stats["throttled"] += 1
+                # multiplicative decrease
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                retry_after = None
+
+            if attempt >= self.max_retries or (retry_after is not None and retry_after > self.max_wait):
+                if response is None:
+                    await self._release()
+                    raise ConnectionError(f"Failed to reach {error.request.url}: {error}")
+                if not hold:
+                    await self._release()
+                return response
+
+            await self._release()
+            if response is not None:
+                # a streamed response holds its pooled connection until it's closed
+                await response.aclose()
+            wait = retry_after if retry_after is not None else self._backoff(attempt)
+            if retry_after is not None:
+                # the whole host asked us to hold off, not just this request
+                self.paused_until = max(self.paused_until, time.monotonic() + wait)
+            logger.debug(f"Retrying request in {wait:.2f}s (attempt {attempt + 1})")
+            self.stats["retries"] += 1
+            attempt += 1
+            await asyncio.sleep(wait)
+
+    def report(self) -> dict:
+        """
+        :returns: the current limits of the host along with its counters
+        """
+        return {"concurrency": int(self.concurrency), "in_flight": self.in_flight, **self.stats}
@@ -0,0 +1,70 @@
+"""
+Bounded counts for the languages/topics of profiles aggregated over many teams/orgs, so the
+memory, merge cost and size of the total stay the same however many profiles go into it
+"""
+from typing import Hashable, Mapping
+from operator import itemgetter
+from collections import Counter
+
+class SpaceSaving(Counter):
+    """
+    Space-Saving summary that keeps the counts of at most `capacity` keys. A kept count can be
+    over the real one by at most `floor`, and a key that was left out was seen at most `floor`
+    times. The floor stays 0, and the counts exact, until more than `capacity` keys come in.
+    Summaries are merged with update(), or `+=` on the profiles holding them
+    """
+    def __init__(self, capacity: int, counts: Mapping = None):
+        """
+        :param capacity: most keys to keep
+        :optional param counts: counts, or another summary, to start from
+        :returns: a SpaceSaving object
+        """
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        # set before Counter.__init__, which calls update()
+        self.capacity = capacity
+        self.floor = 0
+        super().__init__(counts)
+
+    def update(self, counts: Mapping = None, **kwargs):
+        """
+        Adds counts, or merges another summary, in place. Keys only one side has are taken to
+        have that side's floor on the other, then the lowest counts are dropped past capacity
+        """
+        if not isinstance(counts, Mapping) or kwargs:
+            counts = Counter(counts, **kwargs)
+        floor = counts.floor if isinstance(counts, SpaceSaving) else 0
+        if floor:
+            for key in self:
+                if key not in counts:
+                    self[key] += floor
+        for key, count in counts.items():
+            self[key] = (self[key] if key in self else self.floor) + count
+        self.floor += floor
+        self._trim()
+
+    def _trim(self):
+        if len(self) <= self.capacity:
+            return
+        ranked = sorted(self.items(), key = itemgetter(1), reverse = True)
+        self.floor = max(self.floor, ranked[self.capacity][1])
+        for key, _ in ranked[self.capacity:]:
+            del self[key]
+
+    def bounds(self, key: Hashable) -> tuple:
+        """
+        :param key: key to look up
+        :returns: the (lowest, highest) number of times the key could have been seen
+        """
+        if key not in self:
+            return 0, self.floor
+        return max(self[key] - self.floor, 0), self[key]
+
+    def copy(self):
+        result = SpaceSaving(self.capacity)
+        dict.update(result, self)
+        result.floor = self.floor
+        return result
+
+    def __reduce__(self):
+        return self.__class__, (self.capacity,), {"floor": self.floor}, None, iter(self.items())
@@ -0,0 +1,279 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from collections import namedtuple
+
+from app import client
+from app.profile import OrganizationProfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger("user_profiles_api")
+
+# intervals after which a snapshot that failed to refresh is no longer served, the org is gathered live instead
+STALE_INTERVALS = 3
+
+# most seconds a process that doesn't refresh the store goes without picking up what the one that does saved
+RELOAD_INTERVAL = 30.0
+
+# a stored profile and the time.time() it was gathered at
+Snapshot = namedtuple("Snapshot", ["profile", "updated"])
+
+class SnapshotStore:
+    """
+    Keeps the latest profile of each watched team/org in a sqlite file so they survive restarts.
+    Every snapshot is also held in memory, reads never touch the disk. Next to the profiles it keeps
+    an index of what each repo added to them, see app.incremental
+    """
+    def __init__(self, path: str):
+        """
+        :param path: sqlite file to store the snapshots in, ":memory:" for no file
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS snapshots (provider TEXT NOT NULL, organization TEXT NOT NULL, "
+            "profile TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (provider, organization))")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS repos (provider TEXT NOT NULL, organization TEXT NOT NULL, "
+            "id TEXT NOT NULL, entry TEXT NOT NULL, PRIMARY KEY (provider, organization, id))")
+        self._connection.commit()
+        self._snapshots = {(provider, organization): Snapshot(OrganizationProfile.from_dict(json.loads(profile)), updated)
+            for provider, organization, profile, updated in self._connection.execute("SELECT * FROM snapshots")}
+
+    def reload(self):
+        """
+        Picks up the snapshots another process saved to the file since they were last read
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM snapshots").fetchall()
+        for provider, organization, profile, updated in rows:
+            current = self._snapshots.get((provider, organization))
+            if current is None or current.updated < updated:
+                self._snapshots[(provider, organization)] = Snapshot(OrganizationProfile.from_dict(json.loads(profile)), updated)
+
+    def get(self, provider: str, organization: str) -> Optional[Snapshot]:
+        """
+        :param provider: provider the org belongs to, e.g. "github"
+        :param organization: name of the team/org
+        :returns: the latest snapshot of the team/org, or None if there isn't one
+        """
+        return self._snapshots.get((provider, organization))
+
+    def save(self, provider: str, organization: str, profile: OrganizationProfile, updated: float = None,
+            changed: dict = {}, removed: List[str] = []):
+        """
+        Stores a profile along with the changes to its repo index, both in one transaction so they
+        can't get out of step
+
+        :param provider: provider the org belongs to
+        :param organization: name of the team/org
+        :param profile: profile to store
+        :optional param updated: time.time() the profile was gathered at, defaults to now
+        :optional param changed: json serializable entry of each new or changed repo by repo id
+        :optional param removed: ids of the repos that are gone
+        """
+        snapshot = Snapshot(profile, updated if updated is not None else time.time())
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?)",
+                (provider, organization, json.dumps(profile.dict()), snapshot.updated))
+            self._connection.executemany("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?)",
+                [(provider, organization, repo, json.dumps(entry)) for repo, entry in changed.items()])
+            self._connection.executemany("DELETE FROM repos WHERE provider = ? AND organization = ? AND id = ?",
+                [(provider, organization, repo) for repo in removed])
+            self._connection.commit()
+            self._snapshots[(provider, organization)] = snapshot
+
+    def index(self, provider: str, organization: str) -> dict:
+        """
+        :param provider: provider the org belongs to
+        :param organization: name of the team/org
+        :returns: the stored entry of each repo of the team/org by repo id
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT id, entry FROM repos WHERE provider = ? AND organization = ?",
+                (provider, organization)).fetchall()
+        return {repo: json.loads(entry) for repo, entry in rows}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+class RefreshLock:
+    """
+    Lock file next to a snapshot store, held by the one process (e.g. out of several uvicorn
+    workers) that refreshes the store. It's let go when that process exits
+    """
+    def __init__(self, path: str):
+        """
+        :param path: file to lock
+        """
+        self.path = path
+        self._file = None
+
+    def acquire(self) -> bool:
+        """
+        :returns: whether this process holds the lock, without waiting for it
+        """
+        if self._file is not None or fcntl is None:
+            return True
+        handle = open(self.path, "a")
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self._file = handle
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class RefreshWorker:
+    """
+    Re-gathers the profiles of a watchlist every `interval` seconds and saves them to a SnapshotStore.
+    Teams/orgs whose snapshot is still recent enough (e.g. after a restart) are left alone until it's due.
+    With a lock only the process holding it refreshes, the others reload what it saves and take over
+    the lock if it exits
+    """
+    def __init__(self, store: SnapshotStore, watchlist: List[Tuple[str, str]], refreshers: Dict[str, Callable[[str], Awaitable]],
+            interval: float = 300.0, lock: RefreshLock = None):
+        """
+        :param store: where the snapshots go
+        :param watchlist: (provider, team/org) pairs to keep up to date
+        :param refreshers: coroutine function for each provider that re-gathers an org and returns
+            an incremental.Refresh, see incremental.refresher
+        :optional param interval: seconds between refreshes of the same team/org
+        :optional param lock: lock shared with the other processes using the same store, None to always refresh
+        """
+        self.store = store
+        self.watchlist = list(dict.fromkeys(watchlist))
+        self.refreshers = refreshers
+        self.interval = interval
+        self.lock = lock
+        self._attempted = {}
+
+    def watching(self, provider: str, organization: str) -> bool:
+        return (provider, organization) in self.watchlist
+
+    def due(self) -> List[Tuple[str, str]]:
+        """
+        :returns: the watched teams/orgs whose snapshot (or last failed attempt) is older than the interval
+        """
+        now = time.time()
+        due = []
+        for key in self.watchlist:
+            snapshot = self.store.get(*key)
+            last = max(snapshot.updated if snapshot else 0, self._attempted.get(key, 0))
+            if now - last >= self.interval:
+                due.append(key)
+        return due
+
+    async def refresh(self, provider: str, organization: str):
+        self._attempted[(provider, organization)] = time.time()
+        try:
+            async with client.crawl_slot():
+                refresh = await self.refreshers[provider](organization)
+            self.store.save(provider, organization, refresh.profile, changed = refresh.changed, removed = refresh.removed)
+        except Exception as e:
+            logger.warning(f"Failed to refresh the snapshot of {provider} org {organization}: {e}")
+
+    async def run_once(self):
+        # a failed refresh must not end run_forever, the others are still due next time
+        await asyncio.gather(*[self.refresh(provider, organization) for provider, organization in self.due()],
+            return_exceptions = True)
+
+    def refreshing(self) -> bool:
+        """
+        :returns: whether this process refreshes the store, rather than another one holding the lock
+        """
+        return self.lock is None or self.lock.acquire()
+
+    async def run_forever(self):
+        while True:
+            if not self.refreshing():
+                try:
+                    self.store.reload()
+                except sqlite3.Error as e:
+                    logger.warning(f"Failed to reload the snapshots: {e}")
+                await asyncio.sleep(min(RELOAD_INTERVAL, self.interval))
+                continue
+            await self.run_once()
+            # sleep until the oldest snapshot is due again
+            now = time.time()
+            next_due = min((max(getattr(self.store.get(*key), "updated", 0), self._attempted.get(key, 0)) + self.interval
+                for key in self.watchlist), default = now + self.interval)
+            await asyncio.sleep(max(next_due - now, 1.0))
+
+store = None
+worker = None
+
+def watchlist_from_env() -> List[Tuple[str, str]]:
+    """
+    :returns: the (provider, team/org) pairs listed in WATCH_BITBUCKET_TEAMS and WATCH_GITHUB_ORGS
+    """
+    watchlist = []
+    for provider, variable in [("bitbucket", "WATCH_BITBUCKET_TEAMS"), ("github", "WATCH_GITHUB_ORGS")]:
+        watchlist.extend((provider, name.strip()) for name in os.environ.get(variable, "").split(",") if name.strip())
+    return watchlist
+
+def start(watchlist: List[Tuple[str, str]] = None, path: str = None, interval: float = None) -> RefreshWorker:
+    """
+    Opens the snapshot store and starts refreshing the watchlist on the background event loop, if
+    no other process (e.g. another uvicorn worker) already refreshes the same store
+
+    :optional param watchlist: (provider, team/org) pairs to keep up to date, defaults to watchlist_from_env()
+    :optional param path: sqlite file of the store, defaults to SNAPSHOT_PATH or snapshots.sqlite3
+    :optional param interval: seconds between refreshes, defaults to SNAPSHOT_INTERVAL or 300
+    :returns: the running worker
+    """
+    # imported here since the parsers look up snapshots from this module
+    from app import incremental
+
+    global store, worker
+    stop()
+    path = path or os.environ.get("SNAPSHOT_PATH", "snapshots.sqlite3")
+    store = SnapshotStore(path)
+    worker = RefreshWorker(store, watchlist if watchlist is not None else watchlist_from_env(),
+        {provider: incremental.refresher(provider, store) for provider in ["bitbucket", "github"]},
+        interval if interval is not None else float(os.environ.get("SNAPSHOT_INTERVAL", 300)),
+        RefreshLock(path + ".lock") if path != ":memory:" else None)
+    worker.task = client.submit(worker.run_forever())
+    logger.info(f"Refreshing {len(worker.watchlist)} watched teams/orgs every {worker.interval}s")
+    return worker
+
+def stop():
+    """
+    Stops the refresh worker and closes the snapshot store, if they were started
+    """
+    global store, worker
+    if worker is not None:
+        worker.task.cancel()
+        if worker.lock is not None:
+            worker.lock.release()
+    if store is not None:
+        store.close()
+    store = worker = None
+
+def lookup(provider: str, organization: str) -> Optional[OrganizationProfile]:
+    """
+    :param provider: provider the org belongs to
+    :param organization: name of the team/org
+    :returns: the latest snapshot's profile if the team/org is watched and has one that's less than
+        STALE_INTERVALS refreshes old, otherwise None
+    """
+    current = worker
+    if current is None or not current.watching(provider, organization):
+        return None
+    snapshot = current.store.get(provider, organization)
+    if snapshot is None or time.time() - snapshot.updated > STALE_INTERVALS * current.interval:
+        return None
+    return snapshot.profile
@@ -0,0 +1,135 @@
+import json
+import codecs
+from typing import Iterator, Optional
+
+WHITESPACE = " \t\n\r"
+NUMBER = "0123456789.eE+-"
+
+class ItemParser:
+    """
+    Incrementally parses a json listing as its body arrives, handing out each item of the list
+    as soon as it's complete so the whole listing never has to be held in memory. The list is
+    either the document itself (github) or the value of `key` in the top level object (bitbucket),
+    in which case the other top level values are kept in `fields`
+    """
+    def __init__(self, key: Optional[str] = None):
+        """
+        :optional param key: top level key that holds the list, None if the document is the list
+        """
+        self.key = key
+        self.fields = {}
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._final = False
+        # where we are in the document: "start", "key", "value", "after_value", "items", "after_item", "done"
+        self._state = "start"
+        self._field = None
+
+    def feed(self, chunk: bytes) -> Iterator[dict]:
+        """
+        :param chunk: next part of the body
+        :returns: the items that were completed by the chunk
+        """
+        self._buffer = self._buffer[self._pos:] + self._text.decode(chunk)
+        self._pos = 0
+        yield from self._parse()
+
+    def close(self) -> Iterator[dict]:
+        """
+        Finishes the body
+
+        :returns: any items that were still waiting on the end of the body
+        :raises ValueError: raises an exception if the body isn't a complete listing
+        """
+        self._buffer = self._buffer[self._pos:] + self._text.decode(b"", final = True)
+        self._pos = 0
+        self._final = True
+        yield from self._parse()
+        if self._state != "done":
+            raise ValueError("Incomplete json listing")
+
+    def _skip(self) -> Optional[str]:
+        while self._pos < len(self._buffer) and self._buffer[self._pos] in WHITESPACE:
+            self._pos += 1
+        return self._buffer[self._pos] if self._pos < len(self._buffer) else None
+
+    def _decode(self):
+        """
+        :returns: (True, value) for the next complete value, (False, None) if it isn't all here yet
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            if self._final:
+                raise ValueError("Invalid json listing")
+            return False, None
+        # a number that runs up to the end of the buffer might still have digits, a fraction or an
+        # exponent on the way ("12." or "1e" decode as 12 and 1 with the rest left behind)
+        if not self._final and isinstance(value, (int, float)) and not isinstance(value, bool) \
+                and all(char in NUMBER for char in self._buffer[end:]):
+            return False, None
+        self._pos = end
+        return True, value
+
+    def _expect(self, char: str, expected: str):
+        if char not in expected:
+            raise ValueError(f"Invalid json listing, expected one of {expected!r} but found {char!r}")
+        self._pos += 1
+
+    def _parse(self) -> Iterator[dict]:
+        while True:
+            char = self._skip()
+            if char is None:
+                return
+
+            if self._state == "start":
+                self._expect(char, "{" if self.key is not None else "[")
+                self._state = "key" if self.key is not None else "items"
+            elif self._state == "key":
+                if char == "}":
+                    self._pos += 1
+                    self._state = "done"
+                    continue
+                start = self._pos
+                complete, self._field = self._decode()
+                if not complete:
+                    return
+                if self._skip() is None:
+                    # put the key back until we can see the colon after it
+                    self._pos = start
+                    return
+                self._expect(self._skip(), ":")
+                self._state = "value"
+            elif self._state == "value":
+                if self._field == self.key:
+                    self._expect(char, "[")
+                    self._state = "items"
+                    continue
+                complete, value = self._decode()
+                if not complete:
+                    return
+                self.fields[self._field] = value
+                self._state = "after_value"
+            elif self._state == "after_value":
+                self._expect(char, ",}")
+                self._state = "key" if char == "," else "done"
+            elif self._state == "items":
+                if char == "]":
+                    self._pos += 1
+                    self._state = "after_value" if self.key is not None else "done"
+                    continue
+                complete, item = self._decode()
+                if not complete:
+                    return
+                self._state = "after_item"
+                yield item
+            elif self._state == "after_item":
+                self._expect(char, ",]")
+                if char == "]":
+                    self._state = "after_value" if self.key is not None else "done"
+                else:
+                    self._state = "items"
+            else:
+                raise ValueError("Unexpected data after the json listing")
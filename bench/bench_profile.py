@@ -0,0 +1,58 @@
+"""
+Micro-benchmark for merging per-repo OrganizationProfile objects
+
+    python -m bench.bench_profile [--profiles 10000] [--repeat 5] [--top 20]
+
+With --top it also times merge_many keeping only that many languages/topics (see app.sketch)
+"""
+import random
+import timeit
+import argparse
+import functools
+import operator
+
+from app import profile
+
+LANGUAGES = ["python", "java", "javascript", "go", "c", "c++", "ruby", "php", "swift", "kotlin", "none"]
+TOPICS = [f"topic-{i}" for i in range(200)]
+
+def build_profiles(count: int) -> list:
+    """
+    :param count: number of profiles to build
+    :returns: one profile per repo, the way a crawl would produce them
+    """
+    rng = random.Random(0)
+    return [profile.OrganizationProfile(repos = 1, watchers = rng.randint(0, 100),
+        languages = {rng.choice(LANGUAGES): 1}, topics = {topic: 1 for topic in rng.sample(TOPICS, 3)})
+        for _ in range(count)]
+
+def chained_add(profiles: list) -> profile.OrganizationProfile:
+    return functools.reduce(operator.add, profiles, profile.OrganizationProfile())
+
+def merge_many(profiles: list) -> profile.OrganizationProfile:
+    return profile.OrganizationProfile.merge_many(profiles)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profiles", type = int, default = 10000)
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--top", type = int, default = None)
+    args = parser.parse_args()
+
+    profiles = build_profiles(args.profiles)
+    assert chained_add(profiles).dict() == merge_many(profiles).dict()
+
+    results = {}
+    for name, merge in [("chained +", chained_add), ("merge_many", merge_many)]:
+        results[name] = min(timeit.repeat(lambda: merge(profiles), number = 1, repeat = args.repeat))
+        print(f"{name:>12}: {results[name] * 1000:8.2f} ms for {args.profiles} profiles")
+    print(f"{'speedup':>12}: {results['chained +'] / results['merge_many']:8.1f}x")
+
+    if args.top:
+        merged = profile.OrganizationProfile.merge_many(profiles, args.top)
+        elapsed = min(timeit.repeat(lambda: profile.OrganizationProfile.merge_many(profiles, args.top), number = 1, repeat = args.repeat))
+        print(f"{'top ' + str(args.top):>12}: {elapsed * 1000:8.2f} ms, {len(merged.topics)} topics kept, "
+            f"counts at most {merged.topics.floor} over")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Load test for the ASGI app: serves it with 1, 2, 4... uvicorn workers against a local stub of
+github and bitbucket, fires concurrent /profile calls at it and reports the throughput of each
+
+    python -m bench.load_profile [--workers 1 2 4] [--concurrency 32] [--duration 10] [--repos 1000]
+
+The profile cache is off and the response cache too, so every call crawls its org (from the stub)
+and the work per call is the listing parsing and aggregation that extra workers spread over more cpus
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import logging
+import argparse
+import subprocess
+import statistics
+
+import httpx
+
+from app import cache, client
+from test import stub
+
+ORGANIZATIONS = 32
+
+def stub_application():
+    """
+    Factory for uvicorn --factory, called in each worker process: points the pooled client
+    at a stub upstream sized by LOAD_REPOS and LOAD_LATENCY, and turns the caches off
+
+    :returns: the ASGI application
+    """
+    from app import asgi
+
+    repos = int(os.environ.get("LOAD_REPOS", 1000))
+    upstream = stub.Upstream(github = {f"org-{i}": [stub.github_repo(f"org-{i}", r, topics = ["api"]) for r in range(repos)]
+        for i in range(ORGANIZATIONS)}, latency = float(os.environ.get("LOAD_LATENCY", 0.02)))
+    client.configure(transport = upstream.transport())
+    cache.responses.enabled = False
+    cache.profiles.ttl = cache.profiles.stale_ttl = 0
+    logging.getLogger("user_profiles_api").setLevel(logging.WARNING)
+    return asgi.application
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(workers: int, port: int, repos: int, latency: float) -> subprocess.Popen:
+    environment = {**os.environ, "LOAD_REPOS": str(repos), "LOAD_LATENCY": str(latency)}
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "--factory", "bench.load_profile:stub_application",
+        "--port", str(port), "--workers", str(workers), "--log-level", "warning"], env = environment)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health-check").status_code == 200:
+                return server
+        except httpx.TransportError:
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"Server with {workers} workers didn't come up")
+
+async def load(port: int, concurrency: int, duration: float) -> dict:
+    """
+    :param port: port the server listens on
+    :param concurrency: calls in flight at once
+    :param duration: seconds to keep calling for
+    :returns: the completed calls, errors, calls per second and latency percentiles in ms
+    """
+    latencies = []
+    errors = 0
+    stop = time.monotonic() + duration
+
+    async def caller(number: int, session: httpx.AsyncClient):
+        nonlocal errors
+        count = 0
+        while time.monotonic() < stop:
+            organization = f"org-{(number + count * concurrency) % ORGANIZATIONS}"
+            count += 1
+            start = time.monotonic()
+            try:
+                response = await session.get(f"http://127.0.0.1:{port}/profile", params = {"github-org": organization})
+                response.raise_for_status()
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            latencies.append(time.monotonic() - start)
+
+    start = time.monotonic()
+    async with httpx.AsyncClient(timeout = 60, limits = httpx.Limits(max_connections = concurrency)) as session:
+        await asyncio.gather(*[caller(number, session) for number in range(concurrency)])
+    elapsed = time.monotonic() - start
+
+    quantiles = statistics.quantiles(latencies, n = 100) if len(latencies) > 1 else [0] * 99
+    return {"calls": len(latencies), "errors": errors, "calls_per_second": len(latencies) / elapsed,
+        "p50": quantiles[49] * 1000, "p95": quantiles[94] * 1000}
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type = int, nargs = "+", default = [1, 2, 4])
+    parser.add_argument("--concurrency", type = int, default = 32)
+    parser.add_argument("--duration", type = float, default = 10)
+    parser.add_argument("--repos", type = int, default = 1000, help = "repos in each stub org")
+    parser.add_argument("--latency", type = float, default = 0.02, help = "seconds the stub takes to answer")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cpus, {args.concurrency} concurrent /profile calls of {args.repos} repo orgs for {args.duration}s")
+    baseline = None
+    for workers in args.workers:
+        port = free_port()
+        server = start_server(workers, port, args.repos, args.latency)
+        try:
+            result = asyncio.run(load(port, args.concurrency, args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+        baseline = baseline or result["calls_per_second"]
+        print(f"{workers:>3} workers: {result['calls_per_second']:8.1f} calls/s ({result['calls_per_second'] / baseline:.2f}x)"
+            f"  p50 {result['p50']:7.1f}ms  p95 {result['p95']:7.1f}ms  errors {result['errors']}")
+
+if __name__ == "__main__":
+    main()
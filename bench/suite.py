@@ -0,0 +1,162 @@
+"""
+Offline benchmark suite: drives parse_github, parse_bitbucket and the /profile route through the
+stub upstream at 10, 1k and 10k repos, and saves a json report so runs can be compared across commits
+
+    python -m bench.suite [--sizes 10 1000 10000] [--calls 5] [--latency 0.01] [--null-languages 0.05]
+        [--targets parse_github parse_bitbucket profile_route sharded_github] [--processes 4]
+        [--output report.json] [--compare old.json]
+
+sharded_github gathers the org with its pages split across --processes worker processes (see
+app.executor), run it with --processes 1 and then more to see how it scales with cores. The
+workers have their own copy of the stub, so its requests only count those of the first page
+
+Each scenario runs in a fresh process so its peak RSS is its own. The caches are off unless --cache
+is given, so every call crawls the whole org
+"""
+import os
+import json
+import time
+import logging
+import resource
+import argparse
+import platform
+import statistics
+import subprocess
+import concurrent.futures
+import multiprocessing
+
+TARGETS = ["parse_github", "parse_bitbucket", "profile_route", "sharded_github"]
+RESULTS = os.path.join(os.path.dirname(__file__), "results")
+
+def percentiles(latencies: list) -> dict:
+    """
+    :param latencies: seconds each call took
+    :returns: the p50, p95 and p99 in ms
+    """
+    if len(latencies) < 2:
+        return {name: latencies[0] * 1000 if latencies else None for name in ["p50", "p95", "p99"]}
+    quantiles = statistics.quantiles(latencies, n = 100, method = "inclusive")
+    return {"p50": quantiles[49] * 1000, "p95": quantiles[94] * 1000, "p99": quantiles[98] * 1000}
+
+def run_scenario(target: str, repos: int, calls: int, latency: float, null_languages: float, cached: bool,
+        processes: int = None) -> dict:
+    """
+    Calls a target `calls` times against a stub org and team of `repos` repos each, checking every result
+
+    :param target: one of TARGETS
+    :param repos: repos in the stub org and team
+    :param calls: number of calls to time
+    :param latency: seconds the stub takes to answer each request
+    :param null_languages: share of repos listed without a language
+    :param cached: keep the response and profile caches on
+    :optional param processes: worker processes of the sharded targets, defaults to the number of cpus
+    :returns: the scenario's report
+    """
+    from app import cache, client, executor, parsers
+    from app.profile import OrganizationProfile
+    from app.routes import app
+    from test import stub
+
+    upstream = stub.Upstream(github = {"org": stub.github_org("org", repos, null_languages = null_languages)},
+        bitbucket = {"team": stub.bitbucket_team("team", repos, null_languages = null_languages)}, latency = latency)
+    client.configure(transport = upstream.transport())
+    logging.getLogger("user_profiles_api").setLevel(logging.WARNING)
+    cache.responses.enabled = cache.responses.listings = cached
+    if not cached:
+        cache.profiles.ttl = cache.profiles.stale_ttl = 0
+
+    if target == "sharded_github":
+        # started up front so the workers' startup isn't timed
+        executor.start(processes)
+        executor.crawl_pages("github", "org")
+
+    github = stub.github_profile(upstream.github["org"])
+    bitbucket = stub.bitbucket_profile(upstream.bitbucket["team"])
+    test_client = app.test_client()
+
+    def profile_route() -> dict:
+        response = test_client.get("/profile?bitbucket-team=team&github-org=org")
+        assert response.status_code == 200, response.data
+        return response.get_json()
+
+    call, expected = {
+        "parse_github": (lambda: parsers.parse_github("org").dict(), github),
+        "parse_bitbucket": (lambda: parsers.parse_bitbucket("team").dict(), bitbucket),
+        "profile_route": (profile_route, (OrganizationProfile.from_dict(github) + OrganizationProfile.from_dict(bitbucket)).dict()),
+        "sharded_github": (lambda: executor.crawl_pages("github", "org").dict(), github),
+    }[target]
+
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(calls):
+        called = time.perf_counter()
+        result = call()
+        latencies.append(time.perf_counter() - called)
+        assert result == expected, f"{target} gathered {result}, expected {expected}"
+    wall_time = time.perf_counter() - start
+    workers = executor.workers
+    executor.stop()
+
+    return {"target": target, "repos": repos, "calls": calls, "latency": latency, "null_languages": null_languages,
+        "cached": cached, "processes": workers or None, "wall_time": wall_time, "requests": len(upstream.requests), "requests_per_call": len(upstream.requests) / calls,
+        "max_in_flight": upstream.max_in_flight, "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        **percentiles(latencies)}
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report: dict, baseline: dict):
+    """
+    Prints how each scenario of the report did against the same scenario of the baseline
+    """
+    before = {(scenario["target"], scenario["repos"]): scenario for scenario in baseline["scenarios"]}
+    print(f"\ncompared to {baseline.get('commit')} ({baseline.get('timestamp')})")
+    for scenario in report["scenarios"]:
+        old = before.get((scenario["target"], scenario["repos"]))
+        if old is None:
+            continue
+        print(f"{scenario['target']:>16} {scenario['repos']:>6} repos: wall {scenario['wall_time'] / old['wall_time']:5.2f}x"
+            f"  p95 {scenario['p95'] / old['p95']:5.2f}x  requests {scenario['requests_per_call'] - old['requests_per_call']:+8.1f}"
+            f"  rss {scenario['peak_rss_kb'] - old['peak_rss_kb']:+8d}kB")
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [10, 1000, 10000])
+    parser.add_argument("--targets", nargs = "+", choices = TARGETS, default = TARGETS)
+    parser.add_argument("--calls", type = int, default = 5, help = "calls timed per scenario")
+    parser.add_argument("--latency", type = float, default = 0.01, help = "seconds the stub takes to answer")
+    parser.add_argument("--null-languages", type = float, default = 0.05, help = "share of repos listed without a language")
+    parser.add_argument("--cache", action = "store_true", help = "keep the response and profile caches on")
+    parser.add_argument("--processes", type = int, help = "worker processes of sharded_github, defaults to the number of cpus")
+    parser.add_argument("--output", help = "report file, defaults to bench/results/<commit>-<time>.json")
+    parser.add_argument("--compare", help = "earlier report to compare against")
+    args = parser.parse_args()
+
+    report = {"commit": commit(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+        "cpus": os.cpu_count(), "scenarios": []}
+    context = multiprocessing.get_context("spawn")
+    for repos in args.sizes:
+        for target in args.targets:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = context) as executor:
+                scenario = executor.submit(run_scenario, target, repos, args.calls, args.latency, args.null_languages, args.cache,
+                    args.processes).result()
+            report["scenarios"].append(scenario)
+            print(f"{target:>16} {repos:>6} repos: wall {scenario['wall_time']:7.3f}s  p50 {scenario['p50']:8.1f}ms"
+                f"  p95 {scenario['p95']:8.1f}ms  p99 {scenario['p99']:8.1f}ms  {scenario['requests_per_call']:7.1f} requests/call"
+                f"  peak rss {scenario['peak_rss_kb'] / 1024:6.1f}MB")
+
+    output = args.output or os.path.join(RESULTS, f"{report['commit'] or 'local'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok = True)
+    with open(output, "w") as report_file:
+        json.dump(report, report_file, indent = 2)
+    print(f"saved {output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(report, json.load(baseline_file))
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,10 @@
+import os
+
+from app import snapshots
 from app.routes import app
 
+# the debug reloader runs this file in a watcher process too, only the child serves requests
+if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    snapshots.start()
+
 app.run(debug=True)
@@ -0,0 +1,24 @@
+"""
+Production entry point, serves app.asgi with uvicorn across several worker processes
+
+    python serve.py [--host 127.0.0.1] [--port 8000] [--workers N]
+"""
+import os
+import argparse
+
+import uvicorn
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__, formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default = os.environ.get("HOST", "127.0.0.1"))
+    parser.add_argument("--port", type = int, default = int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--workers", type = int, default = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        help = "worker processes, defaults to WEB_CONCURRENCY or the number of cpus")
+    parser.add_argument("--log-level", default = "info")
+    args = parser.parse_args()
+
+    uvicorn.run("app.asgi:application", host = args.host, port = args.port, workers = args.workers,
+        lifespan = "on", log_level = args.log_level)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+import json
+import math
+import random
+import asyncio
+import time
+import hashlib
+from collections import Counter
+from urllib.parse import urlencode
+
+import httpx
+
+GITHUB = "https://api.github.com"
+BITBUCKET = "https://api.bitbucket.org/2.0"
+
+def github_repo(organization: str, index: int, fork: bool = False, language: str = "Python", watchers: int = 1,
+        topics: list = [], languages: dict = None, updated: str = "2020-01-01T00:00:00Z", private: bool = False) -> dict:
+    """
+    Builds a repo entry the way the github org listing returns it
+
+    :param organization: org the repo belongs to
+    :param index: number used to make the repo name unique
+    :optional param updated: updated_at of the repo, the listing can be sorted by it
+    :optional param languages: bytes per language reported by the languages_url of the repo
+    :optional param private: whether the repo is private, the listing only leaves it out with type=public
+    :returns: a repo dict, the languages_url payload is kept under the private `_languages` key
+    """
+    name = f"repo-{index}"
+    return {"id": index, "name": name, "full_name": f"{organization}/{name}", "fork": fork, "language": language,
+        "watchers_count": watchers, "topics": list(topics), "languages_url": f"{GITHUB}/repos/{organization}/{name}/languages",
+        "updated_at": updated, "private": private, "_languages": languages if languages is not None else ({language: 100} if language else {})}
+
+def bitbucket_repo(team: str, index: int, language: str = "python", watchers: int = 1,
+        updated: str = "2020-01-01T00:00:00+00:00") -> dict:
+    """
+    Builds a repo entry the way the bitbucket repositories listing returns it
+
+    :param team: team the repo belongs to
+    :param index: number used to make the repo slug unique
+    :optional param updated: updated_on of the repo, the listing can be sorted by it
+    :returns: a repo dict, the watcher count is kept under the private `_watchers` key
+    """
+    slug = f"repo-{index}"
+    return {"uuid": f"{{{team}-{index}}}", "slug": slug, "full_name": f"{team}/{slug}", "language": language, "updated_on": updated,
+        "links": {"watchers": {"href": f"{BITBUCKET}/repositories/{team}/{slug}/watchers"}}, "_watchers": watchers}
+
+LANGUAGES = ["Python", "JavaScript", "TypeScript", "Go", "Java", "Ruby", "PHP", "C", "C++", "Shell"]
+TOPICS = [f"topic-{i}" for i in range(50)]
+
+def github_org(organization: str, count: int, null_languages: float = 0.05, forks: float = 0.2, seed: int = 0) -> list:
+    """
+    Builds a realistic listing for an org: a mix of languages, some forks, a few topics per repo
+    and a long tail of watchers, the same for the same arguments
+
+    :param organization: org the repos belong to
+    :param count: number of repos
+    :optional param null_languages: share of repos listed with a null language, half of them have
+        languages behind their languages_url and the other half have none
+    :optional param forks: share of repos that are forks
+    :optional param seed: seed of the random choices
+    :returns: list of repo dicts, see github_repo
+    """
+    rng = random.Random(seed)
+    repos = []
+    for index in range(count):
+        language = None if rng.random() < null_languages else rng.choice(LANGUAGES)
+        languages = {rng.choice(LANGUAGES): rng.randint(1, 10000), rng.choice(LANGUAGES): rng.randint(1, 10000)} \
+            if language is None and rng.random() < 0.5 else None
+        repos.append(github_repo(organization, index, fork = rng.random() < forks, language = language,
+            watchers = int(rng.paretovariate(1.5)) - 1, topics = rng.sample(TOPICS, rng.randint(0, 3)), languages = languages))
+    return repos
+
+def bitbucket_team(team: str, count: int, null_languages: float = 0.05, seed: int = 0) -> list:
+    """
+    Builds a realistic listing for a team, see github_org
+
+    :param team: team the repos belong to
+    :param count: number of repos
+    :optional param null_languages: share of repos listed without a language
+    :optional param seed: seed of the random choices
+    :returns: list of repo dicts, see bitbucket_repo
+    """
+    rng = random.Random(seed)
+    return [bitbucket_repo(team, index, language = "" if rng.random() < null_languages else rng.choice(LANGUAGES).lower(),
+        watchers = int(rng.paretovariate(1.5)) - 1) for index in range(count)]
+
+def github_profile(repos: list) -> dict:
+    """
+    :param repos: repo dicts of an org
+    :returns: the profile the parsers should gather for them, as a dict
+    """
+    languages = Counter()
+    for repo in repos:
+        if repo["language"]:
+            languages[repo["language"].lower()] += 1
+        elif repo["_languages"]:
+            languages[max(repo["_languages"].items(), key = lambda item: item[1])[0].lower()] += 1
+        else:
+            languages["none"] += 1
+    return {"repos": sum(1 for repo in repos if not repo["fork"]), "forks": sum(1 for repo in repos if repo["fork"]),
+        "watchers": sum(repo["watchers_count"] for repo in repos), "languages": dict(languages),
+        "topics": dict(Counter(topic for repo in repos for topic in repo["topics"]))}
+
+def bitbucket_profile(repos: list) -> dict:
+    """
+    :param repos: repo dicts of a team
+    :returns: the profile the parsers should gather for them, as a dict
+    """
+    return {"repos": len(repos), "forks": 0, "watchers": sum(repo["_watchers"] for repo in repos),
+        "languages": dict(Counter(repo["language"].lower() or "none" for repo in repos)), "topics": {}}
+
+def wait_for_crawls(timeout: float = 10.0):
+    """
+    Waits for the crawls a deadline left running in the background, so they don't send their
+    requests to the next test's upstream
+    """
+    from app import parsers
+    expires = time.monotonic() + timeout
+    while parsers.crawls and time.monotonic() < expires:
+        time.sleep(0.01)
+
+def _public(repo: dict) -> dict:
+    return {key: value for key, value in repo.items() if not key.startswith("_")}
+
+class Upstream:
+    """
+    Fake github and bitbucket apis served through an httpx.MockTransport so the parsers
+    can be tested without the network
+    """
+    def __init__(self, github: dict = {}, bitbucket: dict = {}, latency: float = 0.0, rate_limit: int = None,
+            rate_window: float = 1.0, max_concurrent: int = None, chunk_size: int = None):
+        """
+        :optional param github: list of repo dicts for each github organization
+        :optional param bitbucket: list of repo dicts for each bitbucket team
+        :optional param latency: seconds to wait before answering each request
+        :optional param rate_limit: requests allowed per window, sent back in X-RateLimit-* headers
+            with a 403 once they're used up, like github's primary rate limit
+        :optional param rate_window: seconds in a rate limit window
+        :optional param max_concurrent: requests in flight above this get a 429, like github's secondary rate limit
+        :optional param chunk_size: bytes per chunk when sending bodies in pieces, None to send them whole
+        """
+        self.github = dict(github)
+        self.bitbucket = dict(bitbucket)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.max_concurrent = max_concurrent
+        self.chunk_size = chunk_size
+        # statuses to answer the next requests with, before anything else
+        self.failures = []
+        self.throttled = 0
+        self.window_start = time.time()
+        self.window_count = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def count(self, fragment: str) -> int:
+        """
+        :param fragment: part of the url to look for
+        :returns: how many requested urls contained the fragment
+        """
+        return sum(1 for url in self.requests if fragment in url)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(str(request.url))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if self.failures:
+                return httpx.Response(self.failures.pop(0))
+            if self.max_concurrent is not None and self.in_flight > self.max_concurrent:
+                self.throttled += 1
+                return httpx.Response(429, json = {"message": "You have exceeded a secondary rate limit"})
+            limited = self.rate_limited()
+            if limited is not None:
+                return limited
+            response = self.respond(request)
+            response.headers.update(self.rate_limit_headers())
+            if response.status_code == 200 and request.method == "GET":
+                etag = '"' + hashlib.md5(response.content).hexdigest() + '"'
+                if request.headers.get("If-None-Match") == etag:
+                    return httpx.Response(304, headers = {"ETag": etag})
+                response.headers["ETag"] = etag
+            if self.chunk_size:
+                response = httpx.Response(response.status_code, headers = response.headers, content = self.chunks(response.content))
+            return response
+        finally:
+            self.in_flight -= 1
+
+    async def chunks(self, content: bytes):
+        for start in range(0, len(content), self.chunk_size):
+            yield content[start:start + self.chunk_size]
+
+    def rate_limit_headers(self) -> dict:
+        if self.rate_limit is None:
+            return {}
+        return {"X-RateLimit-Limit": str(self.rate_limit), "X-RateLimit-Remaining": str(max(self.rate_limit - self.window_count, 0)),
+            "X-RateLimit-Reset": str(math.ceil(self.window_start + self.rate_window))}
+
+    def rate_limited(self):
+        """
+        Counts the request against the rate limit
+
+        :returns: a 403 response if the limit is used up, otherwise None
+        """
+        if self.rate_limit is None:
+            return None
+        if time.time() >= self.window_start + self.rate_window:
+            self.window_start = time.time()
+            self.window_count = 0
+        if self.window_count >= self.rate_limit:
+            self.throttled += 1
+            return httpx.Response(403, headers = self.rate_limit_headers(), json = {"message": "API rate limit exceeded"})
+        self.window_count += 1
+        return None
+
+    def respond(self, request: httpx.Request) -> httpx.Response:
+        url = request.url
+        parts = url.path.strip("/").split("/")
+        if url.host == "api.github.com":
+            if url.path == "/graphql" and request.method == "POST":
+                return self.github_graphql(request)
+            if len(parts) == 2 and parts[0] == "orgs" and parts[1] in self.github:
+                return httpx.Response(200, json = {"login": parts[1],
+                    "public_repos": sum(1 for repo in self.github[parts[1]] if not repo.get("private"))})
+            if len(parts) == 3 and parts[0] == "orgs" and parts[2] == "repos" and parts[1] in self.github:
+                return self.github_page(request, self.github[parts[1]])
+            if len(parts) == 4 and parts[0] == "repos" and parts[3] == "languages":
+                for repo in self.github.get(parts[1], []):
+                    if repo["name"] == parts[2]:
+                        return httpx.Response(200, json = repo["_languages"])
+        elif url.host == "api.bitbucket.org":
+            if len(parts) == 3 and parts[1] == "repositories" and parts[2] in self.bitbucket:
+                return self.bitbucket_page(request, self.bitbucket[parts[2]])
+            if len(parts) == 5 and parts[1] == "repositories" and parts[4] == "watchers":
+                for repo in self.bitbucket.get(parts[2], []):
+                    if repo["slug"] == parts[3]:
+                        if request.url.params.get("fields") == "size":
+                            return httpx.Response(200, json = {"size": repo["_watchers"]})
+                        return httpx.Response(200, json = {"pagelen": 10, "values": [], "page": 1, "size": repo["_watchers"]})
+        return httpx.Response(404, json = {"message": "Not Found"})
+
+    def github_page(self, request: httpx.Request, repos: list) -> httpx.Response:
+        per_page = min(int(request.url.params.get("per_page", 30)), 100)
+        page = int(request.url.params.get("page", 1))
+        last = max(math.ceil(len(repos) / per_page), 1)
+        if request.url.params.get("type") == "public":
+            repos = [repo for repo in repos if not repo.get("private")]
+        if request.url.params.get("sort") == "updated":
+            repos = sorted(repos, key = lambda repo: repo["updated_at"], reverse = request.url.params.get("direction") == "desc")
+        values = [_public(repo) for repo in repos[(page - 1) * per_page:page * per_page]]
+
+        links = []
+        base = str(request.url.copy_with(query = None))
+        params = dict(request.url.params)
+        if page < last:
+            links.append(f'<{base}?{urlencode({**params, "per_page": per_page, "page": page + 1})}>; rel="next"')
+            links.append(f'<{base}?{urlencode({**params, "per_page": per_page, "page": last})}>; rel="last"')
+        headers = {"Link": ", ".join(links)} if links else {}
+        return httpx.Response(200, json = values, headers = headers)
+
+    def bitbucket_page(self, request: httpx.Request, repos: list) -> httpx.Response:
+        pagelen = min(int(request.url.params.get("pagelen", 10)), 100)
+        page = int(request.url.params.get("page", 1))
+        if request.url.params.get("sort", "").lstrip("-") == "updated_on":
+            repos = sorted(repos, key = lambda repo: repo["updated_on"], reverse = request.url.params["sort"].startswith("-"))
+        values = [_public(repo) for repo in repos[(page - 1) * pagelen:page * pagelen]]
+
+        body = {"pagelen": pagelen, "values": values, "page": page, "size": len(repos)}
+        if page * pagelen < len(repos):
+            base = str(request.url.copy_with(query = None))
+            body["next"] = f"{base}?{urlencode({**dict(request.url.params), 'pagelen': pagelen, 'page': page + 1})}"
+        return httpx.Response(200, json = body)
+
+    def github_graphql(self, request: httpx.Request) -> httpx.Response:
+        """
+        Answers the repositories query of the graphql api, 100 repos per page with the
+        cursor being the offset of the next page
+        """
+        variables = json.loads(request.content)["variables"]
+        if variables["organization"] not in self.github:
+            return httpx.Response(200, json = {"data": {"organization": None},
+                "errors": [{"type": "NOT_FOUND", "message": "Could not resolve to an Organization"}]})
+
+        repos = self.github[variables["organization"]]
+        offset = int(variables["cursor"] or 0)
+        nodes = []
+        for repo in repos[offset:offset + 100]:
+            ranked = sorted(repo["_languages"].items(), key = lambda item: -item[1])
+            nodes.append({"isFork": repo["fork"], "stargazerCount": repo["watchers_count"],
+                "primaryLanguage": {"name": repo["language"]} if repo["language"] else None,
+                "languages": {"nodes": [{"name": name} for name, size in ranked[:1]]},
+                "repositoryTopics": {"nodes": [{"topic": {"name": topic}} for topic in repo["topics"]]}})
+
+        page_info = {"hasNextPage": offset + 100 < len(repos), "endCursor": str(offset + 100)}
+        return httpx.Response(200, json = {"data": {"organization": {"repositories": {"pageInfo": page_info, "nodes": nodes}}}})
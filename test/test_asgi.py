@@ -0,0 +1,152 @@
+import json
+import asyncio
+import unittest
+
+import httpx
+
+from app import asgi, cache, client
+
+from test import stub
+
+class TestAsgiStub(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream(github = {"org": [stub.github_repo("org", i, topics = ["api"]) for i in range(150)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", i, watchers = 2) for i in range(20)]}, latency = 0.05)
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        cache.profiles.clear()
+
+    def tearDown(self):
+        client.configure(transport = None)
+
+    def serve(self, requests):
+        """
+        Runs the app through its startup, `requests` and shutdown on a fresh event loop
+
+        :param requests: coroutine function that takes an httpx.AsyncClient talking to the app
+        :returns: whatever `requests` returns
+        """
+        async def main():
+            received = asyncio.Queue()
+            sent = asyncio.Queue()
+            lifespan = asyncio.ensure_future(asgi.application({"type": "lifespan"}, received.get, sent.put))
+
+            await received.put({"type": "lifespan.startup"})
+            self.assertEqual((await sent.get())["type"], "lifespan.startup.complete")
+            try:
+                async with httpx.AsyncClient(transport = httpx.ASGITransport(app = asgi.application), base_url = "http://test") as session:
+                    return await requests(session)
+            finally:
+                await received.put({"type": "lifespan.shutdown"})
+                self.assertEqual((await sent.get())["type"], "lifespan.shutdown.complete")
+                await lifespan
+        return asyncio.run(main())
+
+    def test_profile(self):
+        async def requests(session):
+            return await session.get("/profile", params = {"bitbucket-team": "team", "github-org": "org"})
+        response = self.serve(requests)
+
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result["repos"], 170)
+        self.assertEqual(result["watchers"], 190)
+        self.assertEqual(result["topics"], {"api": 150})
+
+    def test_concurrent_profiles(self):
+        # every call awaits the upstream on the same loop, so they overlap instead of queueing
+        self.upstream.github.update({f"org-{i}": [stub.github_repo(f"org-{i}", 0)] for i in range(20)})
+        async def requests(session):
+            return await asyncio.gather(*[session.get("/profile", params = {"github-org": f"org-{i}"}) for i in range(20)])
+        responses = self.serve(requests)
+
+        self.assertTrue(all(response.json()["repos"] == 1 for response in responses))
+        self.assertGreater(self.upstream.max_in_flight, 10)
+
+    def test_profiles(self):
+        async def requests(session):
+            return (await session.post("/profiles", content = json.dumps({"bitbucket-teams": ["team"], "github-orgs": ["org", "missing"]})),
+                await session.post("/profiles", content = b"not json"))
+        response, invalid = self.serve(requests)
+
+        result = response.json()
+        self.assertEqual(result["total"]["repos"], 170)
+        self.assertIn("missing", result["errors"]["github"])
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_metrics(self):
+        async def requests(session):
+            return (await session.get("/profile", params = {"github-org": "org", "debug-timing": "1"}),
+                await session.get("/metrics"))
+        response, exposition = self.serve(requests)
+
+        self.assertIn("github.listing", response.json()["timing"]["phases"])
+        self.assertEqual(exposition.status_code, 200)
+        self.assertIn("# TYPE upstream_requests_total counter", exposition.text)
+
+    def test_profile_stream(self):
+        async def requests(session):
+            async with session.stream("GET", "/profile", params = {"bitbucket-team": "team", "github-org": "org", "stream": "1"}) as response:
+                return response, [json.loads(line) async for line in response.aiter_lines() if line]
+        response, lines = self.serve(requests)
+
+        self.assertEqual(response.headers["content-type"], "application/x-ndjson")
+        self.assertNotIn("content-length", response.headers)
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(lines[-1]["done"])
+        self.assertEqual(lines[-1]["repos"], 170)
+        self.assertEqual(lines[-1]["watchers"], 190)
+
+    def test_profile_fields(self):
+        async def requests(session):
+            return await session.get("/profile", params = {"bitbucket-team": "team", "github-org": "org", "fields": "repos,topics"})
+        result = self.serve(requests).json()
+
+        self.assertDictEqual(result, {"repos": 170, "topics": {"api": 150}})
+        self.assertEqual(self.upstream.count("/watchers"), 0)
+
+    def test_profile_top(self):
+        async def requests(session):
+            return await session.get("/profile", params = {"bitbucket-team": "team", "github-org": "org", "top": "1"})
+        result = self.serve(requests).json()
+
+        # every repo is in python and has the api topic, so nothing was left out
+        self.assertDictEqual(result["languages"], {"python": 170})
+        self.assertDictEqual(result["topics"], {"api": 150})
+        self.assertDictEqual(result["bounds"], {"languages": 0, "topics": 0})
+
+    def test_profile_deadline(self):
+        async def requests(session):
+            return await session.get("/profile", params = {"bitbucket-team": "team", "github-org": "org", "deadline": "0.01"})
+        result = self.serve(requests).json()
+
+        self.assertDictEqual(result["complete"], {"bitbucket": False, "github": False})
+        self.assertLess(result["repos"], 170)
+
+    def test_blank_args(self):
+        # validated like the flask routes do, not dropped
+        async def requests(session):
+            return [await session.get("/profile", params = {"github-org": "org", arg: ""}) for arg in ["fields", "deadline", "top"]]
+        self.assertEqual([response.status_code for response in self.serve(requests)], [400, 400, 400])
+
+    def test_routing(self):
+        async def requests(session):
+            await session.get("/profile", params = {"github-org": "org"})
+            return [await session.get("/health-check"), await session.get("/nowhere"), await session.post("/profile"),
+                await session.get("/pool-stats")]
+        health, missing, method, pool = self.serve(requests)
+
+        self.assertEqual(health.text, "All Good!")
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(method.status_code, 405)
+        # the pool of the serving loop, not the background one
+        self.assertIn("api.github.com", pool.json()["hosts"])
+
+    def test_shutdown_closes_client(self):
+        async def requests(session):
+            await session.get("/profile", params = {"github-org": "org"})
+            return asyncio.get_running_loop()
+        loop = self.serve(requests)
+
+        self.assertEqual(client.pool_stats(loop)["hosts"], {})
+        self.assertEqual(cache.profiles.stats["misses"], 0)
@@ -0,0 +1,225 @@
+import time
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+from app import cache, client, parsers, profile, routes
+
+from test import stub
+
+class TestResponseCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        backend = cache.MemoryBackend(max_entries = 2)
+        for key in ["a", "b"]:
+            backend.set(key, cache.CachedResponse(key.encode(), [], time.monotonic() + 60))
+
+        # reading "a" makes "b" the least recently used
+        self.assertEqual(backend.get("a").content, b"a")
+        backend.set("c", cache.CachedResponse(b"c", [], time.monotonic() + 60))
+
+        self.assertEqual(len(backend), 2)
+        self.assertIsNone(backend.get("b"))
+        self.assertIsNotNone(backend.get("a"))
+        self.assertIsNotNone(backend.get("c"))
+
+    def test_byte_limit(self):
+        backend = cache.MemoryBackend(max_bytes = 10)
+        for key in ["a", "b", "c"]:
+            backend.set(key, cache.CachedResponse(key.encode() * 4, [], time.monotonic() + 60))
+
+        # "a" went to make room for "c"
+        self.assertEqual(len(backend), 2)
+        self.assertEqual(backend.size, 8)
+        self.assertIsNone(backend.get("a"))
+
+        # replacing an entry counts its new size only, and a body over the limit isn't kept
+        backend.set("b", cache.CachedResponse(b"bb", [], time.monotonic() + 60))
+        self.assertEqual(backend.size, 6)
+        backend.set("d", cache.CachedResponse(b"d" * 11, [], time.monotonic() + 60))
+        self.assertIsNone(backend.get("d"))
+        self.assertEqual(backend.size, 6)
+
+        backend.clear()
+        self.assertEqual(backend.size, 0)
+
+    def test_key(self):
+        responses = cache.ResponseCache()
+        plain = responses.key("https://api.github.com/orgs/org/repos", {})
+        preview = responses.key("https://api.github.com/orgs/org/repos", {"Accept": "application/vnd.github.mercy-preview+json"})
+        authorized = responses.key("https://api.github.com/orgs/org/repos", {"Authorization": "bearer secret"})
+
+        self.assertNotEqual(plain, preview)
+        self.assertNotEqual(plain, authorized)
+        self.assertNotIn("secret", authorized)
+
+        # headers that don't affect the response are left out
+        self.assertEqual(plain, responses.key("https://api.github.com/orgs/org/repos", {"User-Agent": "test"}))
+
+    def test_conditional_headers(self):
+        responses = cache.ResponseCache()
+        entry = cache.CachedResponse(b"{}", [("ETag", '"abc"'), ("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")], 0)
+        self.assertDictEqual(responses.conditional_headers(entry),
+            {"If-None-Match": '"abc"', "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"})
+
+class TestResponseCacheRequests(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream(github = {"org": [stub.github_repo("org", i) for i in range(3)]})
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        cache.responses.listings = True
+
+    def tearDown(self):
+        client.configure(transport = None)
+        cache.responses.ttl = 60.0
+        cache.responses.listings = False
+
+    def test_fresh_hit(self):
+        first = parsers.parse_github("org")
+        second = parsers.parse_github("org")
+
+        self.assertEqual(first.dict(), second.dict())
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 1)
+        self.assertEqual(cache.responses.stats["misses"], 1)
+        self.assertEqual(cache.responses.stats["hits"], 1)
+
+    def test_stale_revalidated(self):
+        cache.responses.ttl = 0
+        first = parsers.parse_github("org")
+        second = parsers.parse_github("org")
+
+        # the second listing is asked for again, but only with a 304 for an answer
+        self.assertEqual(first.dict(), second.dict())
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 2)
+        self.assertEqual(cache.responses.stats["revalidations"], 1)
+        self.assertEqual(cache.responses.stats["revalidated"], 1)
+
+    def test_stale_changed(self):
+        cache.responses.ttl = 0
+        parsers.parse_github("org")
+        self.upstream.github["org"].append(stub.github_repo("org", 3))
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos, 4)
+        self.assertEqual(cache.responses.stats["revalidated"], 0)
+
+    def test_disabled(self):
+        cache.responses.enabled = False
+        try:
+            parsers.parse_github("org")
+            parsers.parse_github("org")
+            self.assertEqual(self.upstream.count("/orgs/org/repos"), 2)
+        finally:
+            cache.responses.enabled = True
+
+    def test_listings_not_kept_by_default(self):
+        cache.responses.listings = False
+        parsers.parse_github("org")
+        parsers.parse_github("org")
+
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 2)
+        self.assertEqual(len(cache.responses.backend), 0)
+
+class TestProfileCache(unittest.TestCase):
+    def setUp(self):
+        self.profiles = cache.ProfileCache(ttl = 60, stale_ttl = 600)
+        self.calls = 0
+
+    async def fetch(self):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return profile.OrganizationProfile(repos = self.calls)
+
+    def test_single_flight(self):
+        async def burst():
+            return await asyncio.gather(*[self.profiles.get("github", "org", self.fetch) for _ in range(10)])
+
+        results = asyncio.run(burst())
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(self.profiles.stats["misses"], 1)
+        self.assertEqual(self.profiles.stats["coalesced"], 9)
+
+    def test_hit(self):
+        async def twice():
+            first = await self.profiles.get("github", "org", self.fetch)
+            second = await self.profiles.get("github", "org", self.fetch)
+            return first, second
+
+        first, second = asyncio.run(twice())
+        self.assertIs(first, second)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.profiles.stats["hits"], 1)
+
+    def test_per_provider(self):
+        async def both():
+            await self.profiles.get("github", "org", self.fetch)
+            await self.profiles.get("bitbucket", "org", self.fetch)
+
+        asyncio.run(both())
+        self.assertEqual(self.calls, 2)
+
+    def test_stale_while_revalidate(self):
+        self.profiles.ttl = 0
+
+        async def stale():
+            first = await self.profiles.get("github", "org", self.fetch)
+            # served the old profile straight away while the refresh runs
+            second = await self.profiles.get("github", "org", self.fetch)
+            await asyncio.sleep(0.05)
+            self.profiles.ttl = 60
+            third = await self.profiles.get("github", "org", self.fetch)
+            return first, second, third
+
+        first, second, third = asyncio.run(stale())
+        self.assertIs(first, second)
+        self.assertEqual(third.repos, 2)
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(self.profiles.stats["stale"], 1)
+
+    def test_failure_not_cached(self):
+        async def failing():
+            self.calls += 1
+            raise ConnectionError("Failed to recieve data")
+
+        async def twice():
+            for _ in range(2):
+                with self.assertRaises(ConnectionError):
+                    await self.profiles.get("github", "org", failing)
+
+        asyncio.run(twice())
+        self.assertEqual(self.calls, 2)
+
+class TestProfileCacheRoutes(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream(github = {"org": [stub.github_repo("org", i) for i in range(3)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", i) for i in range(2)]}, latency = 0.05)
+        client.configure(transport = self.upstream.transport())
+        cache.responses.enabled = False
+        cache.profiles.clear()
+
+    def tearDown(self):
+        client.configure(transport = None)
+        cache.responses.enabled = True
+        cache.profiles.clear()
+
+    def test_concurrent_requests_coalesced(self):
+        test_client = routes.app.test_client()
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda _: test_client.get("/profile?bitbucket-team=team&github-org=org").get_json(), range(8)))
+
+        self.assertTrue(all(result == results[0] for result in results))
+        self.assertEqual(results[0]["repos"], 5)
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 1)
+        self.assertEqual(self.upstream.count("/repositories/team?"), 1)
+
+    def test_new_pairing_is_free(self):
+        self.upstream.github["other"] = [stub.github_repo("other", 0)]
+        parsers.parse_profile("team", "org")
+        parsers.parse_profile(None, "other")
+        requests = len(self.upstream.requests)
+
+        # both halves are cached already
+        test = parsers.parse_profile("team", "other")
+        self.assertEqual(test.repos, 3)
+        self.assertEqual(len(self.upstream.requests), requests)
@@ -0,0 +1,71 @@
+import json
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import app
+from app import cache, client, parsers
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = json.dumps({"path": self.path}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        client.reset()
+        cache.responses.clear()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        client.reset()
+
+    def test_connections_are_reused(self):
+        for i in range(5):
+            test = client.run(parsers.get_request_json(f"{self.url}/{i}"))
+            self.assertEqual(test, {"path": f"/{i}"})
+
+        stats = client.pool_stats()
+        self.assertEqual(stats["requests"], 5)
+        self.assertEqual(stats["opened"], 1)
+        self.assertEqual(stats["reused"], 4)
+        self.assertEqual(stats["open"], 1)
+        self.assertEqual(stats["idle"], 1)
+
+    def test_multiple_share_pool(self):
+        client.configure(max_connections_per_host = 2)
+        try:
+            test = client.run(parsers.get_multiple_json([f"{self.url}/{i}" for i in range(10)]))
+            self.assertEqual([result["path"] for result in test], [f"/{i}" for i in range(10)])
+
+            # never more connections than the per host cap
+            stats = client.pool_stats()
+            self.assertEqual(stats["requests"], 10)
+            self.assertLessEqual(stats["opened"], 2)
+        finally:
+            client.configure(max_connections_per_host = 20)
+
+    def test_same_client_per_loop(self):
+        async def clients():
+            return client.get_client(), client.get_client()
+
+        first, second = client.run(clients())
+        self.assertIs(first, second)
+        self.assertIs(client.run(clients())[0], first)
+
+    def test_configure_unknown(self):
+        with self.assertRaises(KeyError):
+            client.configure(not_a_setting = 1)
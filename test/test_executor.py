@@ -0,0 +1,91 @@
+import unittest
+
+from app import cache, client, executor
+from app.profile import OrganizationProfile
+from app.routes import app
+
+from test import stub
+
+class TestExecutorStub(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the workers get their own copy of the stub when they start, so it's set up once for every test
+        cls.upstream = stub.Upstream(github = {"org": stub.github_org("org", 1500, null_languages = 0.1),
+                **{f"org-{i}": stub.github_org(f"org-{i}", 120, seed = i) for i in range(6)}},
+            bitbucket = {"team": stub.bitbucket_team("team", 1500)})
+        client.configure(transport = cls.upstream.transport())
+        cache.responses.clear()
+        cache.profiles.clear()
+        executor.start(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        executor.stop()
+        client.configure(transport = None)
+
+    def setUp(self):
+        cache.responses.clear()
+        cache.profiles.clear()
+        self.processes = executor.PROCESSES
+        executor.PROCESSES = 2
+
+    def tearDown(self):
+        executor.PROCESSES = self.processes
+
+    def test_shards(self):
+        self.assertEqual(executor.shards(list(range(7)), 3), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(executor.shards([1], 4), [[1]])
+        self.assertEqual(executor.shards([], 4), [])
+
+    def test_compact(self):
+        profile = OrganizationProfile(3, 1, 7, {"python": 2, "go": 1}, {"api": 1})
+        self.assertEqual(executor.expand(executor.compact(profile)).dict(), profile.dict())
+
+    def test_crawl(self):
+        organizations = [f"org-{i}" for i in range(6)]
+        results = executor.crawl(["team", "missing"], organizations + ["org-0"])
+
+        self.assertEqual(list(results["github"]), organizations)
+        for organization in organizations:
+            self.assertDictEqual(results["github"][organization].dict(), stub.github_profile(self.upstream.github[organization]))
+        self.assertDictEqual(results["bitbucket"]["team"].dict(), stub.bitbucket_profile(self.upstream.bitbucket["team"]))
+        self.assertIsInstance(results["bitbucket"]["missing"], ConnectionError)
+
+    def test_crawl_pages(self):
+        self.assertDictEqual(executor.crawl_pages("github", "org").dict(), stub.github_profile(self.upstream.github["org"]))
+        self.assertDictEqual(executor.crawl_pages("bitbucket", "team").dict(), stub.bitbucket_profile(self.upstream.bitbucket["team"]))
+
+        # fields are passed on to the workers
+        result = executor.crawl_pages("bitbucket", "team", fields = {"repos"})
+        self.assertEqual((result.repos, result.watchers), (1500, 0))
+
+    def test_crawl_pages_missing(self):
+        with self.assertRaises(ConnectionError):
+            executor.crawl_pages("github", "missing")
+
+    def test_profiles_route(self):
+        result = app.test_client().post('/profiles', json = {'bitbucket-teams': ['team'], 'github-orgs': ['org-0', 'org-1']})
+        self.assertEqual(result.status_code, 200)
+
+        expected = OrganizationProfile.merge_many(OrganizationProfile.from_dict(profile) for profile in [
+            stub.bitbucket_profile(self.upstream.bitbucket["team"]), stub.github_profile(self.upstream.github["org-0"]),
+            stub.github_profile(self.upstream.github["org-1"])])
+        self.assertDictEqual(result.get_json()["total"], expected.dict())
+
+    def test_profiles_cached(self):
+        # what this process already has isn't sent to the workers, whose upstream doesn't know "cached"
+        cached = OrganizationProfile(repos = 7, languages = {"c": 7})
+        cache.profiles.store("github", "cached", cached)
+        results = executor.crawl([], ["cached", "org-2"])
+        self.assertDictEqual(results["github"]["cached"].dict(), cached.dict())
+
+        # and what they gather is cached here
+        self.assertDictEqual(cache.profiles.peek("github", "org-2").dict(), stub.github_profile(self.upstream.github["org-2"]))
+
+    def test_profile_route_sharded(self):
+        listed = self.upstream.count("/orgs/org/repos")
+        result = app.test_client().get('/profile?github-org=org')
+        self.assertEqual(result.status_code, 200)
+        self.assertDictEqual(result.get_json(), stub.github_profile(self.upstream.github["org"]))
+        # only the first page was listed here, the workers listed the other 14
+        self.assertEqual(self.upstream.count("/orgs/org/repos") - listed, 1)
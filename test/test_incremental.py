@@ -0,0 +1,119 @@
+import unittest
+
+import app
+from app import cache, client, incremental, parsers, snapshots
+
+from test import stub
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream(
+            github = {"org": [stub.github_repo("org", i, language = None if i % 10 == 0 else "Python", topics = ["api"] if i % 2 else [],
+                languages = {"Go": 100} if i % 10 == 0 else None) for i in range(250)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", i, watchers = i % 3) for i in range(150)]})
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        self.store = snapshots.SnapshotStore(":memory:")
+
+    def tearDown(self):
+        self.store.close()
+        client.configure(transport = None)
+
+    def refresh(self, provider: str, organization: str):
+        # refreshes are further apart than the response cache keeps pages
+        cache.responses.clear()
+        refresh = client.run(incremental.refresher(provider, self.store)(organization))
+        self.store.save(provider, organization, refresh.profile, changed = refresh.changed, removed = refresh.removed)
+        return refresh
+
+    def test_first_refresh(self):
+        refresh = self.refresh("github", "org")
+
+        self.assertEqual(len(refresh.changed), 250)
+        self.assertEqual(len(self.store.index("github", "org")), 250)
+        self.assertEqual(refresh.profile.dict(), parsers.parse_github("org").dict())
+
+    def test_github_changed_repo(self):
+        self.refresh("github", "org")
+        requests = len(self.upstream.requests)
+
+        repos = self.upstream.github["org"]
+        repos[5] = stub.github_repo("org", 5, language = None, languages = {"Rust": 10}, watchers = 10, updated = "2021-01-01T00:00:00Z")
+        repos.append(stub.github_repo("org", 250, fork = True, updated = "2021-01-02T00:00:00Z"))
+        refresh = self.refresh("github", "org")
+
+        # one page of the sorted listing, the org details, and the language of the changed repo
+        new = self.upstream.requests[requests:]
+        self.assertEqual(sum(1 for url in new if "/orgs/org/repos" in url), 1)
+        self.assertEqual(sum(1 for url in new if "/languages" in url), 1)
+        self.assertEqual(sorted(refresh.changed), ["250", "5"])
+        self.assertEqual(refresh.removed, [])
+
+        cache.responses.clear()
+        self.assertEqual(refresh.profile.dict(), parsers.parse_github("org").dict())
+
+    def test_github_private_repos(self):
+        # an org member's token lists the private repos too, unless only the public ones are asked for
+        self.upstream.github["org"].append(stub.github_repo("org", 250, private = True, updated = "2021-01-01T00:00:00Z"))
+        self.refresh("github", "org")
+        requests = len(self.upstream.requests)
+        refresh = self.refresh("github", "org")
+
+        self.assertEqual(sum(1 for url in self.upstream.requests[requests:] if "/orgs/org/repos" in url), 1)
+        self.assertEqual(refresh.profile.repos, 250)
+
+    def test_github_deleted_repo(self):
+        self.refresh("github", "org")
+        del self.upstream.github["org"][7]
+        refresh = self.refresh("github", "org")
+
+        # the count didn't add up, so everything was listed again
+        self.assertEqual(refresh.removed, ["7"])
+        self.assertEqual(len(self.store.index("github", "org")), 249)
+        cache.responses.clear()
+        self.assertEqual(refresh.profile.dict(), parsers.parse_github("org").dict())
+
+    def test_bitbucket_changed_repo(self):
+        self.refresh("bitbucket", "team")
+        requests = len(self.upstream.requests)
+
+        self.upstream.bitbucket["team"][3] = stub.bitbucket_repo("team", 3, language = "go", watchers = 9,
+            updated = "2021-01-01T00:00:00+00:00")
+        refresh = self.refresh("bitbucket", "team")
+
+        new = self.upstream.requests[requests:]
+        self.assertEqual(sum(1 for url in new if url.endswith("/watchers?fields=size")), 1)
+        self.assertEqual(sum(1 for url in new if "/repositories/team?" in url), 1)
+        self.assertEqual(list(refresh.changed), ["{team-3}"])
+
+        cache.responses.clear()
+        self.assertEqual(refresh.profile.dict(), parsers.parse_bitbucket("team").dict())
+
+    def test_bitbucket_deleted_repo(self):
+        self.refresh("bitbucket", "team")
+        del self.upstream.bitbucket["team"][0]
+        refresh = self.refresh("bitbucket", "team")
+
+        self.assertEqual(refresh.removed, ["{team-0}"])
+        cache.responses.clear()
+        self.assertEqual(refresh.profile.dict(), parsers.parse_bitbucket("team").dict())
+
+    def test_bitbucket_full_refresh(self):
+        refresh = incremental.refresher("bitbucket", self.store, full_every = 2)
+        def run():
+            cache.responses.clear()
+            result = client.run(refresh("team"))
+            self.store.save("bitbucket", "team", result.profile, changed = result.changed, removed = result.removed)
+            return result
+
+        run()
+        # new watchers don't bump updated_on, the incremental refreshes can't see them
+        self.upstream.bitbucket["team"][0]["_watchers"] += 10
+        self.assertTrue(run().incremental)
+        self.assertTrue(run().incremental)
+        self.assertEqual(self.store.get("bitbucket", "team").profile.watchers, 150)
+
+        result = run()
+        self.assertFalse(result.incremental)
+        self.assertEqual(result.profile.watchers, 160)
+        self.assertTrue(run().incremental)
@@ -0,0 +1,102 @@
+import unittest
+
+from app import cache, client, metrics
+from app.routes import app
+
+from test import stub
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.enabled = metrics.enabled
+        metrics.enabled = True
+
+    def tearDown(self):
+        metrics.enabled = self.enabled
+
+    def test_render(self):
+        counter = metrics.Counter("test_render_total", "Things counted", ["kind"])
+        histogram = metrics.Histogram("test_render_seconds", "Things timed", buckets = (0.1, 1.0))
+        counter.inc("a")
+        counter.inc("a", amount = 2)
+        counter.inc('b"c')
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = metrics.render().splitlines()
+
+        self.assertIn("# TYPE test_render_total counter", lines)
+        self.assertIn('test_render_total{kind="a"} 3', lines)
+        self.assertIn('test_render_total{kind="b\\"c"} 1', lines)
+        self.assertIn("# TYPE test_render_seconds histogram", lines)
+        self.assertIn('test_render_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_render_seconds_bucket{le="1.0"} 2', lines)
+        self.assertIn('test_render_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("test_render_seconds_count 3", lines)
+
+    def test_disabled(self):
+        counter = metrics.Counter("test_disabled_total", "Things counted")
+        metrics.enabled = False
+        counter.inc()
+        self.assertIs(metrics.span("phase"), metrics.NO_SPAN)
+        self.assertEqual(counter.values, {})
+
+        # a request that asked for its timing still gets it
+        with metrics.tracing(metrics.Trace()) as trace:
+            with metrics.span("phase"):
+                pass
+        self.assertEqual(trace.report()["phases"]["phase"]["count"], 1)
+
+    def test_trace_spans_capped(self):
+        trace = metrics.Trace()
+        for _ in range(metrics.Trace.MAX_SPANS + 10):
+            trace.add("phase", 0.001)
+        report = trace.report()
+
+        self.assertEqual(len(report["spans"]), metrics.Trace.MAX_SPANS)
+        self.assertEqual(report["phases"]["phase"]["count"], metrics.Trace.MAX_SPANS + 10)
+
+class TestMetricsStub(unittest.TestCase):
+    def setUp(self):
+        app.testing = True
+        self.client = app.test_client()
+        self.upstream = stub.Upstream(github = {"org": stub.github_org("org", 250, null_languages = 0.1)},
+            bitbucket = {"team": stub.bitbucket_team("team", 30)})
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        cache.profiles.clear()
+        self.enabled = metrics.enabled
+        metrics.enabled = True
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.enabled = self.enabled
+        client.configure(transport = None)
+
+    def test_debug_timing(self):
+        result = self.client.get('/profile?bitbucket-team=team&github-org=org&debug-timing=1').get_json()
+
+        # the spans made it across to the background event loop
+        phases = result["timing"]["phases"]
+        for phase in ["profile", "bitbucket.listing", "bitbucket.watchers", "github.listing", "github.languages", "parse"]:
+            self.assertIn(phase, phases)
+        self.assertEqual(phases["upstream api.github.com"]["count"], self.upstream.count("api.github.com"))
+        self.assertEqual(phases["upstream api.bitbucket.org"]["count"], self.upstream.count("api.bitbucket.org"))
+        self.assertEqual(result["repos"] + result["forks"], 280)
+
+        # only when asked for
+        cache.profiles.clear()
+        self.assertNotIn("timing", self.client.get('/profile?github-org=org').get_json())
+
+    def test_metrics_endpoint(self):
+        self.client.get('/profile?bitbucket-team=team&github-org=org')
+        self.client.get('/profile?bitbucket-team=team&github-org=org')
+        result = self.client.get('/metrics')
+        lines = result.data.decode().splitlines()
+
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(result.content_type.startswith("text/plain"))
+        self.assertIn(f'upstream_requests_total{{host="api.github.com",status="200"}} {self.upstream.count("api.github.com")}', lines)
+        self.assertIn('upstream_request_seconds_count{host="api.bitbucket.org"} 31', lines)
+        self.assertIn('profile_cache_lookups_total{result="hits"} 2', lines)
+        self.assertIn('upstream_retries_total{host="api.github.com"} 0', lines)
+        self.assertTrue(any(line.startswith('profile_phase_seconds_count{phase="github.languages"}') for line in lines))
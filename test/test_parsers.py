@@ -4,7 +4,10 @@ import unittest
 from collections import defaultdict
 
 import app
-from app import parsers
+from app import cache, client, parsers
+from app.profile import OrganizationProfile
+
+from test import stub
 
 
 class TestParsers(unittest.TestCase):
@@ -68,4 +71,232 @@ class TestParsers(unittest.TestCase):
         self.assertEqual(test.watchers, 3237)
         self.assertDictEqual(dict(test.languages), {"c": 1, "python": 7, "ruby": 1})
         self.assertDictEqual(dict(test.topics), {"flask": 1, "game-dev": 1, "game-development": 1, "gamedev": 1,
-                                                 "pygame": 2, "python": 2, "sdl": 1, "sdl2": 1, "sqlalchemy": 1})
\ No newline at end of file
+                                                 "pygame": 2, "python": 2, "sdl": 1, "sdl2": 1, "sqlalchemy": 1})
+
+
+class TestParsersStub(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream()
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+
+    def tearDown(self):
+        client.configure(transport = None)
+
+    def test_parse_bitbucket_pages(self):
+        languages = ["python", "java", None]
+        self.upstream.bitbucket["team"] = [stub.bitbucket_repo("team", i, language = languages[i % 3], watchers = i % 5)
+            for i in range(250)]
+        test = parsers.parse_bitbucket("team")
+
+        self.assertEqual(test.repos, 250)
+        self.assertEqual(test.forks, 0)
+        self.assertEqual(test.watchers, sum(i % 5 for i in range(250)))
+        self.assertDictEqual(dict(test.languages), {"python": 84, "java": 83, "none": 83})
+
+        # one request per page and exactly one watcher request per repo
+        self.assertEqual(self.upstream.count("/repositories/team?"), 3)
+        self.assertEqual(self.upstream.count("/watchers"), 250)
+        watcher_requests = [url for url in self.upstream.requests if url.endswith("/watchers?fields=size")]
+        self.assertEqual(len(set(watcher_requests)), 250)
+
+    def test_parse_bitbucket_pages_concurrent(self):
+        self.upstream.bitbucket["team"] = [stub.bitbucket_repo("team", i) for i in range(500)]
+        self.upstream.latency = 0.01
+        test = parsers.parse_bitbucket("team")
+
+        self.assertEqual(test.repos, 500)
+        self.assertEqual(test.watchers, 500)
+        self.assertGreater(self.upstream.max_in_flight, 1)
+        self.assertLessEqual(self.upstream.max_in_flight, parsers.WATCHER_CONCURRENCY + 4)
+
+    def test_parse_github_pages(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i, fork = i % 4 == 0, language = "Python" if i % 2 else "C",
+            watchers = 2, topics = ["api"] if i % 10 == 0 else []) for i in range(1234)]
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos, 925)
+        self.assertEqual(test.forks, 309)
+        self.assertEqual(test.watchers, 2468)
+        self.assertDictEqual(dict(test.languages), {"python": 617, "c": 617})
+        self.assertDictEqual(dict(test.topics), {"api": 124})
+
+        # every page is requested exactly once
+        page_requests = [url for url in self.upstream.requests if "/orgs/org/repos" in url]
+        self.assertEqual(len(page_requests), 13)
+        self.assertEqual(len(set(page_requests)), 13)
+
+    def test_parse_github_pages_concurrent(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i) for i in range(3000)]
+        self.upstream.latency = 0.01
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos, 3000)
+        self.assertGreater(self.upstream.max_in_flight, 1)
+        self.assertLessEqual(self.upstream.max_in_flight, parsers.PAGE_CONCURRENCY)
+
+    def test_parse_github_single_page(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i) for i in range(5)]
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos, 5)
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 1)
+
+    def test_parse_github_null_languages(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i, fork = True, language = None,
+            languages = {"Ruby": 10, "Go": 20} if i % 2 else {}) for i in range(150)]
+        self.upstream.latency = 0.01
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.forks, 150)
+        self.assertDictEqual(dict(test.languages), {"go": 75, "none": 75})
+
+        # every null language is looked up once, and the lookups overlap
+        self.assertEqual(self.upstream.count("/languages"), 150)
+        self.assertGreater(self.upstream.max_in_flight, 1)
+        self.assertLessEqual(self.upstream.max_in_flight, parsers.LANGUAGE_CONCURRENCY)
+
+    def test_parse_bitbucket_without_watchers(self):
+        repos = stub.bitbucket_team("team", 250)
+        self.upstream.bitbucket["team"] = repos
+        test = client.run(parsers.fetch_bitbucket("team", fields = {"repos", "languages"}))
+
+        expected = stub.bitbucket_profile(repos)
+        self.assertEqual(test.repos, expected["repos"])
+        self.assertDictEqual(dict(test.languages), expected["languages"])
+        # the listing pages and nothing else
+        self.assertEqual(self.upstream.count("/watchers"), 0)
+        self.assertEqual(len(self.upstream.requests), 3)
+
+    def test_parse_github_without_languages(self):
+        repos = stub.github_org("org", 250, null_languages = 0.2)
+        self.upstream.github["org"] = repos
+        test = client.run(parsers.fetch_github("org", fields = {"repos", "forks", "watchers"}))
+
+        expected = stub.github_profile(repos)
+        self.assertEqual((test.repos, test.forks, test.watchers), (expected["repos"], expected["forks"], expected["watchers"]))
+        self.assertEqual(self.upstream.count("/languages"), 0)
+
+    def test_parse_github_scale(self):
+        repos = stub.github_org("org", 10000, null_languages = 0.02)
+        self.upstream.github["org"] = repos
+        test = parsers.parse_github("org")
+
+        self.assertDictEqual(test.dict(), stub.github_profile(repos))
+        # one request per page, plus one per null language
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 100)
+        self.assertEqual(self.upstream.count("/languages"), sum(1 for repo in repos if repo["language"] is None))
+
+    def test_parse_bitbucket_scale(self):
+        repos = stub.bitbucket_team("team", 2000, null_languages = 0.02)
+        self.upstream.bitbucket["team"] = repos
+        test = parsers.parse_bitbucket("team")
+
+        self.assertDictEqual(test.dict(), stub.bitbucket_profile(repos))
+        # one request per page, plus one per repo for its watchers
+        self.assertEqual(self.upstream.count("/repositories/team?"), 20)
+        self.assertEqual(self.upstream.count("/watchers"), 2000)
+
+    def test_parse_github_graphql(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i, fork = i % 3 == 0, language = None if i % 5 == 0 else "Python",
+            languages = {"Ruby": 10} if i % 5 == 0 else None, watchers = 3, topics = ["api"] if i % 2 else [])
+            for i in range(250)]
+
+        rest = parsers.parse_github("org", graphql = False)
+        test = parsers.parse_github("org", graphql = True)
+        self.assertEqual(test.dict(), rest.dict())
+        self.assertDictEqual(dict(test.languages), {"python": 200, "ruby": 50})
+
+        # 100 repos per query, and no languages_url lookups
+        self.assertEqual(self.upstream.count("/graphql"), 3)
+        self.assertEqual(self.upstream.count("/languages"), 50)
+
+    def test_parse_github_graphql_missing(self):
+        with self.assertRaises(ConnectionError):
+            parsers.parse_github("missing", graphql = True)
+
+    def test_parse_bitbucket_missing(self):
+        with self.assertRaises(ConnectionError):
+            parsers.parse_bitbucket("missing")
+
+    def test_parse_partial_profile(self):
+        repos = stub.github_org("org", 3000)
+        self.upstream.github["org"] = repos
+        self.upstream.latency = 0.1
+        cache.profiles.clear()
+        test = parsers.parse_partial_profile(None, "org", 0.15)
+
+        self.assertEqual(test.complete, {"bitbucket": True, "github": False})
+        self.assertEqual(test.errors, {})
+        self.assertGreater(test.profile.repos + test.profile.forks, 0)
+        self.assertLess(test.profile.repos + test.profile.forks, 3000)
+
+        # the crawl carried on past the deadline, asking again waits on it instead of starting over
+        test = parsers.parse_partial_profile(None, "org", 10)
+        self.assertEqual(test.complete, {"bitbucket": True, "github": True})
+        self.assertDictEqual(test.profile.dict(), stub.github_profile(repos))
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 30)
+
+    def test_partial_profile_overlapping_fields(self):
+        team = stub.bitbucket_team("team", 600)
+        self.upstream.bitbucket["team"] = team
+        self.upstream.latency = 0.05
+        cache.profiles.clear()
+
+        async def overlap():
+            full = asyncio.ensure_future(parsers.fetch_partial_profile("team", None, 0.3))
+            await asyncio.sleep(0.05)
+            # a crawl without watchers runs, and ends, alongside the full one
+            repos_only = await parsers.fetch_partial_profile("team", None, 10, {"repos"})
+            return await full, repos_only
+        full, repos_only = client.run(overlap())
+
+        self.assertEqual(repos_only.complete, {"bitbucket": True, "github": True})
+        self.assertEqual(repos_only.profile.repos, 600)
+        # the full crawl's running totals were still the ones shown at its deadline
+        self.assertEqual(full.complete, {"bitbucket": False, "github": True})
+        self.assertGreater(full.profile.repos, 0)
+        self.assertGreater(full.profile.watchers, 0)
+        stub.wait_for_crawls()
+
+    def test_parse_partial_profile_errors(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i) for i in range(5)]
+        cache.profiles.clear()
+        test = parsers.parse_partial_profile("missing", "org", 10)
+
+        self.assertEqual(test.complete, {"bitbucket": False, "github": True})
+        self.assertIn("bitbucket", test.errors)
+        self.assertEqual(test.profile.repos, 5)
+
+    def test_parse_stream_profile(self):
+        github = stub.github_org("org", 2000)
+        bitbucket = stub.bitbucket_team("team", 200)
+        self.upstream.github["org"] = github
+        self.upstream.bitbucket["team"] = bitbucket
+        self.upstream.latency = 0.02
+        cache.profiles.clear()
+        lines = list(parsers.parse_stream_profile("team", "org"))
+
+        # the totals only ever grow, and the last ones are the whole profile
+        self.assertGreater(len(lines), 2)
+        counts = [(partial.profile.repos + partial.profile.forks, partial.profile.watchers) for partial, _ in lines]
+        self.assertEqual(counts, sorted(counts))
+        self.assertEqual([done for _, done in lines], [False] * (len(lines) - 1) + [True])
+        last = lines[-1][0]
+        self.assertEqual(last.complete, {"bitbucket": True, "github": True})
+        expected = OrganizationProfile.from_dict(stub.github_profile(github)) + OrganizationProfile.from_dict(stub.bitbucket_profile(bitbucket))
+        self.assertDictEqual(last.profile.dict(), expected.dict())
+        # the crawls are done, nothing is left registered
+        self.assertEqual(parsers.crawls, {})
+
+    def test_parse_stream_profile_deadline(self):
+        self.upstream.github["org"] = stub.github_org("org", 3000)
+        self.upstream.latency = 0.1
+        cache.profiles.clear()
+        lines = list(parsers.parse_stream_profile(None, "org", deadline = 0.15))
+
+        partial, done = lines[-1]
+        self.assertTrue(done)
+        self.assertEqual(partial.complete, {"bitbucket": True, "github": False})
+        self.assertLess(partial.profile.repos + partial.profile.forks, 3000)
+        stub.wait_for_crawls()
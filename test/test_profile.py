@@ -5,6 +5,7 @@ from collections import defaultdict
 
 import app
 from app import profile
+from app.sketch import SpaceSaving
 
 class TestOrganizationProfile(unittest.TestCase):
     def test_init_empty(self):
@@ -141,3 +142,73 @@ class TestOrganizationProfile(unittest.TestCase):
         test_dict = test.dict()
         
         self.assertEqual(test_dict, {"repos": repos, "forks": forks, "watchers": watchers, "languages": languages, "topics": topics})
+        self.assertEqual(test.dict({"repos", "languages"}), {"repos": repos, "languages": languages})
+
+    def test_defaults_not_shared(self):
+        first = profile.OrganizationProfile()
+        second = profile.OrganizationProfile()
+        first.languages["python"] += 1
+        first.topics["test"] += 1
+
+        self.assertEqual(second.languages, defaultdict(int, {}))
+        self.assertEqual(second.topics, defaultdict(int, {}))
+
+    def test_add_leaves_inputs(self):
+        filled_1 = profile.OrganizationProfile(repos = 1, languages = {"python": 1}, topics = {"test": 1})
+        filled_2 = profile.OrganizationProfile(repos = 2, languages = {"python": 2, "java": 1})
+        test = filled_1 + filled_2
+
+        self.assertDictEqual(dict(test.languages), {"python": 3, "java": 1})
+        self.assertDictEqual(dict(filled_1.languages), {"python": 1})
+        self.assertDictEqual(dict(filled_2.languages), {"python": 2, "java": 1})
+
+    def test_iadd(self):
+        test = profile.OrganizationProfile(repos = 1, forks = 1, watchers = 1, languages = {"python": 1})
+        languages = test.languages
+        test += profile.OrganizationProfile(repos = 2, forks = 3, watchers = 4, languages = {"python": 1, "c": 0}, topics = {"test": 2})
+
+        self.assertEqual(test.repos, 3)
+        self.assertEqual(test.forks, 4)
+        self.assertEqual(test.watchers, 5)
+        # zero counts are kept like the dict based merge did
+        self.assertDictEqual(dict(test.languages), {"python": 2, "c": 0})
+        self.assertDictEqual(dict(test.topics), {"test": 2})
+        self.assertIs(test.languages, languages)
+
+    def test_merge_many(self):
+        language_options = ["python", "java", "objective-c", "c++", "swift", "php"]
+        profiles = [profile.OrganizationProfile(repos = 1, watchers = random.randint(0, 10),
+            languages = {random.choice(language_options): 1}, topics = {"test": 1}) for _ in range(100)]
+
+        test = profile.OrganizationProfile.merge_many(profiles)
+        gold = profiles[0]
+        for other in profiles[1:]:
+            gold = gold + other
+
+        self.assertEqual(test.dict(), gold.dict())
+        self.assertEqual(test.repos, 100)
+        self.assertDictEqual(test.topics, {"test": 100})
+
+    def test_merge_many_empty(self):
+        test = profile.OrganizationProfile.merge_many([])
+        self.assertEqual(test.dict(), profile.OrganizationProfile().dict())
+
+    def test_from_dict(self):
+        test = profile.OrganizationProfile(repos = 1, forks = 2, watchers = 3, languages = {"python": 1}, topics = {"test": 2})
+        self.assertEqual(profile.OrganizationProfile.from_dict(json.loads(json.dumps(test.dict()))).dict(), test.dict())
+
+    def test_merge_many_top(self):
+        profiles = [profile.OrganizationProfile(repos = 1, languages = {"python": 2, f"language-{i}": 1},
+            topics = {f"topic-{i}": 1}) for i in range(50)]
+        test = profile.OrganizationProfile.merge_many(profiles, top = 5)
+
+        self.assertEqual(test.repos, 50)
+        self.assertEqual(len(test.languages), 5)
+        self.assertEqual(len(test.topics), 5)
+        self.assertEqual(test.languages.most_common(1)[0][0], "python")
+        self.assertGreaterEqual(test.languages["python"], 100)
+
+        # adding onto a bounded profile keeps it bounded
+        test = test + profiles[0]
+        self.assertIsInstance(test.topics, SpaceSaving)
+        self.assertEqual(len(test.topics), 5)
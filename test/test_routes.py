@@ -1,8 +1,12 @@
 import json
 import unittest
 
+from app import cache, client
+from app.profile import OrganizationProfile
 from app.routes import app
 
+from test import stub
+
 class TestApi(unittest.TestCase):
     def setUp(self):
         app.testing = True
@@ -62,3 +66,164 @@ class TestApi(unittest.TestCase):
             'watchers': 8345
         }
         self.assertDictEqual(json.loads(result.data), result_gold)
+
+class TestApiStub(unittest.TestCase):
+    def setUp(self):
+        app.testing = True
+        self.client = app.test_client()
+        self.upstream = stub.Upstream(
+            github = {"org": [stub.github_repo("org", 0, topics = ["api"]), stub.github_repo("org", 1, fork = True, language = "Go", watchers = 4)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", 0, language = "ruby", watchers = 3)]},
+            latency = 0.05)
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        cache.profiles.clear()
+
+    def tearDown(self):
+        client.configure(transport = None)
+
+    def test_profile_both(self):
+        result = self.client.get('/profile?bitbucket-team=team&github-org=org')
+        result_gold = {
+            'forks': 1,
+            'languages': {'go': 1, 'python': 1, 'ruby': 1},
+            'repos': 2,
+            'topics': {'api': 1},
+            'watchers': 8
+        }
+        self.assertDictEqual(json.loads(result.data), result_gold)
+
+        # both providers are requested at the same time
+        self.assertGreaterEqual(self.upstream.max_in_flight, 2)
+
+    def test_profile_fields(self):
+        result = self.client.get('/profile?bitbucket-team=team&github-org=org&fields=repos,languages')
+        self.assertEqual(result.status_code, 200)
+        self.assertDictEqual(json.loads(result.data), {'repos': 2, 'languages': {'go': 1, 'python': 1, 'ruby': 1}})
+        self.assertEqual(self.upstream.count("/watchers"), 0)
+
+        # the profile without watchers isn't served to a request that wants them
+        result = json.loads(self.client.get('/profile?bitbucket-team=team&github-org=org').data)
+        self.assertEqual(result['watchers'], 8)
+        self.assertEqual(self.upstream.count("/watchers"), 1)
+
+        # but the full profile is served to one that doesn't
+        requests = len(self.upstream.requests)
+        result = json.loads(self.client.get('/profile?bitbucket-team=team&github-org=org&fields=repos').data)
+        self.assertDictEqual(result, {'repos': 2})
+        self.assertEqual(len(self.upstream.requests), requests)
+
+        for fields in ['', 'repos,stars', ',']:
+            self.assertEqual(self.client.get(f'/profile?github-org=org&fields={fields}').status_code, 400)
+
+    def test_profile_top(self):
+        self.upstream.github["org"].append(stub.github_repo("org", 2, language = "Go", topics = ["api", "cli"]))
+        result = self.client.get('/profile?bitbucket-team=team&github-org=org&top=1')
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.data)
+
+        self.assertDictEqual(result['languages'], {'go': 2})
+        self.assertDictEqual(result['topics'], {'api': 2})
+        self.assertDictEqual(result['bounds'], {'languages': 1, 'topics': 1})
+        self.assertEqual(result['repos'], 3)
+
+        result = json.loads(self.client.get('/profile?github-org=org&top=1&fields=topics').data)
+        self.assertDictEqual(result, {'topics': {'api': 2}, 'bounds': {'topics': 1}})
+
+        for top in ['0', '-1', 'two', '1.5']:
+            self.assertEqual(self.client.get(f'/profile?github-org=org&top={top}').status_code, 400)
+
+    def test_profile_missing(self):
+        result = self.client.get('/profile?github-org=missing')
+        self.assertEqual(result.status_code, 500)
+
+    def test_profile_deadline(self):
+        # the crawl goes on after the test, so it gets an org of its own
+        self.upstream.github["slow"] = stub.github_org("slow", 3000)
+        self.upstream.latency = 0.1
+        result = self.client.get('/profile?github-org=slow&deadline=0.25')
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.data)
+
+        self.assertDictEqual(result['complete'], {'bitbucket': True, 'github': False})
+        self.assertDictEqual(result['errors'], {})
+        self.assertGreater(result['repos'], 1)
+        stub.wait_for_crawls()
+
+        # a provider that fails is reported instead of failing the request
+        result = json.loads(self.client.get('/profile?bitbucket-team=missing&github-org=org&deadline=10').data)
+        self.assertDictEqual(result['complete'], {'bitbucket': False, 'github': True})
+        self.assertIn('bitbucket', result['errors'])
+        self.assertEqual(result['repos'], 1)
+
+        for deadline in ['soon', '0', '-1', 'nan', 'inf']:
+            self.assertEqual(self.client.get(f'/profile?github-org=org&deadline={deadline}').status_code, 400)
+
+    def test_profile_stream(self):
+        self.upstream.github["big"] = stub.github_org("big", 2000)
+        result = self.client.get('/profile?bitbucket-team=team&github-org=big&stream=1')
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in result.data.decode().splitlines()]
+
+        self.assertGreater(len(lines), 2)
+        self.assertEqual([line['done'] for line in lines], [False] * (len(lines) - 1) + [True])
+        expected = OrganizationProfile.from_dict(stub.github_profile(self.upstream.github["big"])) + \
+            OrganizationProfile.from_dict(stub.bitbucket_profile(self.upstream.bitbucket["team"]))
+        self.assertDictEqual({key: lines[-1][key] for key in expected.dict()}, expected.dict())
+        self.assertDictEqual(lines[-1]['complete'], {'bitbucket': True, 'github': True})
+
+    def test_profile_scale(self):
+        self.upstream.github["big"] = stub.github_org("big", 10000, null_languages = 0.02)
+        self.upstream.bitbucket["big"] = stub.bitbucket_team("big", 1000, null_languages = 0.02)
+        result = self.client.get('/profile?bitbucket-team=big&github-org=big')
+        self.assertEqual(result.status_code, 200)
+
+        expected = OrganizationProfile.from_dict(stub.github_profile(self.upstream.github["big"])) + \
+            OrganizationProfile.from_dict(stub.bitbucket_profile(self.upstream.bitbucket["big"]))
+        self.assertDictEqual(json.loads(result.data), expected.dict())
+
+    def test_profiles_batch(self):
+        self.upstream.github["org2"] = [stub.github_repo("org2", 0, language = "C", topics = ["api"])]
+        result = self.client.post('/profiles', json = {
+            'bitbucket-teams': ['team', 'missing'],
+            'github-orgs': ['org', 'org2', 'org']
+        })
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.data)
+
+        self.assertDictEqual(result['profiles']['bitbucket'], {
+            'team': {'forks': 0, 'languages': {'ruby': 1}, 'repos': 1, 'topics': {}, 'watchers': 3}
+        })
+        self.assertEqual(set(result['profiles']['github']), {'org', 'org2'})
+        self.assertEqual(list(result['errors']['bitbucket']), ['missing'])
+        self.assertDictEqual(result['errors']['github'], {})
+        self.assertDictEqual(result['total'], {
+            'forks': 1,
+            'languages': {'c': 1, 'go': 1, 'python': 1, 'ruby': 1},
+            'repos': 3,
+            'topics': {'api': 2},
+            'watchers': 9
+        })
+
+        # every team and org is crawled at the same time
+        self.assertGreaterEqual(self.upstream.max_in_flight, 4)
+
+    def test_profiles_top(self):
+        self.upstream.github.update({f"org-{i}": [stub.github_repo(f"org-{i}", 0, topics = ["api", f"topic-{i}"])] for i in range(10)})
+        result = self.client.post('/profiles?top=3', json = {'github-orgs': [f"org-{i}" for i in range(10)]})
+        self.assertEqual(result.status_code, 200)
+        result = json.loads(result.data)
+
+        self.assertEqual(result['total']['repos'], 10)
+        self.assertEqual(len(result['total']['topics']), 3)
+        self.assertEqual(result['total']['topics']['api'], 10)
+        self.assertLessEqual(result['total']['bounds']['topics'], 10 * 2 / 3)
+        self.assertDictEqual(result['profiles']['github']['org-0']['bounds'], {'languages': 0, 'topics': 0})
+
+        self.assertEqual(self.client.post('/profiles?top=0', json = {'github-orgs': ['org']}).status_code, 400)
+
+    def test_profiles_bad_request(self):
+        for body in [None, [], {'github-orgs': 'org'}, {'bitbucket-teams': [1]}]:
+            result = self.client.post('/profiles', json = body)
+            self.assertEqual(result.status_code, 400)
@@ -0,0 +1,217 @@
+import time
+import asyncio
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+
+import app
+from app import cache, client, parsers, scheduler
+
+from test import stub
+
+class TestTokenBucket(unittest.TestCase):
+    def test_unlimited(self):
+        bucket = scheduler.TokenBucket()
+        for _ in range(100):
+            self.assertEqual(bucket.wait_time(), 0)
+            bucket.take()
+
+    def test_rate(self):
+        bucket = scheduler.TokenBucket(rate = 10, capacity = 2)
+        bucket.take()
+        bucket.take()
+        self.assertGreater(bucket.wait_time(), 0)
+        self.assertLessEqual(bucket.wait_time(), 0.1)
+
+    def test_upstream_limit(self):
+        bucket = scheduler.TokenBucket()
+        bucket.limit(0, time.time() + 5)
+        self.assertGreater(bucket.wait_time(), 4)
+
+        # the window reset, so we're unlimited again
+        bucket.reset_at = time.monotonic()
+        self.assertEqual(bucket.wait_time(), 0)
+
+class TestHostScheduler(unittest.TestCase):
+    def send(self, host: scheduler.HostScheduler, responses: list) -> httpx.Response:
+        async def request():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return asyncio.run(host.send(request))
+
+    def test_retry_server_errors(self):
+        host = scheduler.HostScheduler(backoff_base = 0.001)
+        response = self.send(host, [httpx.Response(503), httpx.Response(502), httpx.Response(200)])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(host.stats["retries"], 2)
+        self.assertEqual(host.stats["throttled"], 2)
+        # halved twice, then one additive step
+        self.assertLess(host.concurrency, host.max_concurrency / 2)
+
+    def test_retry_transport_errors(self):
+        host = scheduler.HostScheduler(backoff_base = 0.001, max_retries = 1)
+        request = httpx.Request("GET", "https://api.github.com")
+        error = httpx.ConnectError("refused", request = request)
+
+        self.assertEqual(self.send(host, [error, httpx.Response(200)]).status_code, 200)
+        with self.assertRaises(ConnectionError):
+            self.send(host, [error, error])
+
+    def test_no_retry_client_errors(self):
+        host = scheduler.HostScheduler(backoff_base = 0.001)
+        response = self.send(host, [httpx.Response(404), httpx.Response(200)])
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(host.stats["retries"], 0)
+
+    def test_retries_run_out(self):
+        host = scheduler.HostScheduler(backoff_base = 0.001, max_retries = 2)
+        response = self.send(host, [httpx.Response(429)] * 3)
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(host.stats["requests"], 3)
+        self.assertEqual(host.concurrency, 2.5)
+
+    def test_retry_after(self):
+        host = scheduler.HostScheduler(backoff_base = 0.001)
+        start = time.monotonic()
+        response = self.send(host, [httpx.Response(403, headers = {"Retry-After": "1"}), httpx.Response(200)])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - start, 1)
+
+    def test_stream_holds_slot(self):
+        host = scheduler.HostScheduler(max_concurrency = 1, backoff_base = 0.001)
+        responses = [httpx.Response(503), httpx.Response(200), httpx.Response(200)]
+        order = []
+
+        async def request():
+            return responses.pop(0)
+
+        async def read(name: str):
+            async with host.stream(request) as response:
+                order.append((name, "headers", host.in_flight))
+                # the body is still on its way, nobody else gets the host's only slot meanwhile
+                await asyncio.sleep(0.05)
+                order.append((name, "closed", response.status_code))
+
+        async def main():
+            await asyncio.gather(read("first"), read("second"))
+        asyncio.run(main())
+
+        # whichever got the retried 503, the two bodies were read one after the other
+        first, second = order[0][0], order[2][0]
+        self.assertEqual({first, second}, {"first", "second"})
+        self.assertEqual(order, [(first, "headers", 1), (first, "closed", 200),
+            (second, "headers", 1), (second, "closed", 200)])
+        self.assertEqual(host.in_flight, 0)
+        self.assertEqual(host.stats["retries"], 1)
+
+    def test_rate_limit_wait_capped(self):
+        host = scheduler.HostScheduler(max_wait = 5)
+        reset = time.time() + 3600
+        host.bucket.limit(0, reset)
+        with self.assertRaises(ConnectionError) as raised:
+            self.send(host, [httpx.Response(200)])
+        self.assertIn(time.strftime("%Y-%m-%d %H:", time.gmtime(reset)), str(raised.exception))
+
+        # a Retry-After past the cap isn't waited for either
+        host = scheduler.HostScheduler(max_wait = 5)
+        response = self.send(host, [httpx.Response(429, headers = {"Retry-After": "3600"}), httpx.Response(200)])
+        self.assertEqual(response.status_code, 429)
+
+    def test_additive_increase(self):
+        host = scheduler.HostScheduler(max_concurrency = 8)
+        host.concurrency = 1.0
+        self.send(host, [httpx.Response(200) for _ in range(1)])
+        self.assertEqual(host.concurrency, 2.0)
+
+        for _ in range(10):
+            self.send(host, [httpx.Response(200)])
+        self.assertGreater(host.concurrency, 4)
+        self.assertLessEqual(host.concurrency, 8)
+
+class TestSchedulerServer(unittest.TestCase):
+    def setUp(self):
+        statuses = [503, 503, 200]
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                body = b"[]"
+                self.send_response(statuses.pop(0) if len(statuses) > 1 else statuses[0])
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_retried_streams_closed(self):
+        # a real pool with a single connection, the retries need the ones they throttled back
+        async def main():
+            async with httpx.AsyncClient(limits = httpx.Limits(max_connections = 1), timeout = httpx.Timeout(5, pool = 1)) as http:
+                host = scheduler.HostScheduler(backoff_base = 0.001)
+                url = f"http://127.0.0.1:{self.server.server_port}/"
+                response = await host.send(lambda: http.send(http.build_request("GET", url), stream = True))
+                await response.aclose()
+                return response, host
+        response, host = asyncio.run(main())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(host.stats["retries"], 2)
+
+class TestSchedulerStub(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream()
+        client.configure(transport = self.upstream.transport(), backoff_base = 0.01, backoff_cap = 0.1, max_retries = 8)
+        cache.responses.clear()
+
+    def tearDown(self):
+        client.configure(transport = None, backoff_base = 0.5, backoff_cap = 30.0, max_retries = 4)
+
+    def test_secondary_rate_limit(self):
+        self.upstream.bitbucket["team"] = [stub.bitbucket_repo("team", i, watchers = 2) for i in range(300)]
+        self.upstream.latency = 0.005
+        self.upstream.max_concurrent = 4
+        test = parsers.parse_bitbucket("team")
+
+        # the crawl backed off instead of failing, and settled close to what the host allows
+        self.assertEqual(test.repos, 300)
+        self.assertEqual(test.watchers, 600)
+        self.assertGreater(self.upstream.throttled, 0)
+        stats = client.pool_stats()["hosts"]["api.bitbucket.org"]
+        self.assertLessEqual(stats["concurrency"], 8)
+        self.assertGreater(stats["retries"], 0)
+
+    def test_primary_rate_limit(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i) for i in range(1000)]
+        self.upstream.rate_limit = 6
+        self.upstream.rate_window = 1.0
+        test = parsers.parse_github("org")
+
+        # 10 pages with 6 requests per window has to wait for one reset
+        self.assertEqual(test.repos, 1000)
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 10 + self.upstream.throttled)
+        self.assertLessEqual(self.upstream.throttled, 4)
+
+    def test_server_errors(self):
+        self.upstream.github["org"] = [stub.github_repo("org", i) for i in range(3)]
+        self.upstream.failures = [502, 503]
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos, 3)
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 3)
@@ -0,0 +1,78 @@
+import copy
+import pickle
+import random
+import unittest
+from collections import Counter
+
+from app.sketch import SpaceSaving
+
+class TestSpaceSaving(unittest.TestCase):
+    def parts(self, count: int) -> list:
+        # a few common keys and a long tail of rare ones, like the topics of many orgs
+        rng = random.Random(count)
+        return [Counter({f"topic-{int(rng.paretovariate(1.2))}": rng.randint(1, 5) for _ in range(40)}) for _ in range(count)]
+
+    def assertWithinBounds(self, summary: SpaceSaving, exact: Counter):
+        for key, count in exact.items():
+            lowest, highest = summary.bounds(key)
+            self.assertLessEqual(lowest, count)
+            self.assertGreaterEqual(highest, count)
+
+    def test_exact_under_capacity(self):
+        summary = SpaceSaving(3, {"a": 2, "b": 1})
+        summary.update({"a": 1, "c": 4})
+
+        self.assertDictEqual(dict(summary), {"a": 3, "b": 1, "c": 4})
+        self.assertEqual(summary.floor, 0)
+        self.assertEqual(summary.bounds("a"), (3, 3))
+        self.assertEqual(summary.bounds("d"), (0, 0))
+
+    def test_trimmed(self):
+        summary = SpaceSaving(2, {"a": 5, "b": 1, "c": 3})
+        self.assertDictEqual(dict(summary), {"a": 5, "c": 3})
+        self.assertEqual(summary.floor, 1)
+
+        # a new key could have been the one dropped, so it starts from the floor
+        summary.update(["d"])
+        self.assertDictEqual(dict(summary), {"a": 5, "c": 3})
+        self.assertEqual(summary.floor, 2)
+        self.assertEqual(summary.bounds("b"), (0, 2))
+
+    def test_bounds(self):
+        parts = self.parts(300)
+        exact = sum(parts, Counter())
+        summary = SpaceSaving(20)
+        for part in parts:
+            summary.update(part)
+
+        self.assertEqual(len(summary), 20)
+        self.assertLessEqual(summary.floor, sum(exact.values()) / 20)
+        self.assertWithinBounds(summary, exact)
+        # the common keys come out on top
+        self.assertEqual([key for key, _ in summary.most_common(3)], [key for key, _ in exact.most_common(3)])
+
+    def test_merge(self):
+        parts = self.parts(200)
+        summaries = [SpaceSaving(15, sum(parts[start:start + 50], Counter())) for start in range(0, 200, 50)]
+        merged = SpaceSaving(15)
+        for summary in summaries:
+            merged.update(summary)
+
+        self.assertEqual(len(merged), 15)
+        self.assertGreaterEqual(merged.floor, max(summary.floor for summary in summaries))
+        self.assertWithinBounds(merged, sum(parts, Counter()))
+
+    def test_copy(self):
+        summary = SpaceSaving(2, {"a": 5, "b": 1, "c": 3})
+        for other in [summary.copy(), copy.copy(summary), pickle.loads(pickle.dumps(summary))]:
+            self.assertIsInstance(other, SpaceSaving)
+            self.assertDictEqual(dict(other), dict(summary))
+            self.assertEqual((other.capacity, other.floor), (2, 1))
+
+        other = summary.copy()
+        other.update({"a": 1})
+        self.assertEqual(summary["a"], 5)
+
+    def test_capacity(self):
+        with self.assertRaises(ValueError):
+            SpaceSaving(0)
@@ -0,0 +1,161 @@
+import os
+import time
+import sqlite3
+import tempfile
+import unittest
+
+import app
+from app import cache, client, incremental, snapshots
+from app.profile import OrganizationProfile
+from app.routes import app as flask_app
+
+from test import stub
+
+class TestSnapshotStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshots.sqlite3")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_survives_restart(self):
+        store = snapshots.SnapshotStore(self.path)
+        profile = OrganizationProfile(repos = 2, forks = 1, watchers = 5, languages = {"python": 2}, topics = {"api": 1})
+        store.save("github", "org", profile, updated = 100.0)
+        store.close()
+
+        store = snapshots.SnapshotStore(self.path)
+        snapshot = store.get("github", "org")
+        self.assertEqual(snapshot.profile.dict(), profile.dict())
+        self.assertEqual(snapshot.updated, 100.0)
+        self.assertIsNone(store.get("bitbucket", "org"))
+        store.close()
+
+    def test_overwrite(self):
+        store = snapshots.SnapshotStore(self.path)
+        store.save("github", "org", OrganizationProfile(repos = 1))
+        store.save("github", "org", OrganizationProfile(repos = 2))
+        self.assertEqual(store.get("github", "org").profile.repos, 2)
+        store.close()
+
+class TestRefreshWorker(unittest.TestCase):
+    def setUp(self):
+        self.upstream = stub.Upstream(github = {"org": [stub.github_repo("org", i) for i in range(3)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", i) for i in range(2)]})
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+        cache.profiles.clear()
+        self.store = snapshots.SnapshotStore(":memory:")
+        self.refreshers = {provider: incremental.refresher(provider, self.store) for provider in ["bitbucket", "github"]}
+
+    def tearDown(self):
+        snapshots.stop()
+        client.configure(transport = None)
+
+    def test_refresh(self):
+        worker = snapshots.RefreshWorker(self.store, [("github", "org"), ("bitbucket", "team"), ("github", "missing")],
+            self.refreshers, interval = 60)
+        client.run(worker.run_once())
+
+        self.assertEqual(self.store.get("github", "org").profile.repos, 3)
+        self.assertEqual(self.store.get("bitbucket", "team").profile.repos, 2)
+        self.assertIsNone(self.store.get("github", "missing"))
+
+        # nothing is due again until the interval is over, not even the failed one
+        self.assertEqual(worker.due(), [])
+        requests = len(self.upstream.requests)
+        client.run(worker.run_once())
+        self.assertEqual(len(self.upstream.requests), requests)
+
+    def test_cold_start(self):
+        # a recent snapshot from before the restart isn't gathered again
+        self.store.save("github", "org", OrganizationProfile(repos = 7), updated = time.time() - 10)
+        self.store.save("bitbucket", "team", OrganizationProfile(repos = 1), updated = time.time() - 120)
+        worker = snapshots.RefreshWorker(self.store, [("github", "org"), ("bitbucket", "team")], self.refreshers, interval = 60)
+
+        self.assertEqual(worker.due(), [("bitbucket", "team")])
+        client.run(worker.run_once())
+        self.assertEqual(self.upstream.count("api.github.com"), 0)
+        self.assertEqual(self.store.get("github", "org").profile.repos, 7)
+        self.assertEqual(self.store.get("bitbucket", "team").profile.repos, 2)
+
+    def test_save_failure(self):
+        class BrokenStore(snapshots.SnapshotStore):
+            def save(self, *args, **kwargs):
+                raise sqlite3.OperationalError("database is locked")
+
+        store = BrokenStore(":memory:")
+        worker = snapshots.RefreshWorker(store, [("github", "org"), ("bitbucket", "team")], self.refreshers, interval = 60)
+        # logged and retried after the interval instead of raised
+        client.run(worker.run_once())
+        self.assertEqual(worker.due(), [])
+        store.close()
+
+    def test_stale_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "snapshots.sqlite3")
+        store = snapshots.SnapshotStore(path)
+        store.save("github", "gone", OrganizationProfile(repos = 42), updated = time.time() - 60 * snapshots.STALE_INTERVALS - 10)
+        store.close()
+
+        # its refreshes fail, after too many of them it's gathered live rather than served frozen
+        snapshots.start(watchlist = [("github", "gone")], path = path, interval = 60)
+        self.assertIsNone(snapshots.lookup("github", "gone"))
+        self.assertEqual(flask_app.test_client().get('/profile?github-org=gone').status_code, 500)
+
+    def test_single_refresher(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "snapshots.sqlite3")
+        # two worker processes sharing the same file
+        stores = [snapshots.SnapshotStore(path), snapshots.SnapshotStore(path)]
+        workers = [snapshots.RefreshWorker(store, [("github", "org")], {provider: incremental.refresher(provider, store)
+            for provider in ["bitbucket", "github"]}, interval = 60, lock = snapshots.RefreshLock(path + ".lock")) for store in stores]
+
+        self.assertTrue(workers[0].refreshing())
+        self.assertFalse(workers[1].refreshing())
+        client.run(workers[0].run_once())
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 1)
+
+        # the other one reads what was saved instead of gathering it again
+        self.assertIsNone(stores[1].get("github", "org"))
+        stores[1].reload()
+        self.assertEqual(stores[1].get("github", "org").profile.repos, 3)
+        self.assertEqual(workers[1].due(), [])
+
+        # and takes over once the first one is gone
+        workers[0].lock.release()
+        self.assertTrue(workers[1].refreshing())
+        workers[1].lock.release()
+        for store in stores:
+            store.close()
+
+    def test_profile_served_from_snapshot(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "snapshots.sqlite3")
+        store = snapshots.SnapshotStore(path)
+        store.save("github", "org", OrganizationProfile(repos = 42, languages = {"c": 42}))
+        store.close()
+
+        snapshots.start(watchlist = [("github", "org")], path = path, interval = 60)
+        test_client = flask_app.test_client()
+        result = test_client.get('/profile?github-org=org').get_json()
+
+        self.assertEqual(result["repos"], 42)
+        self.assertEqual(self.upstream.count("/orgs/org/repos"), 0)
+
+        # orgs that aren't watched are still gathered live
+        result = test_client.get('/profile?bitbucket-team=team').get_json()
+        self.assertEqual(result["repos"], 2)
+
+    def test_watchlist_from_env(self):
+        os.environ["WATCH_BITBUCKET_TEAMS"] = "team, other"
+        os.environ["WATCH_GITHUB_ORGS"] = "org"
+        try:
+            self.assertEqual(snapshots.watchlist_from_env(), [("bitbucket", "team"), ("bitbucket", "other"), ("github", "org")])
+        finally:
+            del os.environ["WATCH_BITBUCKET_TEAMS"]
+            del os.environ["WATCH_GITHUB_ORGS"]
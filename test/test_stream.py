@@ -0,0 +1,99 @@
+import json
+import random
+import unittest
+
+import app
+from app import cache, client, parsers, stream
+
+from test import stub
+
+class TestItemParser(unittest.TestCase):
+    def parse(self, body: bytes, key: str = None, chunk_size: int = 7) -> list:
+        parser = stream.ItemParser(key)
+        items = []
+        for start in range(0, len(body), chunk_size):
+            items.extend(parser.feed(body[start:start + chunk_size]))
+        items.extend(parser.close())
+        return items, parser.fields
+
+    def test_list(self):
+        listing = [{"id": i, "name": f"repo-{i}", "topics": ["a", "b"], "language": None, "nested": {"x": [1, {"y": "]}"}]}}
+            for i in range(50)]
+        body = json.dumps(listing).encode()
+        for chunk_size in [1, 3, 64, len(body)]:
+            items, fields = self.parse(body, chunk_size = chunk_size)
+            self.assertEqual(items, listing)
+            self.assertDictEqual(fields, {})
+
+    def test_keyed_list(self):
+        page = {"pagelen": 100, "values": [{"slug": f"repo-{i}", "language": "é"} for i in range(20)],
+            "page": 12, "size": 12345, "next": "https://api.bitbucket.org/2.0/repositories/team?page=13"}
+        body = json.dumps(page, indent = 2).encode()
+        for chunk_size in [1, 5, len(body)]:
+            items, fields = self.parse(body, key = "values", chunk_size = chunk_size)
+            self.assertEqual(items, page["values"])
+            # numbers split across chunks aren't cut short
+            self.assertDictEqual(fields, {"pagelen": 100, "page": 12, "size": 12345, "next": page["next"]})
+
+    def test_split_numbers(self):
+        for body, key, expected in [(b'{"size": 12.5, "values": []}', "values", {"size": 12.5}),
+                (b'{"size": 1e3, "values": []}', "values", {"size": 1e3}),
+                (b'{"size": -2.5E-4, "values": []}', "values", {"size": -2.5E-4})]:
+            for split in range(1, len(body)):
+                parser = stream.ItemParser(key)
+                items = list(parser.feed(body[:split])) + list(parser.feed(body[split:])) + list(parser.close())
+                self.assertEqual((items, parser.fields), ([], expected), body[:split])
+        for body in [b'[12.5, 1e3, -0.25e+2]', b'[1E10]']:
+            expected = json.loads(body)
+            for split in range(1, len(body)):
+                parser = stream.ItemParser()
+                items = list(parser.feed(body[:split])) + list(parser.feed(body[split:])) + list(parser.close())
+                self.assertEqual(items, expected, body[:split])
+
+    def test_empty(self):
+        self.assertEqual(self.parse(b"[]"), ([], {}))
+        self.assertEqual(self.parse(b'{"values": [], "size": 0}', key = "values"), ([], {"size": 0}))
+
+    def test_items_before_end(self):
+        parser = stream.ItemParser()
+        self.assertEqual(list(parser.feed(b'[{"id": 1}, {"id": 2}, {"id"')), [{"id": 1}, {"id": 2}])
+        self.assertEqual(list(parser.feed(b': 3}]')), [{"id": 3}])
+        self.assertEqual(list(parser.close()), [])
+
+    def test_invalid(self):
+        for body, key in [(b'[{"id": 1}', None), (b'{"values": [1, 2', "values"), (b'[1] 2', None),
+                (b'{"id": 1}', None), (b'[1 2]', None)]:
+            with self.assertRaises(ValueError):
+                self.parse(body, key = key)
+
+class TestStreamedParsersStub(unittest.TestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.upstream = stub.Upstream(chunk_size = 97,
+            github = {"org": [stub.github_repo("org", i, fork = rng.random() < 0.2, language = rng.choice(["Go", "C", None]),
+                topics = rng.sample(["a", "b", "c", "d"], 2), languages = {"Rust": 1}) for i in range(450)]},
+            bitbucket = {"team": [stub.bitbucket_repo("team", i, language = rng.choice(["java", ""])) for i in range(230)]})
+        client.configure(transport = self.upstream.transport())
+        cache.responses.clear()
+
+    def tearDown(self):
+        client.configure(transport = None)
+
+    def test_github(self):
+        repos = self.upstream.github["org"]
+        test = parsers.parse_github("org")
+
+        self.assertEqual(test.repos + test.forks, 450)
+        self.assertEqual(test.forks, sum(1 for repo in repos if repo["fork"]))
+        self.assertEqual(test.languages["rust"], sum(1 for repo in repos if repo["language"] is None))
+        self.assertEqual(sum(test.topics.values()), 900)
+
+        # served again from the response cache through the same parser
+        self.assertEqual(parsers.parse_github("org").dict(), test.dict())
+
+    def test_bitbucket(self):
+        test = parsers.parse_bitbucket("team")
+
+        self.assertEqual(test.repos, 230)
+        self.assertEqual(test.watchers, 230)
+        self.assertEqual(sum(test.languages.values()), 230)